@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Compress the uncompressed binary data arrays of an indexed mzML with zlib (lossless).
+
+The spectra and chromatograms are located through the offset index of the input and
+rewritten one by one, so that memory usage is bounded by the largest single spectrum.
+Arrays that are already compressed are copied unchanged. The index of the output is
+rebuilt.
+"""
+
+import argparse
+import base64
+import os
+import re
+import sys
+import zlib
+
+from index_mzml import HashingWriter, write_index
+
+INDEX_LIST_OFFSET_REGEX = re.compile(rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>")
+INDEX_REGEX = re.compile(rb"<index\s+name=\"(spectrum|chromatogram)\"\s*>(.*?)</index>", re.S)
+OFFSET_REGEX = re.compile(rb"<offset\s+idRef=\"([^\"]*)\"\s*>\s*(\d+)\s*</offset>")
+BINARY_DATA_ARRAY_REGEX = re.compile(rb"(<binaryDataArray\b[^>]*>)(.*?</binaryDataArray>)", re.S)
+NO_COMPRESSION_REGEX = re.compile(rb"<cvParam[^>]*accession=\"MS:1000576\"[^>]*/>")
+BINARY_REGEX = re.compile(rb"<binary>\s*([^<]*?)\s*</binary>")
+ENCODED_LENGTH_REGEX = re.compile(rb"(\sencodedLength=\")\d+(\")")
+ZLIB_COMPRESSION = b"<cvParam cvRef=\"MS\" accession=\"MS:1000574\" name=\"zlib compression\" value=\"\"/>"
+MZML_END = b"</mzML>"
+
+
+def read_offsets(f):
+    """Return the (kind, native id, byte offset) of all spectra and chromatograms, sorted by offset."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 4096))
+    match = INDEX_LIST_OFFSET_REGEX.search(f.read())
+    if not match:
+        raise ValueError("No <indexListOffset> found. Is this an indexed mzML?")
+    index_list_offset = int(match.group(1))
+    f.seek(index_list_offset)
+    offsets = []
+    for kind, index in INDEX_REGEX.findall(f.read()):
+        offsets.extend((kind, native_id, int(offset)) for native_id, offset in OFFSET_REGEX.findall(index))
+    return sorted(offsets, key=lambda o: o[2]), index_list_offset
+
+
+def compress_array(match, level):
+    start_tag, content = match.group(1), match.group(2)
+    if not NO_COMPRESSION_REGEX.search(content):
+        return match.group(0)
+    binary = BINARY_REGEX.search(content)
+    data = base64.b64encode(zlib.compress(base64.b64decode(binary.group(1)), level)) if binary else b""
+    # the binary element is replaced first, its match positions are only valid in the unchanged content
+    if binary:
+        content = content[:binary.start()] + b"<binary>" + data + b"</binary>" + content[binary.end():]
+    content = NO_COMPRESSION_REGEX.sub(ZLIB_COMPRESSION, content, count=1)
+    start_tag = ENCODED_LENGTH_REGEX.sub(rb"\g<1>%d\g<2>" % len(data), start_tag, count=1)
+    return start_tag + content
+
+
+def compress(mzml, out_path, level):
+    with open(mzml, "rb") as f:
+        offsets, index_list_offset = read_offsets(f)
+        if not offsets:
+            raise ValueError("No spectra or chromatograms found in " + mzml)
+        # the last element ends before </mzML>, the old index is not copied
+        f.seek(offsets[-1][2])
+        tail = f.read(index_list_offset - offsets[-1][2])
+        mzml_end = tail.rfind(MZML_END)
+        if mzml_end < 0:
+            raise ValueError("No </mzML> found before the index.")
+        ends = [o[2] for o in offsets[1:]] + [offsets[-1][2] + mzml_end + len(MZML_END)]
+
+        out = HashingWriter(out_path)
+        f.seek(0)
+        out.write(f.read(offsets[0][2]))
+        new_offsets = {b"spectrum": [], b"chromatogram": []}
+        for (kind, native_id, start), end in zip(offsets, ends):
+            new_offsets[kind].append((native_id, out.pos))
+            out.write(BINARY_DATA_ARRAY_REGEX.sub(lambda m: compress_array(m, level), f.read(end - start)))
+        out.write(b"\n")
+        write_index(out, new_offsets[b"spectrum"], new_offsets[b"chromatogram"])
+    print("Compressed {} spectra and {} chromatograms of {}".format(
+        len(new_offsets[b"spectrum"]), len(new_offsets[b"chromatogram"]), mzml))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mzml", help="Indexed mzML")
+    parser.add_argument("out", help="Output indexed mzML")
+    parser.add_argument("--level", type=int, default=6, help="zlib compression level (1-9)")
+    args = parser.parse_args()
+
+    try:
+        compress(args.mzml, args.out, args.level)
+    except ValueError as e:
+        sys.exit("Error compressing {}: {}".format(args.mzml, e))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,109 @@
 #!/usr/bin/env python3
+"""
+Create an OpenMS experimental design for spectra files without SDRF or manual design.
 
-import sys
+Fractions, conditions and biological replicates are inferred from the file names:
+a token like `F3`, `Fr03` or `fraction3` marks the fraction of a file, a token like `R2`,
+`rep2` or `BR2` its biological replicate (tokens are separated by `_`, `-` or `.`).
+Files that only differ in the fraction token form one fraction group (one sample per
+label), samples that only differ in the replicate token form one condition. Files without
+such tokens are treated as unfractionated, unrelated samples, each with its own condition.
+
+The spectra files are either all mzMLs in a folder or listed (one name per line) in a file.
+The design is written in one pass to stdout or the given output file.
+"""
+
+import argparse
 import glob
+import os
 import re
+import sys
+
+FRACTION_REGEX = re.compile(r"(^|[_\-.])(?:f|fr|frac|fraction)[_\-]?(\d+)(?=$|[_\-.])", re.I)
+REPLICATE_REGEX = re.compile(r"(^|[_\-.])(?:r|rep|replicate|br|biorep)[_\-]?(\d+)(?=$|[_\-.])", re.I)
+
 
 # code to sort in a human readable way
 def atoi(text):
     return int(text) if text.isdigit() else text
 
+
 def natural_keys(text):
     '''
     alist.sort(key=natural_keys) sorts in human order
     e.g. UPS1_50amol_R1 is less than UPS1_1200amol_R1
     http://nedbatchelder.com/blog/200712/human_sorting.html
     '''
-    return [ atoi(c) for c in re.split(r'(\d+)', text) ]
-
-if not len(sys.argv) == 3:
-  print("Usage: MZML_FOLDER LABEL_PER_FILE")
-  exit()
-
-in_path = sys.argv[1]
-label_per_file = int(sys.argv[2])
-
-mzmls = [f for f in glob.glob(in_path + "/*.mzML", recursive=False)]
-mzmls.sort(key=natural_keys)
-
-file_count = 1
-fraction_group = 1
-label = 1
-sample = 1
-print("Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample")
-
-for f in mzmls:
-  for label in range(1, label_per_file + 1): 
-    print(str(file_count) + "\t" + str(fraction_group) + "\t" + f + "\t" + str(label) + "\t" + str(sample))
-    sample += 1
-  file_count += 1
-print()
-print("Sample\tMSstats_Condition\tMSstats_BioReplicate")
-sample = 1
-condition = 1
-bioreplicate = 1
-for f in mzmls:
-  for label in range(1, label_per_file + 1): 
-    print(str(sample) + "\t" + str(condition) + "\t" + str(bioreplicate))
-    sample += 1
-    condition += 1
-    bioreplicate += 1
+    return [atoi(c) for c in re.split(r'(\d+)', text)]
+
+
+def remove_token(regex, name):
+    """Return the number of the last token matching regex and the name without it (None and the name if there is none)."""
+    matches = list(regex.finditer(name))
+    if not matches:
+        return None, name
+    last = matches[-1]
+    return int(last.group(2)), name[:last.start()] + last.group(1) + name[last.end():]
+
+
+def infer_design(names, labels):
+    """Return the rows of the file table and the sample table of the design."""
+    # fraction groups: name without the fraction token -> [(fraction, name)]
+    groups = {}
+    for name in names:
+        fraction, group = remove_token(FRACTION_REGEX, os.path.splitext(os.path.basename(name))[0])
+        groups.setdefault(group, []).append((fraction or 0, name))
+
+    fraction_counts = set(len(files) for files in groups.values())
+    if len(fraction_counts) > 1:
+        print("Warning: fraction groups have different numbers of fractions ({}). Please check the design."
+              .format(", ".join(str(c) for c in sorted(fraction_counts))), file=sys.stderr)
+
+    file_rows = []
+    sample_rows = []
+    conditions = {}
+    bioreplicates = {}
+    sample = 0
+    for fraction_group, group in enumerate(sorted(groups, key=natural_keys), start=1):
+        replicate, condition_name = remove_token(REPLICATE_REGEX, group)
+        for label in range(1, labels + 1):
+            sample += 1
+            condition = conditions.setdefault((condition_name, label), len(conditions) + 1)
+            # replicates are numbered globally, so that equal numbers in different conditions are not taken as paired
+            key = (condition, "rep", replicate) if replicate is not None else (condition, "sample", sample)
+            bioreplicate = bioreplicates.setdefault(key, len(bioreplicates) + 1)
+            sample_rows.append((sample, condition, bioreplicate))
+            files = sorted(groups[group], key=lambda f: (f[0], natural_keys(f[1])))
+            for fraction, (_, name) in enumerate(files, start=1):
+                file_rows.append((fraction_group, fraction, name, label, sample))
+    return file_rows, sample_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("spectra", help="Folder with mzMLs or file with the names of the spectra files (one per line)")
+    parser.add_argument("labels", nargs="?", type=int, default=1, help="Number of labels per file (default: 1)")
+    parser.add_argument("-o", "--out", help="Output file (default: stdout)")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.spectra):
+        names = glob.glob(os.path.join(args.spectra, "*.mzML"))
+    else:
+        with open(args.spectra) as f:
+            names = [line.strip() for line in f if line.strip()]
+    names.sort(key=natural_keys)
+
+    file_rows, sample_rows = infer_design(names, args.labels)
+    lines = ["Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample"]
+    lines.extend("\t".join(str(v) for v in row) for row in file_rows)
+    lines.append("")
+    lines.append("Sample\tMSstats_Condition\tMSstats_BioReplicate")
+    lines.extend("\t".join(str(v) for v in row) for row in sample_rows)
+    out = open(args.out, "w") if args.out else sys.stdout
+    out.write("\n".join(lines) + "\n")
+    if args.out:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
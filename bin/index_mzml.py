@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Write an indexed mzML (indexedmzML) from a non-indexed or badly indexed mzML.
+
+The input is streamed once through an incremental XML parser that only reports the
+byte offsets of the <spectrum> and <chromatogram> start tags. The bytes of the <mzML>
+element are copied unchanged to the output, so binary data arrays are neither decoded
+nor re-encoded and memory usage does not depend on the size of the file. An existing
+<indexedmzML> wrapper (e.g. with a truncated index) is replaced.
+"""
+
+import argparse
+import hashlib
+import sys
+import xml.parsers.expat
+from xml.sax.saxutils import escape
+
+INDEXED_MZML_START = (b"<indexedmzML xmlns=\"http://psi.hupo.org/ms/mzml\" "
+                      b"xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" "
+                      b"xsi:schemaLocation=\"http://psi.hupo.org/ms/mzml "
+                      b"http://psidev.info/files/ms/mzML/xsd/mzML1.1.2_idx.xsd\">\n")
+
+
+class HashingWriter(object):
+    """File writer that keeps track of the position and the SHA-1 of everything written."""
+
+    def __init__(self, path):
+        self.f = open(path, "wb")
+        self.sha1 = hashlib.sha1()
+        self.pos = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha1.update(data)
+        self.pos += len(data)
+
+    def close(self):
+        self.f.close()
+
+
+def write_index(out, spectrum_offsets, chromatogram_offsets=()):
+    """Append the indexList, indexListOffset and fileChecksum of an indexedmzML and close it.
+
+    Offsets are (native id, byte offset) pairs with the id already escaped for an attribute.
+    """
+    indices = [(b"spectrum", spectrum_offsets)]
+    if chromatogram_offsets:
+        indices.append((b"chromatogram", chromatogram_offsets))
+    out.write(b"  ")
+    # the indexListOffset points to the start of the indexList element
+    index_list_offset = out.pos
+    out.write(b"<indexList count=\"%d\">\n" % len(indices))
+    for name, offsets in indices:
+        out.write(b"    <index name=\"%s\">\n" % name)
+        for native_id, offset in offsets:
+            out.write(b"      <offset idRef=\"%s\">%d</offset>\n" % (native_id, offset))
+        out.write(b"    </index>\n")
+    out.write(b"  </indexList>\n")
+    out.write(b"  <indexListOffset>%d</indexListOffset>\n" % index_list_offset)
+    out.write(b"  <fileChecksum>")
+    out.f.write(out.sha1.hexdigest().encode() + b"</fileChecksum>\n</indexedmzML>\n")
+    out.close()
+
+
+class OffsetCollector(object):
+    """Expat handlers recording the input byte offsets of the mzML element and of all spectra/chromatograms."""
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.encoding = "UTF-8"
+        self.mzml_start = None
+        self.mzml_end = None
+        self.spectra = []
+        self.chromatograms = []
+        parser.XmlDeclHandler = self.xml_decl
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+
+    def xml_decl(self, version, encoding, standalone):
+        if encoding:
+            self.encoding = encoding
+
+    def start(self, name, attrs):
+        if name == "spectrum":
+            self.spectra.append((attrs.get("id", ""), self.parser.CurrentByteIndex))
+        elif name == "chromatogram":
+            self.chromatograms.append((attrs.get("id", ""), self.parser.CurrentByteIndex))
+        elif name == "mzML":
+            self.mzml_start = self.parser.CurrentByteIndex
+
+    def end(self, name):
+        if name == "mzML":
+            self.mzml_end = self.parser.CurrentByteIndex + len("</mzML>")
+
+
+def index(mzml, out_path, block_size=1 << 22):
+    parser = xml.parsers.expat.ParserCreate()
+    collector = OffsetCollector(parser)
+    out = None
+    # input offset of the first byte not yet written (or skipped)
+    written = 0
+    pending = b""
+
+    with open(mzml, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            parser.Parse(block, not block)
+            if collector.mzml_start is None:
+                # keep the (short) header until the start of the mzML element is known
+                pending += block
+                if not block:
+                    break
+                continue
+            if out is None:
+                out = HashingWriter(out_path)
+                out.write(b"<?xml version=\"1.0\" encoding=\"%s\"?>\n" % collector.encoding.encode())
+                out.write(INDEXED_MZML_START)
+                # output offset of an element = input offset + shift
+                shift = out.pos - collector.mzml_start
+                block = pending + block
+                pending = b""
+                written = collector.mzml_start
+                block = block[collector.mzml_start:]
+            if collector.mzml_end is not None:
+                block = block[:collector.mzml_end - written]
+            out.write(block)
+            written += len(block)
+            if collector.mzml_end is not None or not block:
+                break
+
+    if out is None or collector.mzml_end is None:
+        raise ValueError("No complete <mzML> element found.")
+    out.write(b"\n")
+
+    def shifted(offsets):
+        return [(escape(native_id, {"\"": "&quot;"}).encode(collector.encoding), offset + shift) for native_id, offset in offsets]
+
+    write_index(out, shifted(collector.spectra), shifted(collector.chromatograms))
+    print("Indexed {} spectra and {} chromatograms of {}".format(len(collector.spectra), len(collector.chromatograms), mzml))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mzml", help="mzML to index")
+    parser.add_argument("out", help="Output indexed mzML")
+    args = parser.parse_args()
+
+    try:
+        index(args.mzml, args.out)
+    except (ValueError, xml.parsers.expat.ExpatError) as e:
+        sys.exit("Error indexing {}: {}".format(args.mzml, e))
+
+
+if __name__ == "__main__":
+    main()
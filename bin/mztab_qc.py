@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Compute core quality control metrics per run from the mzTab of ProteomicsLFQ.
+
+The mzTab is streamed once line by line, only the PSM section is evaluated. Decoy PSMs are
+skipped and PSMs reported for several proteins (one row per protein) are counted once.
+Per run (ms_run of the mzTab) the following metrics are computed:
+
+  - number of PSMs, unique peptide sequences and, with --run_statistics, the ID rate
+    (identified spectra / MS2 spectra of the mzML)
+  - precursor mass error in ppm (median, interquartile range)
+  - retention time distribution of the PSMs (quantiles and a histogram)
+  - missed cleavages (for the common enzymes) and charge states
+  - fraction of PSMs of contaminant proteins (matching --contaminant_regex)
+
+The metrics are written to <prefix>.json, a one-row-per-run <prefix>.tsv and a small
+self-contained HTML page <prefix>.html.
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import sys
+from array import array
+
+MS_RUN_LOCATION_REGEX = re.compile(r"^ms_run\[(\d+)\]-location$")
+SPECTRA_REF_RUN_REGEX = re.compile(r"ms_run\[(\d+)\]")
+DECOY_COLUMN = "opt_global_cv_MS:1002217_decoy_peptide"
+# cleavage sites of the common enzymes (OpenMS names), matched on the unmodified sequence
+CLEAVAGE_RULES = {
+    "Trypsin": r"[KR](?!P)",
+    "Trypsin/P": r"[KR]",
+    "Lys-C": r"K(?!P)",
+    "Lys-C/P": r"K",
+    "Arg-C": r"R(?!P)",
+    "Arg-C/P": r"R",
+    "Chymotrypsin": r"[FYWL](?!P)",
+    "Chymotrypsin/P": r"[FYWL]",
+    "glutamyl endopeptidase": r"E(?!P)",
+    "Asp-N": r"(?=D)",
+}
+MAX_MISSED_CLEAVAGES = 3
+MAX_CHARGE = 5
+RT_BINS = 30
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+TSV_COLUMNS = ["run", "psms", "unique_peptides", "ms2_spectra", "id_rate", "mass_error_ppm_median",
+               "mass_error_ppm_iqr", "rt_min", "rt_median", "rt_max", "missed_cleavages_0",
+               "contaminant_psm_fraction"]
+
+
+def quantile(values, q):
+    """Quantile of sorted values (linear interpolation)."""
+    if not values:
+        return None
+    pos = (len(values) - 1) * q
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def to_float(value):
+    # lists of values (e.g. several retention times) are separated by "|", the first one is used
+    value = value.split("|", 1)[0]
+    if value in ("", "null", "NaN"):
+        return None
+    return float(value)
+
+
+def count_missed_cleavages(regex, sequence):
+    return sum(1 for m in regex.finditer(sequence) if 0 < m.end() < len(sequence))
+
+
+class RunMetrics(object):
+    """Accumulates the PSMs of one run."""
+
+    def __init__(self, name):
+        self.name = name
+        self.psms = 0
+        self.contaminant_psms = 0
+        self.ms2_spectra = None
+        self.peptides = set()
+        self.mass_errors = array("d")
+        self.retention_times = array("d")
+        self.missed_cleavages = [0] * (MAX_MISSED_CLEAVAGES + 1)
+        self.charges = [0] * (MAX_CHARGE + 1)
+
+    def add(self, sequence, mass_error, retention_time, missed_cleavages, charge, contaminant):
+        self.psms += 1
+        self.peptides.add(sequence)
+        if mass_error is not None:
+            self.mass_errors.append(mass_error)
+        if retention_time is not None:
+            self.retention_times.append(retention_time)
+        if missed_cleavages is not None:
+            self.missed_cleavages[min(missed_cleavages, MAX_MISSED_CLEAVAGES)] += 1
+        if charge is not None:
+            self.charges[min(max(charge, 1), MAX_CHARGE)] += 1
+        if contaminant:
+            self.contaminant_psms += 1
+
+    def summary(self, rt_range, with_missed_cleavages):
+        mass_errors = sorted(self.mass_errors)
+        retention_times = sorted(self.retention_times)
+        histogram = [0] * RT_BINS
+        if rt_range and rt_range[1] > rt_range[0]:
+            width = (rt_range[1] - rt_range[0]) / RT_BINS
+            for rt in retention_times:
+                histogram[min(int((rt - rt_range[0]) / width), RT_BINS - 1)] += 1
+        psms = max(self.psms, 1)
+        return {
+            "run": self.name,
+            "psms": self.psms,
+            "unique_peptides": len(self.peptides),
+            "ms2_spectra": self.ms2_spectra,
+            "id_rate": self.psms / self.ms2_spectra if self.ms2_spectra else None,
+            "mass_error_ppm": {str(q): quantile(mass_errors, q) for q in QUANTILES},
+            "retention_time": {str(q): quantile(retention_times, q) for q in QUANTILES},
+            "retention_time_range": [retention_times[0], retention_times[-1]] if retention_times else None,
+            "retention_time_histogram": histogram,
+            "missed_cleavages": {("{}+".format(i) if i == MAX_MISSED_CLEAVAGES else str(i)): n / psms
+                                 for i, n in enumerate(self.missed_cleavages)} if with_missed_cleavages else None,
+            "charges": {("{}+".format(i) if i == MAX_CHARGE else str(i)): n / psms
+                        for i, n in enumerate(self.charges) if i > 0},
+            "contaminant_psm_fraction": self.contaminant_psms / psms,
+        }
+
+
+def read_psms(mztab, cleavage_regex, contaminant_regex):
+    """Stream the PSM section of the mzTab and return the metrics per ms_run."""
+    locations = {}
+    runs = {}
+    columns = None
+
+    def add_psm(fields, contaminant):
+        if decoy_column is not None and fields[decoy_column] == "1":
+            return
+        spectra_ref = SPECTRA_REF_RUN_REGEX.match(fields[columns["spectra_ref"]])
+        index = int(spectra_ref.group(1)) if spectra_ref else 0
+        run = runs.get(index)
+        if run is None:
+            run = runs[index] = RunMetrics(index)
+        sequence = fields[columns["sequence"]]
+        exp_mz = to_float(fields[columns["exp_mass_to_charge"]])
+        calc_mz = to_float(fields[columns["calc_mass_to_charge"]])
+        charge = to_float(fields[columns["charge"]])
+        run.add(sequence,
+                (exp_mz - calc_mz) / calc_mz * 1e6 if exp_mz is not None and calc_mz else None,
+                to_float(fields[columns["retention_time"]]),
+                count_missed_cleavages(cleavage_regex, sequence) if cleavage_regex else None,
+                int(charge) if charge is not None else None,
+                contaminant)
+
+    # a PSM is reported in consecutive rows, one per protein
+    psm = None
+    contaminant = False
+    with open(mztab) as f:
+        for line in f:
+            prefix = line[:3]
+            if prefix == "PSM" and columns:
+                fields = line.rstrip("\r\n").split("\t")
+                if psm is None or fields[psm_id_column] != psm[psm_id_column]:
+                    if psm is not None:
+                        add_psm(psm, contaminant)
+                    psm = fields
+                    contaminant = False
+                contaminant = contaminant or bool(contaminant_regex.search(fields[accession_column]))
+            elif prefix == "MTD":
+                fields = line.rstrip("\r\n").split("\t")
+                match = MS_RUN_LOCATION_REGEX.match(fields[1])
+                if match:
+                    locations[int(match.group(1))] = fields[2]
+            elif prefix == "PSH":
+                header = line.rstrip("\r\n").split("\t")
+                columns = {name: i for i, name in enumerate(header)}
+                decoy_column = columns.get(DECOY_COLUMN)
+                psm_id_column = columns["PSM_ID"]
+                accession_column = columns["accession"]
+    if psm is not None:
+        add_psm(psm, contaminant)
+
+    for index, run in runs.items():
+        run.name = os.path.basename(locations.get(index, "ms_run[{}]".format(index)))
+    return [runs[index] for index in sorted(runs)]
+
+
+def read_ms2_spectra_counts(run_statistics):
+    """Number of MS2 spectra per mzML name from pipeline_info/run_statistics.tsv."""
+    counts = {}
+    with open(run_statistics) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        for line in f:
+            row = dict(zip(header, line.rstrip("\n").split("\t")))
+            if row.get("mzml") and row.get("ms2_spectra", "NA").isdigit():
+                counts[row["mzml"]] = int(row["ms2_spectra"])
+    return counts
+
+
+def format_value(value, digits=3):
+    if value is None:
+        return "NA"
+    if isinstance(value, float):
+        return "{:.{}g}".format(value, digits)
+    return str(value)
+
+
+def tsv_row(summary):
+    return [
+        summary["run"], summary["psms"], summary["unique_peptides"], summary["ms2_spectra"], summary["id_rate"],
+        summary["mass_error_ppm"]["0.5"],
+        summary["mass_error_ppm"]["0.75"] - summary["mass_error_ppm"]["0.25"]
+        if summary["mass_error_ppm"]["0.5"] is not None else None,
+        summary["retention_time_range"][0] if summary["retention_time_range"] else None,
+        summary["retention_time"]["0.5"],
+        summary["retention_time_range"][1] if summary["retention_time_range"] else None,
+        summary["missed_cleavages"]["0"] if summary["missed_cleavages"] else None,
+        summary["contaminant_psm_fraction"],
+    ]
+
+
+def histogram_svg(counts, width=240, height=30):
+    top = max(counts) or 1
+    bar = width / len(counts)
+    rects = "".join('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}"/>'.format(
+        i * bar, height - height * c / top, bar * 0.9, height * c / top) for i, c in enumerate(counts))
+    return '<svg width="{}" height="{}" fill="#3b73b9">{}</svg>'.format(width, height, rects)
+
+
+def write_html(path, summaries, rt_range):
+    rows = []
+    for s in summaries:
+        distribution = s["missed_cleavages"] or {}
+        rows.append("<tr>" + "".join("<td>{}</td>".format(v) for v in [
+            html.escape(s["run"]),
+            s["psms"],
+            s["unique_peptides"],
+            format_value(s["id_rate"]),
+            format_value(s["mass_error_ppm"]["0.5"]),
+            format_value(s["mass_error_ppm"]["0.25"]) + " / " + format_value(s["mass_error_ppm"]["0.75"]),
+            histogram_svg(s["retention_time_histogram"]),
+            " / ".join("{}: {}".format(k, format_value(v, 2)) for k, v in distribution.items()) or "NA",
+            " / ".join("{}: {}".format(k, format_value(v, 2)) for k, v in s["charges"].items()),
+            format_value(s["contaminant_psm_fraction"]),
+        ]) + "</tr>")
+    with open(path, "w") as f:
+        f.write("""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>QC metrics</title>
+<style>body{{font-family:sans-serif}} table{{border-collapse:collapse}} td,th{{border:1px solid #ccc;padding:4px 8px;text-align:right}}</style>
+</head><body>
+<h1>QC metrics</h1>
+<p>{} runs. Retention time histograms span {} to {} s.</p>
+<table>
+<tr><th>Run</th><th>PSMs</th><th>Peptides</th><th>ID rate</th><th>Mass error median (ppm)</th>
+<th>Mass error Q1 / Q3 (ppm)</th><th>Retention times</th><th>Missed cleavages</th><th>Charges</th>
+<th>Contaminant PSMs</th></tr>
+{}
+</table>
+</body></html>
+""".format(len(summaries), format_value(rt_range[0] if rt_range else None),
+           format_value(rt_range[1] if rt_range else None), "\n".join(rows)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mztab", required=True, help="mzTab from ProteomicsLFQ")
+    parser.add_argument("--run_statistics", help="run_statistics.tsv with the number of MS2 spectra per mzML")
+    parser.add_argument("--enzyme", default="Trypsin", help="Enzyme for the missed cleavages (skipped for unknown enzymes)")
+    parser.add_argument("--contaminant_regex", default="CONTAMINANT|^CON_",
+                        help="Regular expression matching the accessions of contaminants")
+    parser.add_argument("--out_prefix", default="qc_metrics", help="Prefix of the output files")
+    args = parser.parse_args()
+
+    cleavage_regex = re.compile(CLEAVAGE_RULES[args.enzyme]) if args.enzyme in CLEAVAGE_RULES else None
+    if cleavage_regex is None:
+        print("No cleavage rule for enzyme '{}', missed cleavages are not reported".format(args.enzyme))
+    try:
+        runs = read_psms(args.mztab, cleavage_regex, re.compile(args.contaminant_regex))
+    except KeyError as e:
+        sys.exit("Error: column {} not found in the PSM section of {}".format(e, args.mztab))
+    if args.run_statistics:
+        ms2_spectra = read_ms2_spectra_counts(args.run_statistics)
+        for run in runs:
+            run.ms2_spectra = ms2_spectra.get(run.name)
+
+    retention_times = [rt for run in runs for rt in (min(run.retention_times, default=None),
+                                                      max(run.retention_times, default=None)) if rt is not None]
+    rt_range = [min(retention_times), max(retention_times)] if retention_times else None
+    summaries = [run.summary(rt_range, cleavage_regex is not None) for run in runs]
+
+    with open(args.out_prefix + ".json", "w") as f:
+        json.dump({"enzyme": args.enzyme, "retention_time_range": rt_range, "runs": summaries}, f, indent=1)
+    with open(args.out_prefix + ".tsv", "w") as f:
+        f.write("\t".join(TSV_COLUMNS) + "\n")
+        for s in summaries:
+            f.write("\t".join(format_value(v, 6) for v in tsv_row(s)) + "\n")
+    write_html(args.out_prefix + ".html", summaries, rt_range)
+    print("Computed QC metrics of {} PSMs in {} runs".format(sum(run.psms for run in runs), len(runs)))
+
+
+if __name__ == "__main__":
+    main()
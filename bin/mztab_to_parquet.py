@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Convert the results of ProteomicsLFQ (mzTab and MSstats csv) to Parquet.
+
+The mzTab is read once line by line. Its metadata and the PRT, PEP and PSM sections are
+written to metadata.parquet, proteins.parquet, peptides.parquet and psms.parquet in
+batches of rows. The MSstats csv is streamed into a dataset partitioned by run
+(msstats/Run=<run>/). Accessions, sequences and other highly repetitive columns are
+dictionary encoded.
+"""
+
+import argparse
+import os
+import re
+
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
+
+SECTIONS = {
+    "MTD": "metadata",
+    "PRT": "proteins",
+    "PEP": "peptides",
+    "PSM": "psms",
+}
+HEADERS = {"PRH": "PRT", "PEH": "PEP", "PSH": "PSM"}
+
+DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+FLOAT_COLUMN_REGEX = re.compile(r"(abundance|search_engine_score\[\d+\]|mass_to_charge)")
+DICTIONARY_COLUMN_REGEX = re.compile(r"^(accession|sequence|database|database_version|search_engine|modifications|"
+                                     r"opt_global_result_type|key)$")
+MSSTATS_DICTIONARY_COLUMNS = ["ProteinName", "PeptideSequence", "FragmentIon", "IsotopeLabelType",
+                              "Condition", "BioReplicate"]
+MSSTATS_COLUMN_TYPES = {"PrecursorCharge": pa.int32(), "ProductCharge": pa.int32(), "Fraction": pa.int32(),
+                        "Intensity": pa.float64()}
+
+
+def column_type(name):
+    """Arrow type of an mzTab column, derived from its name (columns with lists of values stay strings)."""
+    if name == "charge":
+        return pa.int32()
+    if FLOAT_COLUMN_REGEX.search(name):
+        return pa.float64()
+    if DICTIONARY_COLUMN_REGEX.match(name):
+        return DICTIONARY
+    return pa.string()
+
+
+class SectionWriter(object):
+    """Collects the rows of one mzTab section and writes them as row groups to a Parquet file."""
+
+    def __init__(self, path, columns, batch_size):
+        self.path = path
+        self.columns = columns
+        self.schema = pa.schema([(c, column_type(c)) for c in columns])
+        self.batch_size = batch_size
+        self.rows = []
+        self.writer = None
+
+    def add(self, values):
+        if len(values) != len(self.columns):
+            raise ValueError("Expected {} columns but found {} in {} row: {}".format(
+                len(self.columns), len(values), self.path, "\t".join(values)[:200]))
+        self.rows.append(values)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        arrays = []
+        for i, field in enumerate(self.schema):
+            values = [None if row[i] in ("null", "") else row[i] for row in self.rows]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            elif pa.types.is_string(field.type):
+                arrays.append(pa.array(values, pa.string()))
+            elif pa.types.is_integer(field.type):
+                arrays.append(pa.array([None if v is None else int(v) for v in values], field.type))
+            else:
+                arrays.append(pa.array([None if v is None else float(v) for v in values], field.type))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        if self.rows or self.writer is None:
+            self.flush()
+        self.writer.close()
+
+
+def convert_mztab(mztab, out_dir, batch_size):
+    writers = {"MTD": SectionWriter(os.path.join(out_dir, "metadata.parquet"), ["key", "value"], batch_size)}
+    with open(mztab) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            fields = line.split("\t")
+            prefix = fields[0]
+            if prefix in HEADERS:
+                section = HEADERS[prefix]
+                writers[section] = SectionWriter(os.path.join(out_dir, SECTIONS[section] + ".parquet"),
+                                                 fields[1:], batch_size)
+            elif prefix == "MTD":
+                writers["MTD"].add(fields[1:3] + [None] * (3 - len(fields)))
+            elif prefix in writers:
+                writers[prefix].add(fields[1:])
+    for writer in writers.values():
+        writer.close()
+
+
+def convert_msstats(csv, out_dir):
+    # the types of all columns are fixed, as a column that is empty in the first block would be inferred as null
+    # and fail on the next one. Columns other than the numeric ones of MSSTATS_COLUMN_TYPES are read as strings.
+    with open(csv) as f:
+        header = [c.strip('"') for c in f.readline().rstrip("\r\n").split(",")]
+    column_types = {c: MSSTATS_COLUMN_TYPES.get(c, pa.string()) for c in header}
+    reader = pyarrow.csv.open_csv(csv, convert_options=pyarrow.csv.ConvertOptions(
+        column_types=column_types, null_values=["NA", "null", ""], strings_can_be_null=True))
+    names = [field.name for field in reader.schema if field.name != "Run"]
+    writers = {}
+    try:
+        while True:
+            try:
+                batch = reader.read_next_batch()
+            except StopIteration:
+                break
+            columns = {name: column for name, column in zip(batch.schema.names, batch.columns)}
+            arrays = [columns[name].dictionary_encode() if name in MSSTATS_DICTIONARY_COLUMNS else columns[name]
+                      for name in names]
+            # one Parquet file per run (Hive partitioning, msstats/Run=<run>/), the run column itself is not stored
+            rows = {}
+            for i, run in enumerate(columns["Run"].to_pylist()):
+                rows.setdefault(run, []).append(i)
+            for run, indices in rows.items():
+                indices = pa.array(indices, pa.int32())
+                table = pa.Table.from_arrays([array.take(indices) for array in arrays], names=names)
+                if run not in writers:
+                    run_dir = os.path.join(out_dir, "msstats", "Run=" + (run if run is not None else "__HIVE_DEFAULT_PARTITION__"))
+                    os.makedirs(run_dir, exist_ok=True)
+                    writers[run] = pq.ParquetWriter(os.path.join(run_dir, "part-0.parquet"), table.schema)
+                writers[run].write_table(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir", help="Output folder")
+    parser.add_argument("--mztab", required=True, help="mzTab from ProteomicsLFQ")
+    parser.add_argument("--csv", help="MSstats csv from ProteomicsLFQ")
+    parser.add_argument("--batch_size", type=int, default=100000, help="Number of rows per row group")
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    convert_mztab(args.mztab, args.out_dir, args.batch_size)
+    if args.csv:
+        convert_msstats(args.csv, args.out_dir)
+
+
+if __name__ == "__main__":
+    main()
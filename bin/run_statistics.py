@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Record the size of the input data of a run as a one-row TSV (with header).
+
+The number of spectra is taken from the count attribute of the spectrumList in the mzML
+header and the number of PSMs (i.e. PeptideIdentifications) is counted while streaming the
+idXML, so even very large files are processed quickly and with constant memory. With --count_ms2,
+the MS2 spectra (ms level cvParams with value 2) are counted while streaming the whole mzML.
+"""
+
+import argparse
+import os
+import re
+
+SPECTRUM_LIST_COUNT_REGEX = re.compile(rb"<spectrumList[^>]*\scount=\"(\d+)\"")
+PEPTIDE_ID_TAG = b"<PeptideIdentification"
+MS2_LEVEL_REGEX = re.compile(rb"<cvParam[^>]*accession=\"MS:1000511\"[^>]*value=\"2\"[^>]*/>")
+COLUMNS = ["run", "spectra", "ms2_spectra", "psms", "mzml_bytes", "id_bytes", "mzml"]
+
+
+def count_spectra(mzml, block_size=1 << 16, max_header_bytes=1 << 24):
+    """Read the number of spectra from the spectrumList element of the mzML header."""
+    data = b""
+    with open(mzml, "rb") as f:
+        while len(data) < max_header_bytes:
+            block = f.read(block_size)
+            if not block:
+                break
+            data += block
+            match = SPECTRUM_LIST_COUNT_REGEX.search(data)
+            if match:
+                return int(match.group(1))
+    return "NA"
+
+
+def count_ms2_spectra(mzml, block_size=1 << 20, max_tag_bytes=512):
+    """Count the spectra with ms level 2 of an mzML."""
+    count = 0
+    tail = b""
+    with open(mzml, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = tail + block
+            last_end = 0
+            for match in MS2_LEVEL_REGEX.finditer(data):
+                count += 1
+                last_end = match.end()
+            # a tag split between two blocks is completed by the next one, counted tags are not kept
+            tail = data[max(last_end, len(data) - max_tag_bytes):]
+    return count
+
+
+def count_psms(idxml, block_size=1 << 20):
+    """Count the PeptideIdentification elements of an idXML."""
+    count = 0
+    tail = b""
+    with open(idxml, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            data = tail + block
+            count += data.count(PEPTIDE_ID_TAG)
+            # a tag split between two blocks is completed by the next one
+            tail = data[-(len(PEPTIDE_ID_TAG) - 1):]
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--name", required=True, help="Name/ID of the run")
+    parser.add_argument("--mzml", help="mzML of the run")
+    parser.add_argument("--ids", help="idXML of the run")
+    parser.add_argument("--count_ms2", action="store_true", help="Also count the MS2 spectra (reads the whole mzML)")
+    args = parser.parse_args()
+
+    row = [
+        args.name,
+        count_spectra(args.mzml) if args.mzml else "NA",
+        count_ms2_spectra(args.mzml) if args.mzml and args.count_ms2 else "NA",
+        count_psms(args.ids) if args.ids else "NA",
+        os.path.getsize(args.mzml) if args.mzml else "NA",
+        os.path.getsize(args.ids) if args.ids else "NA",
+        os.path.basename(args.mzml) if args.mzml else "NA",
+    ]
+    print("\t".join(COLUMNS))
+    print("\t".join(str(v) for v in row))
+
+
+if __name__ == "__main__":
+    main()
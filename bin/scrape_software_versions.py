@@ -1,84 +1,159 @@
 #!/usr/bin/env python
+"""
+Collect the versions of the software used by the pipeline.
+
+probe: Resolve the versions of the tools and write them to a TSV (tool, version). They are
+  read from the package metadata of the conda environment the script runs in (written when
+  the environment/container image was built), only tools not found there are started to
+  scrape the version from their output.
+
+report: Write the MultiQC section (stdout) and software_versions.csv from the tool versions
+  of probe and the pipeline, Nextflow and MSstats versions in v_*.txt.
+"""
 from __future__ import print_function
 from collections import OrderedDict
+import argparse
+import glob
+import json
+import os
 import re
+import subprocess
+import sys
 
 openms_version_regex = r"([0-9][.][0-9][.][0-9])"
 
 regexes = {
     'nf-core/proteomicslfq': ['v_pipeline.txt', r"(\S+)"],
     'Nextflow': ['v_nextflow.txt', r"(\S+)"],
-    'ThermorawfileParser': ['v_thermorawfileparser.txt', r"(\S+)"],
-    'FileConverter': ['v_fileconverter.txt', openms_version_regex],
-    'DecoyDatabase': ['v_decoydatabase.txt', openms_version_regex],
-    'MSGFPlusAdapter': ['v_msgfplusadapter.txt', openms_version_regex],
-    'MSGFPlus': ['v_msgfplus.txt', r"\(([^v)]+)\)"],
-    'CometAdapter': ['v_cometadapter.txt', openms_version_regex],
-    'Comet': ['v_comet.txt', r"\"(.*)\""],
-    'PeptideIndexer': ['v_peptideindexer.txt', openms_version_regex],
-    'PSMFeatureExtractor': ['v_psmfeatureextractor.txt', openms_version_regex],
-    'PercolatorAdapter': ['v_percolatoradapter.txt', openms_version_regex],
-    'Percolator': ['v_percolator.txt', r"([0-9].[0-9]{2}.[0-9])"],
-    'IDFilter': ['v_idfilter.txt', openms_version_regex],
-    'IDScoreSwitcher': ['v_idscoreswitcher.txt', openms_version_regex],
-    'FalseDiscoveryRate': ['v_falsediscoveryrate.txt', openms_version_regex],
-    'IDPosteriorErrorProbability': ['v_idposteriorerrorprobability.txt', openms_version_regex],
-    'ProteomicsLFQ': ['v_proteomicslfq.txt', openms_version_regex],
     'MSstats': ['v_msstats_plfq.txt', r"(\S+)"]
 }
-results = OrderedDict()
-results['nf-core/proteomicslfq'] = '<span style="color:#999999;\">N/A</span>'
-results['Nextflow'] = '<span style="color:#999999;\">N/A</span>'
-results['ThermorawfileParser'] = '<span style="color:#999999;\">N/A</span>'
-results['FileConverter'] = '<span style="color:#999999;\">N/A</span>'
-results['DecoyDatabase'] = '<span style="color:#999999;\">N/A</span>'
-results['MSGFPlusAdapter'] = '<span style="color:#999999;\">N/A</span>'
-results['MSGFPlus'] = '<span style="color:#999999;\">N/A</span>'
-results['CometAdapter'] = '<span style="color:#999999;\">N/A</span>'
-results['Comet'] = '<span style="color:#999999;\">N/A</span>'
-results['PeptideIndexer'] = '<span style="color:#999999;\">N/A</span>'
-results['PSMFeatureExtractor'] = '<span style="color:#999999;\">N/A</span>'
-results['PercolatorAdapter'] = '<span style="color:#999999;\">N/A</span>'
-results['Percolator'] = '<span style="color:#999999;\">N/A</span>'
-results['IDFilter'] = '<span style="color:#999999;\">N/A</span>'
-results['IDScoreSwitcher'] = '<span style="color:#999999;\">N/A</span>'
-results['FalseDiscoveryRate'] = '<span style="color:#999999;\">N/A</span>'
-results['IDPosteriorErrorProbability'] = '<span style="color:#999999;\">N/A</span>'
-results['ProteomicsLFQ'] = '<span style="color:#999999;\">N/A</span>'
-
-# Search each file using its regex
-for k, v in regexes.items():
+
+# tool: conda package, command to probe the version if the package is not found, regex for its output
+tools = OrderedDict([
+    ('ThermorawfileParser', ['thermorawfileparser', "ThermoRawFileParser.sh --version", r"(\S+)"]),
+    ('FileConverter', ['openms', "FileConverter", openms_version_regex]),
+    ('DecoyDatabase', ['openms', "DecoyDatabase", openms_version_regex]),
+    ('MSGFPlusAdapter', ['openms', "MSGFPlusAdapter", openms_version_regex]),
+    ('MSGFPlus', ['msgf_plus', "msgf_plus", r"\(([^v)]+)\)"]),
+    ('CometAdapter', ['openms', "CometAdapter", openms_version_regex]),
+    ('Comet', ['comet-ms', "comet", r"\"(.*)\""]),
+    ('PeptideIndexer', ['openms', "PeptideIndexer", openms_version_regex]),
+    ('PSMFeatureExtractor', ['openms', "PSMFeatureExtractor", openms_version_regex]),
+    ('PercolatorAdapter', ['openms', "PercolatorAdapter", openms_version_regex]),
+    ('Percolator', ['percolator', "percolator -h", r"([0-9].[0-9]{2}.[0-9])"]),
+    ('IDFilter', ['openms', "IDFilter", openms_version_regex]),
+    ('IDScoreSwitcher', ['openms', "IDScoreSwitcher", openms_version_regex]),
+    ('FalseDiscoveryRate', ['openms', "FalseDiscoveryRate", openms_version_regex]),
+    ('IDPosteriorErrorProbability', ['openms', "IDPosteriorErrorProbability", openms_version_regex]),
+    ('ProteomicsLFQ', ['openms', "ProteomicsLFQ", openms_version_regex]),
+])
+
+
+def conda_package_versions(prefix):
+    """Versions of the packages installed in the conda environment at prefix (empty if it is none)."""
+    versions = {}
+    for meta in glob.glob(os.path.join(prefix, "conda-meta", "*.json")):
+        try:
+            with open(meta) as f:
+                package = json.load(f)
+            versions[package["name"]] = package["version"]
+        except (IOError, ValueError, KeyError):
+            continue
+    return versions
+
+
+def probe_version(command, regex):
     try:
-        with open(v[0]) as x:
-            versions = x.read()
-            match = re.search(v[1], versions)
-            if match:
-                results[k] = "v{}".format(match.group(1))
-    except IOError:
-        results[k] = False
-
-# Remove software set to false in results
-for k in list(results):
-    if not results[k]:
-        del results[k]
-
-# Dump to YAML
-print(
-    """
+        process = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=300)
+    except subprocess.TimeoutExpired:
+        return None
+    # most tools print their version with their usage and exit with an error, only missing ones are skipped
+    if process.returncode == 127:
+        return None
+    match = re.search(regex, process.stdout.decode(errors="replace"))
+    return match.group(1) if match else None
+
+
+def probe(out):
+    packages = conda_package_versions(os.environ.get("CONDA_PREFIX", sys.prefix))
+    with open(out, "w") as f:
+        for tool, (package, command, regex) in tools.items():
+            version = packages.get(package)
+            if version is None:
+                print("{} not found in the conda environment, running '{}'".format(tool, command), file=sys.stderr)
+                version = probe_version(command, regex)
+            if version is not None:
+                f.write("{}\t{}\n".format(tool, version))
+
+
+def report(tool_versions):
+    results = OrderedDict()
+    results['nf-core/proteomicslfq'] = '<span style="color:#999999;\">N/A</span>'
+    results['Nextflow'] = '<span style="color:#999999;\">N/A</span>'
+    for tool in tools:
+        results[tool] = '<span style="color:#999999;\">N/A</span>'
+
+    # Search each file using its regex
+    for k, v in regexes.items():
+        try:
+            with open(v[0]) as x:
+                versions = x.read()
+                match = re.search(v[1], versions)
+                if match:
+                    results[k] = "v{}".format(match.group(1))
+        except IOError:
+            results[k] = False
+
+    if tool_versions:
+        with open(tool_versions) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2 and fields[0] in results:
+                    results[fields[0]] = "v{}".format(fields[1])
+
+    # Remove software set to false in results
+    for k in list(results):
+        if not results[k]:
+            del results[k]
+
+    # Dump to YAML
+    print(
+        """
 id: 'software_versions'
 section_name: 'nf-core/proteomicslfq Software Versions'
 section_href: 'https://github.com/nf-core/proteomicslfq'
 plot_type: 'html'
-description: 'are collected at run time from the software output.'
+description: 'are taken from the package metadata of the software environment or collected from the software output.'
 data: |
     <dl class="dl-horizontal">
     """
-)
-for k, v in results.items():
-    print("        <dt>{}</dt><dd><samp>{}</samp></dd>".format(k, v))
-print("    </dl>")
-
-# Write out regexes as csv file:
-with open("software_versions.csv", "w") as f:
+    )
     for k, v in results.items():
-        f.write("{}\t{}\n".format(k, v))
+        print("        <dt>{}</dt><dd><samp>{}</samp></dd>".format(k, v))
+    print("    </dl>")
+
+    # Write out regexes as csv file:
+    with open("software_versions.csv", "w") as f:
+        for k, v in results.items():
+            f.write("{}\t{}\n".format(k, v))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    probe_parser = subparsers.add_parser("probe", help="Resolve the tool versions")
+    probe_parser.add_argument("out", help="Output TSV with the tool versions")
+    report_parser = subparsers.add_parser("report", help="Write the MultiQC section and software_versions.csv")
+    report_parser.add_argument("--tool_versions", help="TSV with the tool versions from probe")
+    args = parser.parse_args()
+
+    if args.command == "probe":
+        probe(args.out)
+    elif args.command == "report":
+        report(args.tool_versions)
+    else:
+        parser.error("Please specify a command (probe or report)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Convert an SDRF into the search settings (openms.tsv) and the experimental design
+(experimental_design.tsv, two-table format) of OpenMS.
+
+The output follows `parse_sdrf convert-openms -t2` of sdrf-pipelines, but the SDRF is read
+in one pass and the columns are resolved by their (case-insensitive) header names. The search
+settings are written once per data file, with the columns URI, Filename, FixedModifications,
+VariableModifications, Label, PrecursorMassTolerance, PrecursorMassToleranceUnit,
+FragmentMassTolerance, FragmentMassToleranceUnit, DissociationMethod and Enzyme.
+
+Modification names are taken from the Unimod database of sdrf-pipelines if it is installed,
+from the NT= key of the modification otherwise.
+"""
+
+import argparse
+import csv
+import re
+import sys
+from collections import OrderedDict
+
+NT_REGEX = re.compile(r"NT=(.+?)(;|$)")
+AC_REGEX = re.compile(r"AC=(.+?)(;|$)")
+PP_REGEX = re.compile(r"PP=(.+?)(;|$)")
+TA_REGEX = re.compile(r"TA=(.+?)(;|$)")
+RAW_EXTENSION_REGEX = re.compile(r"\.raw$", re.I)
+SETTINGS_COLUMNS = ["URI", "Filename", "FixedModifications", "VariableModifications", "Label",
+                    "PrecursorMassTolerance", "PrecursorMassToleranceUnit", "FragmentMassTolerance",
+                    "FragmentMassToleranceUnit", "DissociationMethod", "Enzyme"]
+# OpenMS names of enzymes that are not just capitalized
+ENZYMES = {name.lower(): name for name in [
+    "Trypsin/P", "Chymotrypsin/P", "Lys-C", "Lys-C/P", "Lys-N", "Arg-C", "Arg-C/P", "Asp-N", "Asp-N/B",
+    "Asp-N_ambic", "Glu-C+P", "PepsinA", "PepsinA + P", "V8-DE", "V8-E", "TrypChymo", "CNBr", "Formic_acid",
+    "Alpha-lytic protease", "Clostripain/P", "leukocyte elastase", "proline endopeptidase",
+    "glutamyl endopeptidase", "2-iodobenzoate", "iodosobenzoate", "staphylococcal protease/D",
+    "proline-endopeptidase/HKR", "cyanogen-bromide", "unspecific cleavage", "no cleavage"]}
+
+
+class Warnings(OrderedDict):
+
+    def add(self, message):
+        self[message] = self.get(message, 0) + 1
+
+
+def unimod_names():
+    """Unimod accession -> name, if sdrf-pipelines is installed."""
+    try:
+        from sdrf_pipelines.openms.unimod import UnimodDatabase
+    except ImportError:
+        return None
+    database = []
+    names = {}
+
+    def lookup(accession):
+        if accession not in names:
+            # the database is only parsed if there are modifications
+            if not database:
+                database.append(UnimodDatabase())
+            ptm = database[0].get_by_accession(accession)
+            names[accession] = ptm.get_name() if ptm is not None else None
+        return names[accession]
+    return lookup
+
+
+def openms_mods(sdrf_mods, unimod, warnings):
+    """OpenMS notation (e.g. 'Oxidation (M)') of SDRF modification parameters."""
+    oms_mods = []
+    for m in sdrf_mods:
+        if "AC=UNIMOD" not in m and "AC=Unimod" not in m:
+            raise ValueError("Only UNIMOD modifications are supported: " + m)
+        name = NT_REGEX.search(m).group(1).capitalize()
+        if unimod:
+            name = unimod(AC_REGEX.search(m).group(1)) or name
+
+        pp = PP_REGEX.search(m)
+        # one of Anywhere, Protein N-term, Protein C-term, Any N-term, Any C-term
+        pp = pp.group(1) if pp else "Anywhere"
+        ta = TA_REGEX.search(m)
+        if ta:
+            ta = ta.group(1)
+        else:
+            warnings.add("No TA= specified. Setting to N-term or C-term if possible.")
+            if "C-term" in pp:
+                ta = "C-term"
+            elif "N-term" in pp:
+                ta = "N-term"
+            else:
+                warnings.add("Reassignment of the modification site not possible. Skipping.")
+                continue
+
+        # several target sites (e.g. S,T,Y), potentially including the termini
+        for aa in ta.split(","):
+            if pp in ("Protein N-term", "Protein C-term"):
+                oms_mods.append("{} ({})".format(name, pp) if aa in ("N-term", "C-term") else
+                                "{} ({} {})".format(name, pp, aa))
+            elif pp in ("Any N-term", "Any C-term"):
+                term = pp.replace("Any ", "")
+                oms_mods.append("{} ({})".format(name, term) if aa in ("N-term", "C-term") else
+                                "{} ({} {})".format(name, term, aa))
+            else:
+                oms_mods.append("{} ({})".format(name, aa))
+    return ",".join(oms_mods)
+
+
+def tolerance(value, default, kind, warnings):
+    value = (value or "").replace("PPM", "ppm")
+    if "ppm" in value or "Da" in value:
+        return value.split(" ")[:2]
+    warnings.add("No or invalid {} mass tolerance set. Assuming {} {}.".format(kind, *default))
+    return default
+
+
+def nt_value(value):
+    match = NT_REGEX.search(value)
+    return match.group(1) if match else value
+
+
+def identifier(value):
+    return "1" if not value or "not available" in value else value
+
+
+class Sdrf(object):
+    """Columns of an SDRF resolved by their lower-case header names (duplicate names are allowed)."""
+
+    def __init__(self, header):
+        self.header = [h.strip().lower() for h in header]
+        self.indices = {}
+        for i, name in enumerate(self.header):
+            self.indices.setdefault(name, []).append(i)
+
+    def index(self, name, required=False):
+        indices = self.indices.get(name)
+        if indices is None and required:
+            raise ValueError("Column '{}' not found in the SDRF".format(name))
+        return indices[0] if indices else None
+
+    def starting_with(self, prefix):
+        return [i for i, name in enumerate(self.header) if name.startswith(prefix)]
+
+
+def convert(sdrf_path, settings_path, design_path, keep_raw):
+    warnings = Warnings()
+    unimod = unimod_names()
+    with open(sdrf_path, newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        sdrf = Sdrf(next(reader))
+        data_file = sdrf.index("comment[data file]", required=True)
+        uri = sdrf.index("comment[file uri]")
+        source_name = sdrf.index("source name", required=True)
+        enzyme_column = sdrf.index("comment[cleavage agent details]", required=True)
+        label_column = sdrf.index("comment[label]", required=True)
+        precursor_tolerance = sdrf.index("comment[precursor mass tolerance]")
+        fragment_tolerance = sdrf.index("comment[fragment mass tolerance]")
+        dissociation = sdrf.index("comment[dissociation method]")
+        technical_replicate = sdrf.index("comment[technical replicate]")
+        fraction_column = sdrf.index("comment[fraction identifier]")
+        mod_columns = sdrf.starting_with("comment[modification parameters")
+        factor_columns = sdrf.starting_with("factor value[")
+        characteristics_columns = sdrf.starting_with("characteristics[")
+
+        settings = OrderedDict()
+        files = []
+        factor_values = {i: [] for i in factor_columns + characteristics_columns}
+        source_names = OrderedDict()
+        for row in reader:
+            if not any(v.strip() for v in row):
+                continue
+            raw = row[data_file]
+            source = row[source_name]
+            replicate = identifier(row[technical_replicate] if technical_replicate is not None else None)
+            # the highest technical replicate number of every source name determines the fraction groups
+            source_names[source] = max(source_names.get(source, 0), int(replicate))
+            label = nt_value(row[label_column])
+            files.append((raw, source, replicate,
+                          identifier(row[fraction_column] if fraction_column is not None else None),
+                          "1" if "label free sample" in label else label))
+            for i in factor_values:
+                factor_values[i].append(row[i])
+            if raw in settings:
+                continue
+
+            mods = [row[i] for i in mod_columns]
+            enzyme = nt_value(row[enzyme_column])
+            if dissociation is not None:
+                dissociation_method = nt_value(row[dissociation]).upper()
+            else:
+                warnings.add("No dissociation method provided. Assuming HCD.")
+                dissociation_method = "HCD"
+            settings[raw] = [
+                row[uri] if uri is not None else raw,
+                raw,
+                openms_mods(sorted(m for m in mods if "MT=fixed" in m or "MT=Fixed" in m), unimod, warnings),
+                openms_mods(sorted(m for m in mods if "MT=variable" in m or "MT=Variable" in m), unimod, warnings),
+                label,
+            ] + tolerance(row[precursor_tolerance] if precursor_tolerance is not None else None,
+                          ["10", "ppm"], "precursor", warnings) \
+              + tolerance(row[fragment_tolerance] if fragment_tolerance is not None else None,
+                          ["20", "ppm"], "fragment", warnings) \
+              + [dissociation_method, ENZYMES.get(enzyme.lower(), enzyme.capitalize())]
+
+    # conditions: the factor values that are not constant, or else the non-constant characteristics
+    factors = [i for i in factor_columns if len(set(factor_values[i])) > 1]
+    if not factors:
+        factors = [i for i in characteristics_columns if len(set(factor_values[i])) > 1]
+        warnings.add("No factors specified. Adding non-redundant characteristics as factor. Will be used as condition."
+                     if factors else "No factors specified. Adding dummy factor used as condition.")
+
+    with open(settings_path, "w") as out:
+        out.write("\t".join(SETTINGS_COLUMNS) + "\n")
+        for values in settings.values():
+            out.write("\t".join(values) + "\n")
+
+    # fraction groups are numbered by source name and technical replicate
+    offsets = {}
+    offset = 0
+    for source, replicates in source_names.items():
+        offsets[source] = offset
+        offset += replicates
+
+    file_rows = []
+    sample_rows = OrderedDict()
+    for n, (raw, source, replicate, fraction, label) in enumerate(files):
+        sample = str(offsets[source] + int(replicate))
+        out = raw if keep_raw else RAW_EXTENSION_REGEX.sub(".mzML", raw)
+        file_rows.append("\t".join([sample, fraction, out, label, sample]))
+        if sample not in sample_rows:
+            condition = "|".join(factor_values[i][n] for i in factors)
+            # MSstats needs different BioReplicates for samples of different conditions
+            sample_rows[sample] = "\t".join([sample, condition if factors else sample, sample])
+
+    with open(design_path, "w") as out:
+        out.write("Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample\n")
+        out.write("\n".join(file_rows) + "\n")
+        out.write("\nSample\tMSstats_Condition\tMSstats_BioReplicate\n")
+        out.write("\n".join(sample_rows.values()) + "\n")
+
+    for message, count in warnings.items():
+        print('WARNING: "{}" occurred {} times.'.format(message, count))
+    print("Converted {} rows ({} data files, {} samples) of {}".format(
+        len(files), len(settings), len(sample_rows), sdrf_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sdrf", help="SDRF file")
+    parser.add_argument("--settings", default="openms.tsv", help="Output search settings")
+    parser.add_argument("--design", default="experimental_design.tsv", help="Output experimental design")
+    parser.add_argument("--keep_raw", action="store_true", help="Keep the .raw extension in the experimental design")
+    args = parser.parse_args()
+
+    try:
+        convert(args.sdrf, args.settings, args.design, args.keep_raw)
+    except (ValueError, IndexError) as e:
+        sys.exit("Error converting {}: {}".format(args.sdrf, e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Split the PSMs of an idXML into shards and merge the shards again.
+
+split: The PeptideIdentifications of the idXML are streamed into shards of up to
+  --shard_size PSMs, named <basename>_shard<i>of<n>.idXML (1-based), each with the protein
+  identifications of the input. With --mzml, the spectra referenced by the PSMs are
+  copied once from the (indexed) mzML into a compact indexed mzML (--spectra_out) that can
+  be used for all shards instead of the full mzML.
+
+merge: The PeptideIdentifications of the shards are concatenated in the order of the shard
+  numbers, i.e. the original PSM order. Proteins and the rest of the file are taken from
+  the first shard.
+
+Only idXMLs with a single identification run are supported.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from index_mzml import HashingWriter, write_index
+from split_mzml import SPECTRUM_INDEX_ATTR_REGEX, SPECTRUM_LIST_COUNT_REGEX, find_spectrum_list_end, read_spectrum_offsets
+
+PEPTIDE_ID_START = b"<PeptideIdentification"
+PEPTIDE_ID_END = b"</PeptideIdentification>"
+RUN_END = b"</IdentificationRun>"
+SPECTRUM_REFERENCE_REGEX = re.compile(rb"\sspectrum_reference=\"([^\"]*)\"")
+SHARD_REGEX = re.compile(r"_shard(\d+)of(\d+)")
+SEPARATOR = b"\n\t\t"
+HEADER, PEPTIDE_ID, FOOTER = range(3)
+
+
+def read_idxml(path, block_size=1 << 20):
+    """Yield the part of an idXML before the first PeptideIdentification, all PeptideIdentification elements and the rest."""
+    with open(path, "rb") as f:
+        buf = b""
+        pos = 0
+        eof = False
+        in_header = True
+        while True:
+            block = f.read(block_size)
+            eof = not block
+            buf = buf[pos:] + block
+            pos = 0
+            if in_header:
+                i = buf.find(PEPTIDE_ID_START)
+                if i < 0:
+                    if not eof:
+                        continue
+                    # no PSMs at all
+                    end = buf.rfind(RUN_END)
+                    yield HEADER, buf[:end]
+                    yield FOOTER, buf[end:]
+                    return
+                yield HEADER, buf[:i]
+                in_header = False
+                pos = i
+            while True:
+                i = buf.find(PEPTIDE_ID_START, pos)
+                if i < 0:
+                    break
+                if buf[pos:i].strip():
+                    raise ValueError("Unexpected content between PeptideIdentifications. Only idXMLs with a single "
+                                     "identification run are supported.")
+                tag_end = buf.find(b">", i)
+                if tag_end < 0:
+                    break
+                if buf[tag_end - 1:tag_end] == b"/":
+                    end = tag_end + 1
+                else:
+                    end = buf.find(PEPTIDE_ID_END, tag_end)
+                    if end < 0:
+                        break
+                    end += len(PEPTIDE_ID_END)
+                yield PEPTIDE_ID, buf[i:end]
+                pos = end
+            if eof:
+                if PEPTIDE_ID_START in buf[pos:]:
+                    raise ValueError("Truncated PeptideIdentification at the end of " + path)
+                yield FOOTER, buf[pos:]
+                return
+
+
+def write_spectra(mzml, native_ids, out_path):
+    """Copy the spectra with the given native ids (all if None) into a new indexed mzML, keeping their order."""
+    with open(mzml, "rb") as f:
+        offsets = read_spectrum_offsets(f)
+        if not offsets:
+            raise ValueError("No spectra found in " + mzml)
+        ends = [o for _, o in offsets[1:]] + [find_spectrum_list_end(f, offsets[-1][1])]
+        selected = [(native_id, start, end) for (native_id, start), end in zip(offsets, ends)
+                    if native_ids is None or native_id in native_ids]
+        f.seek(0)
+        header = f.read(offsets[0][1])
+
+        out = HashingWriter(out_path)
+        out.write(SPECTRUM_LIST_COUNT_REGEX.sub(rb"\g<1>%d\g<2>" % len(selected), header, count=1))
+        spectrum_offsets = []
+        for i, (native_id, start, end) in enumerate(selected):
+            f.seek(start)
+            spectrum = f.read(end - start)
+            spectrum_offsets.append((native_id, out.pos))
+            # spectrum indices have to be consecutive and zero-based within each file
+            out.write(SPECTRUM_INDEX_ATTR_REGEX.sub(rb"\g<1>%d\g<2>" % i, spectrum, count=1))
+        out.write(b"</spectrumList>\n    </run>\n  </mzML>\n")
+        write_index(out, spectrum_offsets)
+    return len(selected), len(offsets)
+
+
+def split(id_file, out_dir, shard_size, mzml=None, spectra_out=None):
+    stem = os.path.splitext(os.path.basename(id_file))[0]
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    native_ids = set()
+    missing_reference = False
+    out = None
+    header = footer = b""
+    for kind, data in read_idxml(id_file):
+        if kind == HEADER:
+            header = data
+        elif kind == PEPTIDE_ID:
+            if out is None or shards[-1][1] == shard_size:
+                if out is not None:
+                    out.close()
+                path = os.path.join(out_dir, "{}_shard{}.idXML".format(stem, len(shards) + 1))
+                out = open(path, "wb")
+                out.write(header)
+                shards.append([path, 0])
+            else:
+                out.write(SEPARATOR)
+            out.write(data)
+            shards[-1][1] += 1
+            reference = SPECTRUM_REFERENCE_REGEX.search(data[:data.find(b">")])
+            if reference:
+                native_ids.add(reference.group(1))
+            else:
+                missing_reference = True
+        else:
+            footer = data
+    if out is None:
+        # no PSMs: a single (empty) shard
+        path = os.path.join(out_dir, "{}_shard1.idXML".format(stem))
+        out = open(path, "wb")
+        out.write(header)
+        shards.append([path, 0])
+    out.close()
+
+    # the rest of the file is only known at the end
+    for i, (path, _) in enumerate(shards, start=1):
+        with open(path, "ab") as f:
+            f.write(footer)
+        os.rename(path, os.path.join(out_dir, "{}_shard{}of{}.idXML".format(stem, i, len(shards))))
+    print("Split {} PSMs of {} into {} shards".format(sum(n for _, n in shards), id_file, len(shards)))
+
+    if mzml:
+        if missing_reference:
+            print("Some PSMs have no spectrum reference, copying all spectra")
+        n_selected, n_spectra = write_spectra(mzml, None if missing_reference else native_ids, spectra_out)
+        print("Copied {} of {} spectra of {} to {}".format(n_selected, n_spectra, mzml, spectra_out))
+
+
+def merge(out_path, shards):
+    def shard_number(path):
+        match = SHARD_REGEX.search(os.path.basename(path))
+        return int(match.group(1)) if match else 0
+
+    shards = sorted(shards, key=shard_number)
+    n_psms = 0
+    footer = b""
+    with open(out_path, "wb") as out:
+        for s, shard in enumerate(shards):
+            for kind, data in read_idxml(shard):
+                if kind == HEADER and s == 0:
+                    out.write(data)
+                elif kind == PEPTIDE_ID:
+                    if n_psms:
+                        out.write(SEPARATOR)
+                    out.write(data)
+                    n_psms += 1
+                elif kind == FOOTER and s == 0:
+                    footer = data
+        out.write(footer)
+    print("Merged {} PSMs of {} shards into {}".format(n_psms, len(shards), out_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    split_parser = subparsers.add_parser("split", help="Split an idXML into shards")
+    split_parser.add_argument("id_file", help="idXML to split")
+    split_parser.add_argument("out_dir", help="Output folder for the shards")
+    split_parser.add_argument("--shard_size", type=int, required=True, help="Maximum number of PSMs per shard")
+    split_parser.add_argument("--mzml", help="Indexed mzML with the spectra of the PSMs")
+    split_parser.add_argument("--spectra_out", help="Output mzML with the spectra referenced by the PSMs")
+    merge_parser = subparsers.add_parser("merge", help="Merge shards into one idXML")
+    merge_parser.add_argument("out", help="Merged idXML")
+    merge_parser.add_argument("shards", nargs="+", help="Shards of one idXML")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "split":
+            if args.mzml and not args.spectra_out:
+                parser.error("--spectra_out is required with --mzml")
+            split(args.id_file, args.out_dir, args.shard_size, args.mzml, args.spectra_out)
+        elif args.command == "merge":
+            merge(args.out, args.shards)
+        else:
+            parser.error("Please specify a command (split or merge)")
+    except ValueError as e:
+        sys.exit("Error: {}".format(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Split an indexed mzML into indexed mzML chunks of consecutive spectra.
+
+Spectra are located through the offset index of the input and copied one by one,
+so that memory usage is bounded by the largest single spectrum. Chromatograms are
+not copied. Chunks are named <basename>_chunk<i>of<n>.mzML (1-based).
+"""
+
+import argparse
+import math
+import os
+import re
+import sys
+
+from index_mzml import HashingWriter, write_index
+
+INDEX_LIST_OFFSET_REGEX = re.compile(rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>")
+SPECTRUM_INDEX_REGEX = re.compile(rb"<index\s+name=\"spectrum\"\s*>(.*?)</index>", re.S)
+OFFSET_REGEX = re.compile(rb"<offset\s+idRef=\"([^\"]*)\"\s*>\s*(\d+)\s*</offset>")
+SPECTRUM_LIST_COUNT_REGEX = re.compile(rb"(<spectrumList[^>]*\scount=\")\d+(\")")
+SPECTRUM_INDEX_ATTR_REGEX = re.compile(rb"(<spectrum[^>]*\sindex=\")\d+(\")")
+
+
+def read_spectrum_offsets(f):
+    """Return the (native id, byte offset) pairs of all spectra from the index of an indexed mzML."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 4096))
+    match = INDEX_LIST_OFFSET_REGEX.search(f.read())
+    if not match:
+        raise ValueError("No <indexListOffset> found. Is this an indexed mzML?")
+    f.seek(int(match.group(1)))
+    index = SPECTRUM_INDEX_REGEX.search(f.read())
+    if not index:
+        raise ValueError("No spectrum index found.")
+    return [(native_id, int(offset)) for native_id, offset in OFFSET_REGEX.findall(index.group(1))]
+
+
+def find_spectrum_list_end(f, start, block_size=1 << 20):
+    """Return the byte offset of the closing </spectrumList> tag after start."""
+    tag = b"</spectrumList>"
+    f.seek(start)
+    pos = start
+    tail = b""
+    while True:
+        block = f.read(block_size)
+        if not block:
+            raise ValueError("No </spectrumList> found.")
+        data = tail + block
+        i = data.find(tag)
+        if i >= 0:
+            return pos - len(tail) + i
+        tail = data[-len(tag):]
+        pos += len(block)
+
+
+def chunk_size_for(n_spectra, chunk_size, max_chunks, min_chunk_size):
+    """Use the given chunk size or pick one so that at most max_chunks chunks are created."""
+    if chunk_size > 0:
+        return chunk_size
+    return max(min_chunk_size, int(math.ceil(n_spectra / float(max_chunks))))
+
+
+def split(mzml, out_dir, chunk_size, max_chunks, min_chunk_size):
+    with open(mzml, "rb") as f:
+        offsets = read_spectrum_offsets(f)
+        if not offsets:
+            raise ValueError("No spectra found in " + mzml)
+        spectrum_list_end = find_spectrum_list_end(f, offsets[-1][1])
+        f.seek(0)
+        header = f.read(offsets[0][1])
+
+        size = chunk_size_for(len(offsets), chunk_size, max_chunks, min_chunk_size)
+        n_chunks = int(math.ceil(len(offsets) / float(size)))
+        stem = os.path.splitext(os.path.basename(mzml))[0]
+        print("Splitting {} spectra of {} into {} chunks of up to {} spectra".format(len(offsets), mzml, n_chunks, size))
+
+        for c in range(n_chunks):
+            chunk = offsets[c * size:(c + 1) * size]
+            ends = [o for _, o in offsets[(c * size) + 1:(c + 1) * size + 1]]
+            if len(ends) < len(chunk):
+                ends.append(spectrum_list_end)
+
+            out = HashingWriter(os.path.join(out_dir, "{}_chunk{}of{}.mzML".format(stem, c + 1, n_chunks)))
+            out.write(SPECTRUM_LIST_COUNT_REGEX.sub(rb"\g<1>%d\g<2>" % len(chunk), header, count=1))
+            chunk_offsets = []
+            f.seek(chunk[0][1])
+            for i, ((native_id, start), end) in enumerate(zip(chunk, ends)):
+                spectrum = f.read(end - start)
+                chunk_offsets.append((native_id, out.pos))
+                # spectrum indices have to be consecutive and zero-based within each file
+                out.write(SPECTRUM_INDEX_ATTR_REGEX.sub(rb"\g<1>%d\g<2>" % i, spectrum, count=1))
+            out.write(b"</spectrumList>\n    </run>\n  </mzML>\n")
+            write_index(out, chunk_offsets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mzml", help="Indexed mzML to split")
+    parser.add_argument("out_dir", help="Output folder for the chunks")
+    parser.add_argument("--chunk_size", type=int, default=0,
+                        help="Number of spectra per chunk. 0 = pick automatically from the number of spectra (default)")
+    parser.add_argument("--max_chunks", type=int, default=8,
+                        help="Maximum number of chunks if the chunk size is picked automatically")
+    parser.add_argument("--min_chunk_size", type=int, default=5000,
+                        help="Minimum number of spectra per chunk if the chunk size is picked automatically")
+    args = parser.parse_args()
+
+    try:
+        split(args.mzml, args.out_dir, args.chunk_size, args.max_chunks, args.min_chunk_size)
+    except ValueError as e:
+        sys.exit("Error splitting {}: {}".format(args.mzml, e))
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,12 @@ generated_parameters = {
         section_title=None,
         description='Email address for completion summary.',
     ),
+    'publish_dir_mode_overrides': NextflowParameter(
+        type=typing.Optional[str],
+        default=None,
+        section_title='Generic options',
+        description='Publishing modes for single output folders, overriding `--publish_dir_mode`.',
+    ),
     'root_folder': NextflowParameter(
         type=typing.Optional[str],
         default=None,
@@ -44,6 +50,12 @@ generated_parameters = {
         section_title=None,
         description='Overwrite the file type/extension of the filename as specified in the SDRF',
     ),
+    'sdrf_cache': NextflowParameter(
+        type=typing.Optional[str],
+        default=None,
+        section_title=None,
+        description='Persistent directory in which parsed SDRFs are cached across pipeline executions',
+    ),
     'expdesign': NextflowParameter(
         type=typing.Optional[str],
         default=None,
@@ -74,10 +86,28 @@ generated_parameters = {
         section_title=None,
         description='Location of the decoy marker string in the fasta accession. Before (prefix) or after (suffix)',
     ),
+    'database_cache': NextflowParameter(
+        type=typing.Optional[str],
+        default=None,
+        section_title=None,
+        description='Persistent directory in which generated databases are cached across pipeline executions',
+    ),
+    'conversion_cache': NextflowParameter(
+        type=typing.Optional[str],
+        default=None,
+        section_title='Spectrum preprocessing',
+        description='Persistent directory in which converted raw files are cached across pipeline executions',
+    ),
+    'raw_conversion_batch_size': NextflowParameter(
+        type=typing.Optional[int],
+        default=None,
+        section_title=None,
+        description='Number of raw files that are converted in parallel in one task',
+    ),
     'openms_peakpicking': NextflowParameter(
         type=typing.Optional[bool],
         default=None,
-        section_title='Spectrum preprocessing',
+        section_title=None,
         description='Activate OpenMS-internal peak picking',
     ),
     'peakpicking_inmemory': NextflowParameter(
@@ -86,6 +116,18 @@ generated_parameters = {
         section_title=None,
         description='Perform peakpicking in memory',
     ),
+    'peakpicking_adaptive': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Choose between in-memory and on-the-fly peakpicking per file',
+    ),
+    'peakpicking_compression': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Compress the picked spectra with zlib',
+    ),
     'peakpicking_ms_levels': NextflowParameter(
         type=typing.Optional[str],
         default=None,
@@ -212,6 +254,30 @@ generated_parameters = {
         section_title=None,
         description="Debug level when running the database search. Logs become more verbose and at '>5' temporary files are kept.",
     ),
+    'search_chunking': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Split every mzML into chunks of spectra that are searched in parallel and merged afterwards',
+    ),
+    'search_chunk_size': NextflowParameter(
+        type=typing.Optional[int],
+        default=None,
+        section_title=None,
+        description='Number of spectra per chunk if `--search_chunking` is enabled. Default: 0 = pick automatically from the number of spectra',
+    ),
+    'search_max_chunks': NextflowParameter(
+        type=typing.Optional[int],
+        default=None,
+        section_title=None,
+        description='Maximum number of chunks per mzML if the chunk size is picked automatically. Default: 8',
+    ),
+    'fused_search': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Run Comet and MS-GF+ for an mzML in the same task',
+    ),
     'enable_mod_localization': NextflowParameter(
         type=typing.Optional[bool],
         default=None,
@@ -224,6 +290,12 @@ generated_parameters = {
         section_title=None,
         description='Which variable modifications to use for scoring their localization.',
     ),
+    'luciphor_shard_size': NextflowParameter(
+        type=typing.Optional[int],
+        default=None,
+        section_title=None,
+        description='Number of PSMs per Luciphor task. 0 = one task per run.',
+    ),
     'allow_unmatched': NextflowParameter(
         type=typing.Optional[str],
         default='false',
@@ -248,6 +320,12 @@ generated_parameters = {
         section_title=None,
         description='FDR cutoff on PSM level (or potential peptide level; see Percolator options) before going into feature finding, map alignment and inference.',
     ),
+    'post_search_batch_size': NextflowParameter(
+        type=typing.Optional[int],
+        default=None,
+        section_title=None,
+        description='Number of runs whose post-search steps (peptide indexing to ID filtering) run in one task. 0 = one task per run and step.',
+    ),
     'pp_debug': NextflowParameter(
         type=typing.Optional[int],
         default=None,
@@ -278,6 +356,12 @@ generated_parameters = {
         section_title=None,
         description='Only train an SVM on a subset of PSMs, and use the resulting score vector to evaluate the other PSMs. Recommended when analyzing huge numbers (>1 million) of PSMs. When set to 0, all PSMs are used for training as normal. This is a runtime vs. discriminability tradeoff. Default: 300,000',
     ),
+    'percolator_study_level': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Train and apply Percolator on the pooled PSMs of all runs (per search engine) instead of per run. Default: false',
+    ),
     'description_correct_features': NextflowParameter(
         type=typing.Optional[int],
         default=None,
@@ -350,6 +434,12 @@ generated_parameters = {
         section_title=None,
         description="Only looks for quantifiable features at locations with an identified spectrum. Set to false to include unidentified features so they can be linked and matched to identified ones (= match between runs). (default: 'true')",
     ),
+    'per_run_feature_detection': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description="Detect features per run (FeatureFinderIdentification) as soon as the IDs of the run are final and only align, link, infer and quantify on the whole study, instead of running ProteomicsLFQ. Only used with 'feature_intensity'. Mass recalibration, ID transfer, `--protein_quant` and `--psm_pep_fdr_for_quant` are not supported in this mode, so the results differ from ProteomicsLFQ if they are used. PTXQC (`--enable_qc`) and the QC metrics (`--enable_qc_metrics`) are skipped, as they need the mzTab of ProteomicsLFQ.",
+    ),
     'inf_quant_debug': NextflowParameter(
         type=typing.Optional[int],
         default=None,
@@ -374,17 +464,41 @@ generated_parameters = {
         section_title=None,
         description="Allows full control over contrasts by specifying a set of contrasts in a semicolon seperated list of R-compatible contrasts with the condition names/numbers as variables (e.g. `1-2;1-3;2-3`). Overwrites '--ref_condition' (TODO not yet fully implemented)",
     ),
+    'export_parquet': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title='Parquet export',
+        description='Also export the mzTab (proteins, peptides, PSMs) and the MSstats table of ProteomicsLFQ as Parquet files with dictionary-encoded accessions and sequences. The MSstats table is partitioned by run. Only available with `-profile conda`: pyarrow is not part of the container of the pipeline (and thus not available on Latch).',
+    ),
     'enable_qc': NextflowParameter(
         type=typing.Optional[bool],
         default=None,
         section_title='Quality control',
         description="Enable generation of quality control report by PTXQC? default: 'false' since it is still unstable",
     ),
+    'enable_qc_metrics': NextflowParameter(
+        type=typing.Optional[bool],
+        default=None,
+        section_title=None,
+        description='Compute fast QC metrics per run (ID rate, mass error, retention times, missed cleavages, charges, contaminants) from the mzTab in one pass. Written as JSON, TSV and a small HTML page to `qc_metrics`.',
+    ),
+    'contaminant_regex': NextflowParameter(
+        type=typing.Optional[str],
+        default=None,
+        section_title=None,
+        description='Regular expression matching the accessions of contaminant proteins in the QC metrics',
+    ),
     'ptxqc_report_layout': NextflowParameter(
         type=typing.Optional[str],
         default=None,
         section_title=None,
         description='Specify a yaml file for the report layout (see PTXQC documentation) (TODO not yet fully implemented)',
     ),
+    'storage_expansion_factor': NextflowParameter(
+        type=typing.Optional[float],
+        default=None,
+        section_title='Latch resources',
+        description='Size of the shared storage volume relative to the total size of the spectra files, to account for RAW to mzML conversion and intermediate results (default: 4.0)',
+    ),
 }
 
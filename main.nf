@@ -25,9 +25,11 @@ def helpMessage() {
       For SDRF:
       --root_folder                 (Optional) If given, looks for the filenames in the SDRF in this folder, locally
       --local_input_type            (Optional) If given and 'root_folder' was specified, it overwrites the filetype in the SDRF for local lookup and matches only the basename.
+      --sdrf_cache                  (Optional) Persistent directory to cache parsed SDRFs across pipeline executions
 
       For mzML/raw files:
-      --expdesign                   (Optional) Path to an experimental design file (if not given, it assumes unfractionated, unrelated samples)
+      --expdesign                   (Optional) Path to an experimental design file (if not given, it is inferred from the file names,
+                                    see bin/create_trivial_design.py)
 
       And:
       --database                    Path to input protein database as fasta
@@ -36,6 +38,7 @@ def helpMessage() {
       --add_decoys                  Add decoys to the given fasta
       --decoy_affix                 The decoy prefix or suffix used or to be used (default: DECOY_)
       --affix_type                  Prefix (default) or suffix (WARNING: Percolator only supports prefices)
+      --database_cache              (Optional) Persistent directory to cache generated databases across pipeline executions
 
     Database Search:
       --search_engines               Which search engine: "comet" (default) or "msgf"
@@ -47,6 +50,7 @@ def helpMessage() {
       --variable_mods               Variable modifications ('Oxidation (M)', see OpenMS modifications)
       --enable_mod_localization     Enable localization scoring with Luciphor
       --mod_localization            Specify the var. modifications whose localizations should be rescored with the luciphor algorithm
+      --luciphor_shard_size         Localize the PSMs of a run in parallel shards of this many PSMs (default: 0 = one task per run)
       --precursor_mass_tolerance    Mass tolerance of precursor mass (default: 5)
       --precursor_mass_tolerance_unit Da or ppm (default: ppm)
       --fragment_mass_tolerance     Mass tolerance for fragment masses (currently only controls Comets fragment_bin_tol) (default: 0.03)
@@ -61,15 +65,25 @@ def helpMessage() {
       --fragment_method             Used fragmentation method (currently unused since we let the search engines consider all MS2 spectra and let them determine from the spectrum metadata)
       --max_mods                    Maximum number of modifications per peptide. If this value is large, the search may take very long
       --db_debug                    Debug level during database search
+      --search_chunking             Split every mzML into chunks of spectra that are searched in parallel and merged afterwards
+      --search_chunk_size           Number of spectra per chunk (default: 0 = pick automatically from the number of spectra)
+      --search_max_chunks           Maximum number of chunks per mzML if the chunk size is picked automatically (default: 8)
+      --fused_search                With both search engines, run Comet and MS-GF+ for an mzML in the same task (default: false)
 
       //TODO probably also still some options missing. Try to consolidate them whenever the two search engines share them
 
     Peak picking:
       --openms_peakpicking          Use the OpenMS PeakPicker to ADDITIONALLY pick the spectra before the search. This is usually done
                                     during conversion already. Only activate if something goes wrong.
-      --peakpicking_inmemory        Perform OpenMS peakpicking in-memory. Needs at least the size of the mzML file as RAM but is faster. default: false
+      --peakpicking_inmemory        Always perform OpenMS peakpicking in-memory. Needs at least the size of the mzML file as RAM but is faster. default: false
+      --peakpicking_adaptive        Pick in-memory if the mzML fits into the memory of the task and on the fly otherwise. default: false
+      --peakpicking_compression     Compress the picked spectra with zlib (lossless). default: false
       --peakpicking_ms_levels       Which MS levels to pick. default: [] which means auto-convert all non-centroided
 
+    Raw file conversion:
+      --conversion_cache            (Optional) Persistent directory to cache converted raw files across pipeline executions
+      --raw_conversion_batch_size   Number of raw files converted in parallel in one task, without conversion cache (default: 4)
+
     Peptide Re-indexing:
       --IL_equivalent               Should isoleucine and leucine be treated interchangeably? Default: true
       --allow_unmatched             Ignore unmatched peptides (Default: false; only activate if you double-checked all other settings)
@@ -83,6 +97,8 @@ def helpMessage() {
       --rescoring_debug             Debug level during PSM rescoring
       --psm_pep_fdr_cutoff          FDR cutoff on PSM level (or potential peptide level; see Percolator options) before going into
                                     feature finding, map alignment and inference.
+      --post_search_batch_size      Run the steps from peptide indexing to ID filtering for batches of this many runs in one task
+                                    instead of one task per run and step (default: 0 = off)
 
       Percolator specific:
       --train_FDR                   False discovery rate threshold to define positive examples in training. Set to testFDR if 0
@@ -94,6 +110,7 @@ def helpMessage() {
       --subset_max_train            Only train an SVM on a subset of PSMs, and use the resulting score vector to evaluate the other
                                     PSMs. Recommended when analyzing huge numbers (>1 million) of PSMs. When set to 0, all PSMs are used for training as normal.
       --klammer                     Retention time features are calculated as in Klammer et al. instead of with Elude
+      --percolator_study_level      Train and apply Percolator on the pooled PSMs of all runs (per search engine) instead of per run (default: false)
 
       Distribution specific:
       --outlier_handling            How to handle outliers during fitting:
@@ -127,6 +144,9 @@ def helpMessage() {
       --targeted_only               Only ID based quantification. (default: true) TODO must specify true or false
       --mass_recalibration          Recalibrates masses to correct for instrument biases. (default: false) TODO must specify true
                                     or false
+      --per_run_feature_detection   Detect features per run as soon as its IDs are final and only align, link and quantify
+                                    on the whole study (instead of ProteomicsLFQ; only with 'feature_intensity', default: false).
+                                    Mass recalibration, ID transfer, PTXQC and the QC metrics are not available in this mode
 
       //TODO the following need to be passed still
       --psm_pep_fdr_for_quant       PSM/peptide level FDR used for quantification (if filtering on protein level is not enough)
@@ -145,12 +165,21 @@ def helpMessage() {
       --contrasts                   Specify a set of contrasts in a semicolon seperated list of R-compatible contrasts with the
                                     condition numbers as variables (e.g. "1-2;1-3;2-3"). Overwrites "--reference" (TODO fully implement)
 
+    Parquet export:
+      --export_parquet              Also export the mzTab and MSstats table of ProteomicsLFQ as Parquet
+                                    (only with -profile conda, the container does not contain pyarrow)
+
     Quality control:
+      --enable_qc_metrics           Compute fast QC metrics per run from the mzTab (ID rate, mass error, retention times,
+                                    missed cleavages, contaminants; default: false)
+      --contaminant_regex           Regular expression matching the accessions of contaminants in the QC metrics
+                                    (default: 'CONTAMINANT|^CON_')
       --ptxqc_report_layout         Specify a yaml file for the report layout (see PTXQC documentation) (TODO fully implement)
 
     Other options:
       --outdir [file]                 The output directory where the results will be saved
       --publish_dir_mode [str]        Mode for publishing results in the output directory. Available: symlink, rellink, link, copy, copyNoFollow, move (Default: copy)
+      --publish_dir_mode_overrides [str]  Comma-separated modes for single output folders, e.g. 'logs:copy,raw_ids:symlink' (Default: '')
       --email [email]                 Set this parameter to your e-mail address to get a summary e-mail with details of the run sent to you when the workflow exits
       --email_on_fail [email]         Same as --email, except only send mail if the workflow is not successful
       -name [str]                     Name for the pipeline run. If not specified, Nextflow will automatically generate a random mnemonic
@@ -215,6 +244,24 @@ if (tocheck.toLowerCase().endsWith("sdrf") || tocheck.toLowerCase().endsWith("ts
 params.database = params.database ?: { log.error "No protein database provided. Make sure you have used the '--database' option."; exit 1 }()
 params.outdir = params.outdir ?: { log.warn "No output directory provided. Will put the results into './results'"; return "./results" }()
 
+// Publishing modes of single output folders (see publishMode), checked before any process is set up
+publish_dir_mode_overrides = [:]
+params.publish_dir_mode_overrides.tokenize(',')*.trim().findAll{ it }.each{ entry ->
+  def fields = entry.tokenize(':')*.trim()
+  def modes = ['symlink', 'rellink', 'link', 'copy', 'copyNoFollow', 'move']
+  if (fields.size() != 2 || !(fields[1] in modes)) {
+    log.error "Invalid entry '${entry}' in --publish_dir_mode_overrides. Expected <folder>:<mode> with one of the modes ${modes.join(', ')}, e.g. 'logs:copy,raw_ids:symlink'."
+    exit 1
+  }
+  publish_dir_mode_overrides[fields[0]] = fields[1]
+}
+
+// pyarrow is only part of the conda environment of the pipeline, the released container (nfcore/proteomicslfq:1.0.0) lacks it
+if (params.export_parquet && workflow.containerEngine) {
+  log.error "--export_parquet needs pyarrow, which is only available with '-profile conda' (not in the container '${workflow.container}')."
+  exit 1
+}
+
 /*
  * Create a channel for input files
  */
@@ -227,7 +274,7 @@ if (!sdrf_file)
   ch_spectra = Channel.fromPath(spectra_files, checkIfExists: true)
   ch_spectra
   .multiMap{ it -> id = it.toString().md5()
-                    comet_settings: msgf_settings: tuple(id,
+                    comet_settings: msgf_settings: fused_settings: tuple(id,
                                     params.fixed_mods,
                                     params.variable_mods,
                                     "", //labelling modifications currently not supported
@@ -247,16 +294,20 @@ if (!sdrf_file)
 }
 else
 {
+  // If an SDRF cache is given, the parsed SDRF is kept there, keyed by the content of the SDRF and of the
+  // converter, so that later executions do not have to parse it again
   ch_sdrf = Channel.fromPath(sdrf_file, checkIfExists: true)
+                   .map{ sdrf -> tuple([fileChecksum(sdrf), fileChecksum(file("$baseDir/bin/sdrf_to_openms.py"))].join('_').md5(), sdrf) }
   /*
    * STEP 0 - SDRF parsing
    */
   process sdrf_parsing {
 
-      publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+      publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+      storeDir { params.sdrf_cache ? "${params.sdrf_cache}/${cache_key}" : null }
 
       input:
-       file sdrf from ch_sdrf
+       tuple val(cache_key), file(sdrf) from ch_sdrf
 
       output:
        file "experimental_design.tsv" into ch_expdesign
@@ -267,40 +318,51 @@ else
 
       script:
        """
-       ## -t2 since the one-table format parser is broken in OpenMS2.5
-       ## -l for legacy behavior to always add sample columns
-       parse_sdrf convert-openms -t2 -l -s ${sdrf} > sdrf_parsing.log
+       sdrf_to_openms.py ${sdrf} --settings openms.tsv --design experimental_design.tsv > sdrf_parsing.log
        """
   }
 
-  //TODO use header and reference by col name instead of index
+  // All spectra files referenced by the SDRF are checked before any of them is processed
   ch_sdrf_config_file
-  .splitCsv(skip: 1, sep: '\t')
-  .multiMap{ row -> id = row.toString().md5()
-                    comet_settings: msgf_settings: tuple(id,
-                                    row[2],
-                                    row[3],
-                                    row[4],
-                                    row[5],
-                                    row[6],
-                                    row[7],
-                                    row[8],
-                                    row[9],
-                                    row[10])
+  .splitCsv(header: true, sep: '\t')
+  .toList()
+  .map{ rows ->
+        def missing = missingFiles(rows.collect{ sdrfSpectraPath(it) })
+        if (missing) {
+            error "${missing.size()} spectra files referenced by the SDRF do not exist, e.g.:\n  ${missing.take(10).join('\n  ')}"
+        }
+        rows }
+  .flatMap()
+  .multiMap{ row -> id = row.Filename.md5()
+                    comet_settings: msgf_settings: fused_settings: tuple(id,
+                                    row.FixedModifications,
+                                    row.VariableModifications,
+                                    row.Label,
+                                    row.PrecursorMassTolerance,
+                                    row.PrecursorMassToleranceUnit,
+                                    row.FragmentMassTolerance,
+                                    row.FragmentMassToleranceUnit,
+                                    row.DissociationMethod,
+                                    row.Enzyme)
                     idx_settings: tuple(id,
-                                    row[10])
+                                    row.Enzyme)
                     luciphor_settings:
                                   tuple(id,
-                                    row[9])
-                    mzmls: tuple(id, !params.root_folder ?
-                                    row[0] :
-                                    params.root_folder + "/" + (params.local_input_type ?
-                                        row[1].take(row[1].lastIndexOf('.')) + '.' + params.local_input_type :
-                                        row[1]))}
+                                    row.DissociationMethod)
+                    mzmls: tuple(id, sdrfSpectraPath(row))}
   .set{ch_sdrf_config}
 }
 
+// Identifies the versions of the tools used to build cached results (container image or pipeline release)
+tool_version_tag = workflow.container ? workflow.container.toString() : workflow.manifest.version
+
+// The cache key of a decoy database combines the content of the target database with all settings that influence the output.
+// The checksum is only calculated if decoys are generated and caching is enabled.
 ch_db_for_decoy_creation = Channel.fromPath(params.database)
+                            .map{ db -> tuple(params.add_decoys && params.database_cache ?
+                                                [fileChecksum(db), params.decoy_affix, params.affix_type, tool_version_tag].join('_').md5() :
+                                                '',
+                                              db) }
 
 // overwrite experimental design if given additionally to SDRF
 //TODO think about that
@@ -319,23 +381,21 @@ ch_sdrf_config.mzmls
 .set {branched_input}
 
 
+// Results of the mzML index probes are kept in the trace directory, keyed by path, size and modification time,
+// so that resumed runs do not have to open every input file again.
+mzml_index_cache_file = file("${params.tracedir}/.mzml_index_cache.tsv")
+mzml_index_cache = readFileCache(mzml_index_cache_file)
+
 //TODO we could also check for outdated mzML versions and try to update them
 branched_input.mzML
-.branch {
-    nonIndexedMzML: file(it[1]).withReader {
-                        f = it;
-                        1.upto(5) {
-                            if (f.readLine().contains("indexedmzML")) return false;
-                        }
-                        return true;
-                    }
-    inputIndexedMzML: file(it[1]).withReader {
-                        f = it;
-                        1.upto(5) {
-                            if (f.readLine().contains("indexedmzML")) return true;
-                        }
-                        return false;
-                    }
+.map { id, mzml ->
+    tuple(id, mzml, cachedFileValue(mzml_index_cache, mzml_index_cache_file, file(mzml)){ isIndexedMzML(it) }.toBoolean())
+}
+.branch { id, mzml, indexed ->
+    nonIndexedMzML: !indexed
+        return tuple(id, mzml)
+    inputIndexedMzML: true
+        return tuple(id, mzml)
 }
 .set {branched_input_mzMLs}
 
@@ -344,36 +404,75 @@ branched_input.mzML
 //This piece only runs on data that is a.) raw and b.) needs conversion
 //mzML files will be mixed after this step to provide output for downstream processing - allowing you to even specify mzMLs and RAW files in a mixed mode as input :-)
 
+// The conversion of a raw file only depends on its content and the version of the converter. If a conversion cache is
+// given, the converted files are stored there (see storeDir of raw_file_conversion) instead of converting them again.
+// They are keyed by name, size and modification time of the raw file, which needs no read of the file. Only on a hit,
+// the checksum of the raw file is compared with the one stored with the conversion (see rawConversionKeys).
+// Checksums are kept in the trace directory, keyed by path, size and modification time, so that relaunches
+// do not have to read every raw file again.
+raw_checksum_cache_file = file("${params.tracedir}/.raw_checksum_cache.tsv")
+raw_checksum_cache = readFileCache(raw_checksum_cache_file)
+
+if (params.conversion_cache && params.raw_conversion_batch_size > 1) {
+  log.warn "--raw_conversion_batch_size is ignored with --conversion_cache, every raw file is converted and cached by its own task."
+}
+
+// Several raw files are converted in parallel within one task
+branched_input.raw
+  .toList()
+  .flatMap{ raws -> [raws, params.conversion_cache ? rawConversionKeys(raws.collect{ file(it[1]) }) : raws.collect{ it[0] }]
+                      .transpose().collect{ raw, key -> tuple(raw[0], raw[1], key) } }
+  .buffer(size: params.conversion_cache ? 1 : params.raw_conversion_batch_size, remainder: true)
+  .map{ batch -> tuple(batch.collect{ it[0] }, batch.collect{ it[2] }, batch.collect{ file(it[1]).baseName }, batch.collect{ it[1] }) }
+  .set{ ch_raw_batches }
+
 /*
  * STEP 0.1 - Raw file conversion
  */
 process raw_file_conversion {
 
+    // cpus and memory depend on the number of files in the batch (see conf/base.config)
     label 'process_low'
-    label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*/*.log', saveAs: { filename -> file(filename).name }
+    // with a conversion cache, a task converts a single file and Nextflow only moves it to the cache when the task
+    // succeeded, so that only complete conversions are reused
+    storeDir { params.conversion_cache ? "${params.conversion_cache}/raw_conversion" : null }
 
     input:
-     tuple mzml_id, path(rawfile) from branched_input.raw
+     tuple val(mzml_ids), val(cache_keys), val(raw_names), path(rawfiles) from ch_raw_batches
 
     output:
-     tuple mzml_id, file("*.mzML") into mzmls_converted
+     tuple val(mzml_ids), val(cache_keys), val(raw_names), file("{${cache_keys.join(',')}}/*.mzML") into mzmls_converted_batches
+     file "{${cache_keys.join(',')}}/*.log"
+     file "{${cache_keys.join(',')}}/raw.md5" optional true
 
     script:
+     // every file (and its log) is written to a folder named by its cache key, cached conversions also record the
+     // checksum of the raw file to confirm hits
+     def jobs = [cache_keys, isCollectionOrArray(rawfiles) ? rawfiles : [rawfiles]].transpose().collect{ key, raw -> "'${key} ${raw}'" }.join(' ')
+     def checksum = params.conversion_cache ? ' && md5sum "\$1" | cut -d " " -f 1 > \$0/raw.md5' : ''
      """
-     ThermoRawFileParser.sh -i=${rawfile} -f=2 -o=./ > ${rawfile}_conversion.log
+     printf "%s\\n" ${jobs} > jobs.txt
+     cut -d ' ' -f 1 jobs.txt | xargs -I {} mkdir -p {}
+     xargs -P ${task.cpus} -L 1 sh -c 'ThermoRawFileParser.sh -i="\$1" -f=2 -o=\$0/ > \$0/"\$1"_conversion.log${checksum}' < jobs.txt
      """
 }
 
+mzmls_converted_batches
+  .flatMap{ ids, keys, names, mzmls ->
+      (isCollectionOrArray(mzmls) ? mzmls : [mzmls]).collect{ mzml -> tuple(ids[[keys, names].transpose().indexOf([mzml.parent.name, mzml.baseName])], mzml) } }
+  .set{ mzmls_converted }
+
 /*
  * STEP 0.2 - MzML indexing
  */
 process mzml_indexing {
 
-    label 'process_low'
+    label 'process_very_low'
+    label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
      tuple mzml_id, path(mzmlfile) from branched_input_mzMLs.nonIndexedMzML
@@ -385,7 +484,7 @@ process mzml_indexing {
     script:
      """
      mkdir out
-     FileConverter -in ${mzmlfile} -out out/${mzmlfile.baseName}.mzML > ${mzmlfile.baseName}_mzmlindexing.log
+     index_mzml.py ${mzmlfile} out/${mzmlfile.baseName}.mzML > ${mzmlfile.baseName}_mzmlindexing.log
      """
 }
 
@@ -413,10 +512,12 @@ process generate_decoy_database {
     label 'process_very_low'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    // On a cache hit the process is skipped and the stored database is emitted directly
+    storeDir { params.database_cache ? "${params.database_cache}/decoy_databases/${cache_key}" : null }
 
     input:
-     file(mydatabase) from ch_db_for_decoy_creation
+     tuple val(cache_key), file(mydatabase) from ch_db_for_decoy_creation
 
     output:
      file "${mydatabase.baseName}_decoy.fasta" into searchengine_in_db_decoy_msgf, searchengine_in_db_decoy_comet, pepidx_in_db_decoy, plfq_in_db_decoy
@@ -435,30 +536,42 @@ process generate_decoy_database {
      """
 }
 
-// Doesnt work yet. Maybe point the script to the workspace?
-// All the files should be there after collecting.
-//process generate_simple_exp_design_file {
-//    publishDir "${params.outdir}", mode: 'copy'
-//    input:
-//      val mymzmls from mzmls.collect()
+// Without SDRF or experimental design, the design is inferred from the names of the spectra files
+// (see bin/create_trivial_design.py). Only the names are needed, so it does not wait for the conversion.
+if (!sdrf_file && !params.expdesign)
+{
+  Channel.fromPath(spectra_files)
+    .map{ it.baseName + '.mzML' }
+    .collectFile(name: 'spectra_files.txt', newLine: true, sort: true)
+    .set{ ch_spectra_file_names }
+
+  process generate_simple_exp_design_file {
+
+      label 'process_very_low'
+      label 'process_single_thread'
+
+      publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+      publishDir "${params.outdir}/pipeline_info", mode: publishMode('pipeline_info'), pattern: '*.tsv'
+
+      input:
+       file spectra_file_names from ch_spectra_file_names
 
-//    output:
-//        file "expdesign.tsv" into expdesign
-//    when:
-//        !params.expdesign
+      output:
+       file "experimental_design.tsv" into ch_expdesign
+       file "*.log"
 
-//    script:
-//     strng = new File(mymzmls[0].toString()).getParentFile()
-//     """
-//       create_trivial_design.py ${strng} 1 > expdesign.tsv
-//     """
-//}
+      script:
+       """
+       create_trivial_design.py ${spectra_file_names} 1 -o experimental_design.tsv 2> generate_exp_design.log
+       """
+  }
+}
 
 process openms_peakpicker {
 
     label 'process_low'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
      tuple mzml_id, path(mzml_file) from mzmls_pp
@@ -471,17 +584,23 @@ process openms_peakpicker {
      file "*.log"
 
     script:
-     in_mem = params.peakpicking_inmemory ? "inmemory" : "lowmemory"
+     // in-memory picking needs roughly three times the size of the (uncompressed) file, fall back to streaming on retries
+     fits_in_memory = task.memory && task.attempt == 1 && 3 * mzml_file.size() < task.memory.toBytes()
+     in_mem = params.peakpicking_inmemory || (params.peakpicking_adaptive && fits_in_memory) ? "inmemory" : "lowmemory"
      lvls = params.peakpicking_ms_levels ? "-algorithm:ms_levels ${params.peakpicking_ms_levels}" : ""
+     picked = params.peakpicking_compression ? "${mzml_file.baseName}_picked.mzML" : "out/${mzml_file.baseName}.mzML"
+     compress = params.peakpicking_compression ? "compress_mzml.py ${picked} out/${mzml_file.baseName}.mzML >> ${mzml_file.baseName}_pp.log && rm ${picked}" : ""
      """
      mkdir out
+     echo "Peak picking ${mzml_file} (${mzml_file.size()} bytes) with processOption ${in_mem}" > ${mzml_file.baseName}_pp.log
      PeakPickerHiRes -in ${mzml_file} \\
-                     -out out/${mzml_file.baseName}.mzML \\
+                     -out ${picked} \\
                      -threads ${task.cpus} \\
                      -debug ${params.pp_debug} \\
                      -processOption ${in_mem} \\
                      ${lvls} \\
-                     > ${mzml_file.baseName}_pp.log
+                     >> ${mzml_file.baseName}_pp.log
+     ${compress}
      """
 }
 
@@ -496,11 +615,101 @@ if (params.num_enzyme_termini == "fully")
   pepidx_num_enzyme_termini = "full"
 }
 
+searchengine_in_db_msgf.mix(searchengine_in_db_decoy_msgf).into{ searchengine_in_db_msgf_index; searchengine_in_db_msgf_search; searchengine_in_db_fused_search }
+
+// MS-GF+ builds a suffix array index next to the database (only depending on its content) if it does not find one.
+// Build it only once and stage it next to the database for every search task.
+process msgf_index {
+
+    label 'process_low'
+    label 'process_single_thread'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    // On a cache hit the process is skipped and the stored index is emitted directly
+    storeDir { params.database_cache ? "${params.database_cache}/msgf_indexes/${cache_key}" : null }
+
+    input:
+     tuple val(cache_key), file(database) from searchengine_in_db_msgf_index
+                                                .map{ db -> tuple(params.search_engines.contains("msgf") && params.database_cache ?
+                                                                    [fileChecksum(db), tool_version_tag].join('_').md5() :
+                                                                    '',
+                                                                  db) }
+
+    output:
+     file "${database.baseName}.c*" into msgf_db_index, msgf_db_index_fused
+     file "*.log"
+
+    when:
+      params.search_engines.contains("msgf")
+
+    script:
+     """
+     msgf_plus edu.ucsd.msjava.msdbsearch.BuildSA -d ${database} -tda 0 > ${database.baseName}_msgf_index.log
+     """
+}
+
+// Optionally split every mzML into chunks of spectra that are searched in parallel and merged afterwards.
+// If both search engines are used, the chunks are shared between them.
+if (params.search_chunking)
+{
+  mzmls_to_split = params.search_engines.contains("comet") ? mzmls_comet.mix(mzmls_comet_picked) : mzmls_msgf.mix(mzmls_msgf_picked)
+  (mzmls_comet_search, mzmls_msgf_search) = [Channel.empty(), Channel.empty()]
+}
+else
+{
+  mzmls_to_split = Channel.empty()
+  mzmls_comet_search = mzmls_comet.mix(mzmls_comet_picked)
+  mzmls_msgf_search = mzmls_msgf.mix(mzmls_msgf_picked)
+}
+
+process split_mzml {
+
+    label 'process_low'
+    label 'process_single_thread'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+
+    input:
+     tuple mzml_id, path(mzml_file) from mzmls_to_split
+
+    output:
+     tuple mzml_id, file("chunks/*.mzML") into mzml_chunks
+     file "*.log"
+
+    when:
+      params.search_chunking
+
+    script:
+     """
+     mkdir chunks
+     split_mzml.py ${mzml_file} chunks \\
+                   --chunk_size ${params.search_chunk_size} \\
+                   --max_chunks ${params.search_max_chunks} \\
+                   > ${mzml_file.baseName}_split.log
+     """
+}
+
+mzml_chunks
+  .flatMap{ id, chunks -> (chunks instanceof List ? chunks : [chunks]).collect{ chunk -> tuple(id, chunk) } }
+  .into{ mzml_chunks_comet; mzml_chunks_msgf }
+
+// With --fused_search and both search engines, every mzML (or chunk) is searched by Comet and MS-GF+ in the same task
+fuse_search = params.fused_search && params.search_engines.contains("comet") && params.search_engines.contains("msgf")
+if (fuse_search)
+{
+  mzmls_fused_search = mzmls_comet_search.mix(mzml_chunks_comet)
+  (mzmls_comet_search, mzml_chunks_comet, mzmls_msgf_search, mzml_chunks_msgf) = [Channel.empty(), Channel.empty(), Channel.empty(), Channel.empty()]
+}
+else
+{
+  mzmls_fused_search = Channel.empty()
+}
+
 process search_engine_msgf {
 
     label 'process_medium'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     // ---------------------------------------------------------------------------------------------------------------------
     // ------------- WARNING: If you experience nextflow running forever after a failure, set the following ----------------
@@ -509,7 +718,8 @@ process search_engine_msgf {
     // errorStrategy 'terminate'
 
     input:
-     tuple file(database), mzml_id, path(mzml_file), fixed, variable, label, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, diss_meth, enzyme from searchengine_in_db_msgf.mix(searchengine_in_db_decoy_msgf).combine(mzmls_msgf.mix(mzmls_msgf_picked).join(ch_sdrf_config.msgf_settings))
+     // the index files are staged next to the database, where MS-GF+ picks them up instead of re-building them
+     tuple file(database), file(database_index), mzml_id, path(mzml_file), fixed, variable, label, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, diss_meth, enzyme from searchengine_in_db_msgf_search.combine(msgf_db_index.map{ idx -> [idx] }).combine(mzmls_msgf_search.mix(mzml_chunks_msgf).combine(ch_sdrf_config.msgf_settings, by: 0))
 
      // This was another way of handling the combination
      //file database from searchengine_in_db.mix(searchengine_in_db_decoy)
@@ -522,40 +732,8 @@ process search_engine_msgf {
      file "*.log"
 
     script:
-      if (enzyme == 'Trypsin') enzyme = 'Trypsin/P'
-      else if (enzyme == 'Arg-C') enzyme = 'Arg-C/P'
-      else if (enzyme == 'Asp-N') enzyme = 'Asp-N/B'
-      else if (enzyme == 'Chymotrypsin') enzyme = 'Chymotrypsin/P'
-      else if (enzyme == 'Lys-C') enzyme = 'Lys-C/P'
-
-      if ((frag_tol.toDouble() < 50 && frag_tol_unit == "ppm") || (frag_tol.toDouble() < 0.1 && frag_tol_unit == "Da"))
-      {
-        inst = params.instrument ?: "high_res"
-      } else {
-        inst = params.instrument ?: "low_res"
-      }
      """
-     MSGFPlusAdapter -in ${mzml_file} \\
-                     -out ${mzml_file.baseName}_msgf.idXML \\
-                     -threads ${task.cpus} \\
-                     -java_memory ${task.memory.toMega()} \\
-                     -database "${database}" \\
-                     -instrument ${inst} \\
-                     -protocol "${params.protocol}" \\
-                     -matches_per_spec ${params.num_hits} \\
-                     -min_precursor_charge ${params.min_precursor_charge} \\
-                     -max_precursor_charge ${params.max_precursor_charge} \\
-                     -min_peptide_length ${params.min_peptide_length} \\
-                     -max_peptide_length ${params.max_peptide_length} \\
-                     -enzyme "${enzyme}" \\
-                     -tryptic ${params.num_enzyme_termini} \\
-                     -precursor_mass_tolerance ${prec_tol} \\
-                     -precursor_error_units ${prec_tol_unit} \\
-                     -fixed_modifications ${fixed.tokenize(',').collect { "'${it}'" }.join(" ") } \\
-                     -variable_modifications ${variable.tokenize(',').collect { "'${it}'" }.join(" ") } \\
-                     -max_mods ${params.max_mods} \\
-                     -debug ${params.db_debug} \\
-                     > ${mzml_file.baseName}_msgf.log
+     ${msgfCommand(mzml_file, database, fixed, variable, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, enzyme, task.cpus, task.memory.toMega())}
      """
 }
 
@@ -563,7 +741,7 @@ process search_engine_comet {
 
     label 'process_medium'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     // ---------------------------------------------------------------------------------------------------------------------
     // ------------- WARNING: If you experience nextflow running forever after a failure, set the following ----------------
@@ -572,7 +750,7 @@ process search_engine_comet {
     //errorStrategy 'terminate'
     
     input:
-     tuple file(database), mzml_id, path(mzml_file), fixed, variable, label, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, diss_meth, enzyme from searchengine_in_db_comet.mix(searchengine_in_db_decoy_comet).combine(mzmls_comet.mix(mzmls_comet_picked).join(ch_sdrf_config.comet_settings))
+     tuple file(database), mzml_id, path(mzml_file), fixed, variable, label, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, diss_meth, enzyme from searchengine_in_db_comet.mix(searchengine_in_db_decoy_comet).combine(mzmls_comet_search.mix(mzml_chunks_comet).combine(ch_sdrf_config.comet_settings, by: 0))
 
     when:
       params.search_engines.contains("comet")
@@ -581,108 +759,208 @@ process search_engine_comet {
      tuple mzml_id, file("${mzml_file.baseName}_comet.idXML") into id_files_comet
      file "*.log"
 
-    //TODO we currently ignore the activation_method param to leave the default "ALL" for max. compatibility
-    //Note: OpenMS CometAdapter will double the number that is passed to fragment_mass_tolerance to "convert"
-    // it to a fragment_bin_tolerance
     script:
-     if (frag_tol_unit == "ppm") {
-       // Note: This uses an arbitrary rule to decide if it was hi-res or low-res
-       // and uses Comet's defaults for bin size (i.e. by passing 0.5*default to the Adapter), in case unsupported unit "ppm" was given.
-       if (frag_tol.toDouble() < 50) {
-         bin_tol = 0.015
-         bin_offset = 0.0
-         inst = params.instrument ?: "high_res"
-       } else {
-         bin_tol = 0.50025
-         bin_offset = 0.4
-         inst = params.instrument ?: "low_res"
-       }
-       log.warn "The chosen search engine Comet does not support ppm fragment tolerances. We guessed a " + inst +
-         " instrument and set the fragment_bin_tolerance to " + bin_tol
-     } else {
-       //TODO expose the fragment_bin_offset parameter of comet
-       bin_tol = frag_tol.toDouble()
-       bin_offset = bin_tol <= 0.05 ? 0.0 : 0.4
-       if (!params.instrument)
-       {
-         inst = bin_tol <= 0.05 ? "high_res" : "low_res"
-       } else {
-         inst = params.instrument
-       }
-     }
+     """
+     ${cometCommand(mzml_file, database, fixed, variable, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, enzyme, task.cpus)}
+     """
+}
+
+// Both engines run at the same time on a local copy of the spectra and split the cores of the task. This saves
+// staging the mzML twice, and both results of a run are emitted together.
+process search_engines_fused {
+
+    label 'process_medium'
+    tag "${mzml_id}"
+    scratch true
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+
+    input:
+     tuple file(database), file(database_index), mzml_id, path(mzml_file), fixed, variable, label, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, diss_meth, enzyme from searchengine_in_db_fused_search.combine(msgf_db_index_fused.map{ idx -> [idx] }).combine(mzmls_fused_search.combine(ch_sdrf_config.fused_settings, by: 0))
+
+    when:
+      fuse_search
+
+    output:
+     tuple mzml_id, file("${mzml_file.baseName}_comet.idXML"), file("${mzml_file.baseName}_msgf.idXML") into id_files_fused
+     file "*.log"
+
+    script:
+     def msgf_threads = Math.max(1, task.cpus.intdiv(2))
+     def comet_threads = Math.max(1, task.cpus - msgf_threads)
+     // MS-GF+ (Java) gets two thirds of the memory
+     def msgf_memory = (task.memory.toMega() * 2).intdiv(3)
+     """
+     # only the mzML is read by both engines, replace its link by a local copy
+     cp -L ${mzml_file} ${mzml_file}.local && mv ${mzml_file}.local ${mzml_file}
+
+     ${cometCommand(mzml_file, database, fixed, variable, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, enzyme, comet_threads)} &
+     comet_pid=\$!
 
-     // for consensusID the cutting rules need to be the same. So we adapt to the loosest rules from MSGF
-     // TODO find another solution. In ProteomicsLFQ we re-run PeptideIndexer (remove??) and if we
-     // e.g. add XTandem, after running ConsensusID it will lose the auto-detection ability for the
-     // XTandem specific rules.
-     if (params.search_engines.contains("msgf"))
-     {
-        if (enzyme == 'Trypsin') enzyme = 'Trypsin/P'
-        else if (enzyme == 'Arg-C') enzyme = 'Arg-C/P'
-        else if (enzyme == 'Asp-N') enzyme = 'Asp-N/B'
-        else if (enzyme == 'Chymotrypsin') enzyme = 'Chymotrypsin/P'
-        else if (enzyme == 'Lys-C') enzyme = 'Lys-C/P'
+     ${msgfCommand(mzml_file, database, fixed, variable, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, enzyme, msgf_threads, msgf_memory)}
+
+     wait \$comet_pid
+     """
+}
+
+// Results of chunks are grouped per run and search engine. Every group is emitted as soon as the
+// results for all chunks of the run (number encoded in the chunk names) are available.
+id_files_msgf.mix(id_files_comet)
+  .mix(id_files_fused.flatMap{ id, comet, msgf -> [tuple(id, comet), tuple(id, msgf)] })
+  .branch {
+      chunk: params.search_chunking
+      run: true
+  }
+  .set{ id_files_search }
+
+process merge_chunk_ids {
+
+    label 'process_low'
+    label 'process_single_thread'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+
+    input:
+     tuple mzml_id, file(id_files), val(merged_name) from id_files_search.chunk
+                                                     .map{ id, f -> def m = (f.name =~ /_chunk\d+of(\d+)_(\w+)\.idXML$/)
+                                                                    tuple(groupKey([id, m[0][2]], m[0][1] as int), f) }
+                                                     .groupTuple()
+                                                     .map{ key, files -> tuple(key.getGroupTarget()[0], files, files[0].name.replaceAll(/_chunk\d+of\d+/, '')) }
+
+    output:
+     tuple mzml_id, file("${merged_name}") into id_files_merged
+     file "*.log"
+
+    when:
+      params.search_chunking
+
+    script:
+     """
+     IDMerger -in ${id_files} \\
+              -out ${merged_name} \\
+              -merge_proteins_add_PSMs \\
+              -threads ${task.cpus} \\
+              > ${merged_name.take(merged_name.lastIndexOf('.'))}_merge_chunks.log
+     """
+}
+
+// With --post_search_batch_size, the per-run steps from PeptideIndexer to IDFilter run for batches of runs in one task
+fuse_post_search = params.post_search_batch_size > 0
+if (fuse_post_search && params.percolator_study_level) {
+  log.warn "--post_search_batch_size is ignored with --percolator_study_level, the steps after the search run separately."
+  fuse_post_search = false
+}
+
+id_files_search.run.mix(id_files_merged)
+  .combine(ch_sdrf_config.idx_settings, by: 0)
+  .combine(pepidx_in_db.mix(pepidx_in_db_decoy))
+  .branch {
+      fused: fuse_post_search
+      single: true
+  }
+  .set{ id_files_post_search }
+
+// The results of all search engines for a run are processed in the same batch. Every run in a batch
+// is described by its mzml_id, enzyme and the names of its id files.
+ch_post_search_batches = id_files_post_search.fused
+  .groupTuple(size: params.search_engines.split(",").size())
+  .map{ mzml_id, id_files, enzymes, databases -> tuple(mzml_id, enzymes[0], id_files, databases[0]) }
+  .buffer(size: params.post_search_batch_size > 0 ? params.post_search_batch_size : 1, remainder: true)
+  .map{ batch -> tuple(batch.collect{ mzml_id, enzyme, id_files, database -> [mzml_id, enzyme, id_files*.name] },
+                       batch.collect{ it[2] }.flatten(),
+                       batch[0][3]) }
+
+// Runs the same steps with the same parameters as the single processes below (PeptideIndexer, Percolator or
+// IDPosteriorErrorProbability, ConsensusID, FalseDiscoveryRate, IDScoreSwitcher and IDFilter) for all runs of a batch,
+// one after the other. This saves the scheduling, staging and publishing overhead of many small tasks. Intermediate
+// files stay in the scratch directory of the task and the published files are the same as in the unfused mode.
+process post_search_batch {
+
+    // time is scaled with the number of runs in conf/base.config
+    label 'process_medium'
+    scratch true
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/raw_ids", mode: publishMode('raw_ids'), pattern: '*_{perc,idpep}.idXML'
+    publishDir "${params.outdir}/consensus_ids", mode: publishMode('consensus_ids'), pattern: '*_consensus.idXML'
+    publishDir "${params.outdir}/ids", mode: publishMode('ids'), pattern: '*_{consensus_fdr,filter}.idXML'
+
+    input:
+     tuple val(runs), file(id_files), file(database) from ch_post_search_batches
+
+    output:
+     tuple val(runs), file("*_filter.idXML") into id_filtered_batches
+     file "*_{perc,idpep}.idXML"
+     file "*_consensus{.idXML,_fdr.idXML}" optional true
+     file "*.log"
+
+    when:
+     fuse_post_search
+
+    script:
+     def n_engines = params.search_engines.split(",").size()
+     def qval_score = params.posterior_probabilities == "percolator" ? "MS:1001491" : "q-value_score"
+     def commands = []
+     runs.each{ mzml_id, enzyme, names ->
+        def scored = names.collect{ name ->
+            def id = idBaseName(name)
+            commands << peptideIndexerCommand(name, database, enzyme, task.cpus)
+            id += "_idx"
+            if (params.posterior_probabilities == "percolator") {
+                commands << psmFeatureExtractorCommand("${id}.idXML", task.cpus)
+                commands << percolatorCommand("${id}_feat.idXML", task.cpus)
+                id += "_feat_perc"
+            } else {
+                if (n_engines == 1) {
+                    commands << fdrCommand("${id}.idXML", task.cpus)
+                    id += "_fdr"
+                }
+                commands << idpepCommand("${id}.idXML", task.cpus)
+                id += "_idpep"
+            }
+            return id
+        }
+        def filter_in = n_engines == 1 ? "${scored[0]}_switched" : "${mzml_id}_consensus_fdr"
+        if (n_engines == 1) {
+            commands << scoreSwitcherCommand("${scored[0]}.idXML", qval_score, task.cpus)
+        } else {
+            commands << consensusIDCommand(scored.collect{ it + '.idXML' }, mzml_id, task.cpus)
+            commands << fdrCommand("${mzml_id}_consensus.idXML", task.cpus)
+        }
+        commands << idFilterCommand("${filter_in}.idXML", task.cpus)
      }
      """
-     CometAdapter  -in ${mzml_file} \\
-                   -out ${mzml_file.baseName}_comet.idXML \\
-                   -threads ${task.cpus} \\
-                   -database "${database}" \\
-                   -instrument ${inst} \\
-                   -missed_cleavages ${params.allowed_missed_cleavages} \\
-                   -num_hits ${params.num_hits} \\
-                   -num_enzyme_termini ${params.num_enzyme_termini} \\
-                   -enzyme "${enzyme}" \\
-                   -precursor_charge ${params.min_precursor_charge}:${params.max_precursor_charge} \\
-                   -fixed_modifications ${fixed.tokenize(',').collect { "'${it}'" }.join(" ") } \\
-                   -variable_modifications ${variable.tokenize(',').collect { "'${it}'" }.join(" ") } \\
-                   -max_variable_mods_in_peptide ${params.max_mods} \\
-                   -precursor_mass_tolerance ${prec_tol} \\
-                   -precursor_error_units ${prec_tol_unit} \\
-                   -fragment_mass_tolerance ${bin_tol} \\
-                   -fragment_bin_offset ${bin_offset} \\
-                   -debug ${params.db_debug} \\
-		   -force \\
-                   > ${mzml_file.baseName}_comet.log
+     ${commands.join('\n')}
      """
 }
 
+// Map the filtered ids of a batch back to their runs (names as built in post_search_batch)
+post_search_suffix = params.posterior_probabilities == "percolator" ? "_idx_feat_perc_switched_filter.idXML" : "_idx_fdr_idpep_switched_filter.idXML"
+id_filtered_batches
+  .flatMap{ runs, filtered ->
+      runs.collect{ mzml_id, enzyme, names ->
+          def name = names.size() == 1 ? names[0].take(names[0].lastIndexOf('.')) + post_search_suffix : "${mzml_id}_consensus_fdr_filter.idXML"
+          tuple(mzml_id, [filtered].flatten().find{ it.name == name })
+      }
+  }
+  .set{ id_filtered_fused }
 
 process index_peptides {
 
     label 'process_low'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
-     tuple mzml_id, file(id_file), val(enzyme), file(database) from id_files_msgf.mix(id_files_comet).combine(ch_sdrf_config.idx_settings, by: 0).combine(pepidx_in_db.mix(pepidx_in_db_decoy))
+     tuple mzml_id, file(id_file), val(enzyme), file(database) from id_files_post_search.single
 
     output:
      tuple mzml_id, file("${id_file.baseName}_idx.idXML") into id_files_idx_ForPerc, id_files_idx_ForIDPEP, id_files_idx_ForIDPEP_noFDR
      file "*.log"
 
     script:
-     def il = params.IL_equivalent ? '-IL_equivalent' : ''
-     def allow_um = params.allow_unmatched ? '-allow_unmatched' : ''
-     // see comment in CometAdapter. Alternative here in PeptideIndexer is to let it auto-detect the enzyme by not specifying.
-     if (params.search_engines.contains("msgf"))
-     {
-        if (enzyme == 'Trypsin') enzyme = 'Trypsin/P'
-        else if (enzyme == 'Arg-C') enzyme = 'Arg-C/P'
-        else if (enzyme == 'Asp-N') enzyme = 'Asp-N/B'
-        else if (enzyme == 'Chymotrypsin') enzyme = 'Chymotrypsin/P'
-        else if (enzyme == 'Lys-C') enzyme = 'Lys-C/P'
-     }
      """
-     PeptideIndexer -in ${id_file} \\
-                    -out ${id_file.baseName}_idx.idXML \\
-                    -threads ${task.cpus} \\
-                    -fasta ${database} \\
-                    -enzyme:name "${enzyme}" \\
-                    -enzyme:specificity ${pepidx_num_enzyme_termini} \\
-                    ${il} \\
-                    ${allow_um} \\
-                    > ${id_file.baseName}_index_peptides.log
+     ${peptideIndexerCommand(id_file, database, enzyme, task.cpus)}
      """
 }
 
@@ -695,13 +973,13 @@ process extract_percolator_features {
     label 'process_very_low'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
      tuple mzml_id, file(id_file) from id_files_idx_ForPerc
 
     output:
-     tuple mzml_id, file("${id_file.baseName}_feat.idXML") into id_files_idx_feat
+     tuple mzml_id, file("${id_file.baseName}_feat.idXML"), file("${id_file.baseName}_feat_stats.tsv") into id_files_idx_feat_stats
      file "*.log"
 
     when:
@@ -709,36 +987,44 @@ process extract_percolator_features {
 
     script:
      """
-     PSMFeatureExtractor -in ${id_file} \\
-                         -out ${id_file.baseName}_feat.idXML \\
-                         -threads ${task.cpus} \\
-                         > ${id_file.baseName}_extract_percolator_features.log
+     ${psmFeatureExtractorCommand(id_file, task.cpus)}
+     run_statistics.py --name ${id_file.baseName} --ids ${id_file.baseName}_feat.idXML > ${id_file.baseName}_feat_stats.tsv
      """
 }
 
+// The number of PSMs is used to size the Percolator tasks (see conf/base.config). It is recorded per search engine
+// result in `pipeline_info/percolator_statistics.tsv` to re-fit the resource model (see tools/resources).
+id_files_idx_feat_stats
+  .into{ id_files_idx_feat_stats_runs; id_files_idx_feat_stats_table }
+
+id_files_idx_feat_stats_table
+  .map{ id, f, stats -> stats }
+  .collectFile(name: 'percolator_statistics.tsv', keepHeader: true, skip: 1, storeDir: "${params.tracedir}")
+
+id_files_idx_feat_stats_runs
+  .map{ id, f, stats -> tuple(id, f, readRunStatistics(stats)[0].psms) }
+  .into{ id_files_idx_feat; id_files_idx_feat_study; id_files_idx_feat_names }
+
 
 //Note: from here, we do not need any settings anymore. so we can skip adding the mzml_id to the channels
-//TODO find a way to run across all runs merged
 process percolator {
 
-    //TODO Actually it heavily depends on the subset_max_train option and the number of IDs
-    // would be cool to get an estimate by parsing the number of IDs from previous tools.
+    // cpus and memory are estimated from the number of PSMs in conf/base.config
     label 'process_medium'
-    //Since percolator 3.5 it allows for 27 parallel tasks
-    cpus { check_max( 27, 'cpus' ) }
+    tag "${id_file.baseName}"
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/raw_ids", mode: 'copy', pattern: '*.idXML'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/raw_ids", mode: publishMode('raw_ids'), pattern: '*.idXML'
 
     input:
-     tuple mzml_id, file(id_file) from id_files_idx_feat
+     tuple mzml_id, file(id_file), val(n_psms) from id_files_idx_feat
 
     output:
-     tuple mzml_id, file("${id_file.baseName}_perc.idXML"), val("MS:1001491") into id_files_perc, id_files_perc_consID
+     tuple mzml_id, file("${id_file.baseName}_perc.idXML"), val("MS:1001491") into id_files_perc_run
      file "*.log"
 
     when:
-     params.posterior_probabilities == "percolator"
+     params.posterior_probabilities == "percolator" && !params.percolator_study_level
 
     // NICE-TO-HAVE: the decoy-pattern is automatically detected from PeptideIndexer.
     // Parse its output and put the correct one here.
@@ -748,22 +1034,78 @@ process percolator {
           log.warn('Klammer will be implicitly off!')
       }
 
-      // currently post-processing-tdc is always set since we do not support separate TD databases
       """
-      ## Percolator does not have a threads parameter. Set it via OpenMP env variable,
-      ## to honor threads on clusters
+      ${percolatorCommand(id_file, task.cpus)}
+      """
+}
+
+// Percolator on the pooled PSMs of all runs, one model per search engine. This gives the SVM more (decoy) training
+// examples for small runs and needs only one task per engine. The results are split by file origin into the same
+// per-run files as the per-run mode. This relies on IDMerger annotating and PercolatorAdapter keeping the file_origin
+// of every PSM, as in OpenMS 2.6 (see tests/test_percolator_study.py), which is checked by the number of split files.
+process percolator_study {
+
+    // cpus and memory are estimated from the number of PSMs in conf/base.config
+    label 'process_high'
+    tag "${engine}"
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/raw_ids", mode: publishMode('raw_ids'), pattern: '*_perc.idXML'
+
+    input:
+     tuple val(engine), file(id_files), val(n_psms) from id_files_idx_feat_study
+                                                     .map{ id, f, n -> tuple((f.name =~ /_([^_]+)_idx_feat\.idXML$/)[0][1], f, n) }
+                                                     .groupTuple()
+                                                     .map{ engine, files, n -> tuple(engine, files, n.sum()) }
+
+    output:
+     file("*_perc.idXML") into id_files_perc_study
+     file "*.log"
+
+    when:
+     params.posterior_probabilities == "percolator" && params.percolator_study_level
+
+    script:
+      """
+      IDMerger -in ${(id_files as List).join(' ')} \\
+               -out study_${engine}_merged.idXML \\
+               -annotate_file_origin \\
+               -merge_proteins_add_PSMs \\
+               -threads ${task.cpus} \\
+               > study_${engine}_percolator_merge.log
+
       OMP_NUM_THREADS=${task.cpus} PercolatorAdapter \\
-                          -in ${id_file} \\
-                          -out ${id_file.baseName}_perc.idXML \\
+                          -in study_${engine}_merged.idXML \\
+                          -out study_${engine}_percolator.idXML \\
                           -threads ${task.cpus} \\
                           -subset_max_train ${params.subset_max_train} \\
                           -decoy_pattern ${params.decoy_affix} \\
                           -post_processing_tdc \\
                           -score_type pep \\
-                          > ${id_file.baseName}_percolator.log
+                          > study_${engine}_percolator.log
+
+      mkdir ripped
+      IDRipper -in study_${engine}_percolator.idXML \\
+               -out_path ripped \\
+               > study_${engine}_percolator_split.log
+      n_ripped=\$(ls ripped/*.idXML | wc -l)
+      if [ "\$n_ripped" -ne ${(id_files as List).size()} ]; then
+        echo "IDRipper split the PSMs of ${(id_files as List).size()} runs into \$n_ripped files, their file origin was lost (requires OpenMS 2.6)." >&2
+        exit 1
+      fi
+      for f in ripped/*.idXML; do mv "\$f" "\$(basename "\$f" .idXML)_perc.idXML"; done
       """
 }
 
+// Map the per-run results of the study-level Percolator back to their mzML ids
+id_files_perc_study
+  .flatten()
+  .map{ f -> tuple(f.name - '_perc.idXML', f) }
+  .join(id_files_idx_feat_names.map{ id, f, n_psms -> tuple(f.baseName, id) })
+  .map{ name, f, id -> tuple(id, f, "MS:1001491") }
+  .mix(id_files_perc_run)
+  .into{ id_files_perc; id_files_perc_consID }
+
 // ---------------------------------------------------------------------
 // Branch b) Q-values and PEP from OpenMS
 
@@ -776,7 +1118,7 @@ process fdr_idpep {
     label 'process_very_low'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
      tuple mzml_id, file(id_file) from id_files_idx_ForIDPEP
@@ -790,13 +1132,7 @@ process fdr_idpep {
 
     script:
      """
-     FalseDiscoveryRate -in ${id_file} \\
-                        -out ${id_file.baseName}_fdr.idXML \\
-                        -threads ${task.cpus} \\
-                        -protein false \\
-                        -algorithm:add_decoy_peptides \\
-                        -algorithm:add_decoy_proteins \\
-                        > ${id_file.baseName}_fdr.log
+     ${fdrCommand(id_file, task.cpus)}
      """
 }
 
@@ -806,8 +1142,8 @@ process idpep {
     label 'process_low'
     // I think Eigen optimization is multi-threaded, so leave threads open
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/raw_ids", mode: 'copy', pattern: '*.idXML'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/raw_ids", mode: publishMode('raw_ids'), pattern: '*.idXML'
 
     input:
      tuple mzml_id, file(id_file) from id_files_idx_ForIDPEP_FDR.mix(id_files_idx_ForIDPEP_noFDR)
@@ -821,11 +1157,7 @@ process idpep {
 
     script:
      """
-     IDPosteriorErrorProbability    -in ${id_file} \\
-                                    -out ${id_file.baseName}_idpep.idXML \\
-                                    -fit_algorithm:outlier_handling ${params.outlier_handling} \\
-                                    -threads ${task.cpus} \\
-                                    > ${id_file.baseName}_idpep.log
+     ${idpepCommand(id_file, task.cpus)}
      """
 }
 
@@ -838,7 +1170,7 @@ process idscoreswitcher_to_qval {
     label 'process_very_low'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
      tuple mzml_id, file(id_file), val(qval_score) from id_files_idpep.mix(id_files_perc)
@@ -852,14 +1184,7 @@ process idscoreswitcher_to_qval {
 
     script:
      """
-     IDScoreSwitcher    -in ${id_file} \\
-                        -out ${id_file.baseName}_switched.idXML \\
-                        -threads ${task.cpus} \\
-                        -old_score "Posterior Error Probability" \\
-                        -new_score ${qval_score} \\
-                        -new_score_type q-value \\
-                        -new_score_orientation lower_better \\
-                        > ${id_file.baseName}_scoreswitcher_qval.log
+     ${scoreSwitcherCommand(id_file, qval_score, task.cpus)}
      """
 }
 
@@ -869,8 +1194,8 @@ process consensusid {
     //TODO could be easily parallelized
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/consensus_ids", mode: 'copy', pattern: '*.idXML'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/consensus_ids", mode: publishMode('consensus_ids'), pattern: '*.idXML'
 
     // we can drop qval_score in this branch since we have to recalculate FDR anyway
     input:
@@ -885,14 +1210,7 @@ process consensusid {
 
     script:
      """
-     ConsensusID -in ${id_files_from_ses} \\
-                        -out ${mzml_id}_consensus.idXML \\
-                        -per_spectrum \\
-                        -threads ${task.cpus} \\
-                        -algorithm ${params.consensusid_algorithm} \\
-                        -filter:min_support ${params.min_consensus_support} \\
-                        -filter:considered_hits ${params.consensusid_considered_top_hits} \\
-                        > ${mzml_id}_consensusID.log
+     ${consensusIDCommand(id_files_from_ses, mzml_id, task.cpus)}
      """
 
 }
@@ -902,8 +1220,8 @@ process fdr_consensusid {
     label 'process_medium'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/ids", mode: 'copy', pattern: '*.idXML'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/ids", mode: publishMode('ids'), pattern: '*.idXML'
 
     input:
      tuple mzml_id, file(id_file) from consensusids
@@ -917,13 +1235,7 @@ process fdr_consensusid {
 
     script:
      """
-     FalseDiscoveryRate -in ${id_file} \\
-                        -out ${id_file.baseName}_fdr.idXML \\
-                        -threads ${task.cpus} \\
-                        -protein false \\
-                        -algorithm:add_decoy_peptides \\
-                        -algorithm:add_decoy_proteins \\
-                        > ${id_file.baseName}_fdr.log
+     ${fdrCommand(id_file, task.cpus)}
      """
 
 }
@@ -933,26 +1245,26 @@ process idfilter {
     label 'process_very_low'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/ids", mode: 'copy', pattern: '*.idXML'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/ids", mode: publishMode('ids'), pattern: '*.idXML'
 
     input:
      tuple mzml_id, file(id_file) from id_files_noConsID_qval.mix(consensusids_fdr)
 
     output:
-     tuple mzml_id, file("${id_file.baseName}_filter.idXML") into id_filtered, id_filtered_luciphor
+     tuple mzml_id, file("${id_file.baseName}_filter.idXML") into id_filtered_single
      file "*.log"
 
     script:
      """
-     IDFilter -in ${id_file} \\
-                        -out ${id_file.baseName}_filter.idXML \\
-                        -threads ${task.cpus} \\
-                        -score:pep ${params.psm_pep_fdr_cutoff} \\
-                        > ${id_file.baseName}_idfilter.log
+     ${idFilterCommand(id_file, task.cpus)}
      """
 }
 
+id_filtered_single
+  .mix(id_filtered_fused)
+  .into{ id_filtered; id_filtered_luciphor }
+
 plfq_in_id = params.enable_mod_localization
                     ? Channel.empty()
                     : id_filtered
@@ -963,7 +1275,7 @@ process idscoreswitcher_for_luciphor {
     label 'process_very_low'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
      tuple mzml_id, file(id_file) from id_filtered_luciphor
@@ -989,17 +1301,53 @@ process idscoreswitcher_for_luciphor {
      """
 }
 
+// With --luciphor_shard_size, the PSMs of a run are localized in shards that run in parallel and are merged afterwards
+mzmls_luciphor.join(id_filtered_luciphor_pep).join(ch_sdrf_config.luciphor_settings)
+  .branch {
+      shard: params.luciphor_shard_size > 0
+      run: true
+  }
+  .set{ luciphor_input }
+
+// The spectra of all PSMs are copied once into a small indexed mzML that is used by all shards of the run
+process luciphor_split {
+
+    label 'process_very_low'
+    label 'process_single_thread'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+
+    input:
+     tuple mzml_id, file(mzml_file), file(id_file), frag_method from luciphor_input.shard
+
+    output:
+     tuple mzml_id, file("${mzml_file.baseName}_psm_spectra.mzML"), file("shards/*.idXML"), frag_method into luciphor_shards
+     file "*.log"
+
+    when:
+     params.enable_mod_localization && params.luciphor_shard_size > 0
+
+    script:
+     """
+     shard_idxml.py split ${id_file} shards \\
+                    --shard_size ${params.luciphor_shard_size} \\
+                    --mzml ${mzml_file} \\
+                    --spectra_out ${mzml_file.baseName}_psm_spectra.mzML \\
+                    > ${id_file.baseName}_luciphor_split.log
+     """
+}
+
 process luciphor {
 
     label 'process_medium'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
 
     input:
-     tuple mzml_id, file(mzml_file), file(id_file), frag_method from mzmls_luciphor.join(id_filtered_luciphor_pep).join(ch_sdrf_config.luciphor_settings)
+     tuple mzml_id, file(mzml_file), file(id_file), frag_method from luciphor_input.run.mix(luciphor_shards.flatMap{ id, spectra, shards, frag_method -> [shards].flatten().collect{ tuple(id, spectra, it, frag_method) } })
 
     output:
-     set mzml_id, file("${id_file.baseName}_luciphor.idXML") into plfq_in_id_luciphor
+     set mzml_id, file("${id_file.baseName}_luciphor.idXML") into luciphor_out
      file "*.log"
 
     when:
@@ -1029,6 +1377,44 @@ process luciphor {
                      //   -fragment_error_units ${} \\
 }
 
+// Shard results are grouped per run and emitted as soon as all shards of the run (number encoded in the names) are done
+luciphor_out
+  .branch{ mzml_id, id_file ->
+      shard: id_file.name =~ /_shard\d+of\d+_luciphor\.idXML$/
+      run: true
+  }
+  .set{ luciphor_results }
+
+process luciphor_merge {
+
+    label 'process_very_low'
+    label 'process_single_thread'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+
+    input:
+     tuple mzml_id, file(id_files), val(merged_name) from luciphor_results.shard
+                                                     .map{ id, f -> tuple(groupKey(id, (f.name =~ /_shard\d+of(\d+)_/)[0][1] as int), f) }
+                                                     .groupTuple()
+                                                     .map{ key, files -> tuple(key.getGroupTarget(), files, files[0].name.replaceAll(/_shard\d+of\d+/, '')) }
+
+    output:
+     tuple mzml_id, file("${merged_name}") into luciphor_merged
+     file "*.log"
+
+    when:
+     params.enable_mod_localization && params.luciphor_shard_size > 0
+
+    script:
+     """
+     shard_idxml.py merge ${merged_name} ${id_files} > ${merged_name.take(merged_name.lastIndexOf('.'))}_merge_shards.log
+     """
+}
+
+luciphor_results.run
+  .mix(luciphor_merged)
+  .set{ plfq_in_id_luciphor }
+
 // Join mzmls and ids by UID specified per mzml file in the beginning.
 // ID files can come directly from the Percolator branch, IDPEP branch or
 // after optional processing with Luciphor
@@ -1037,27 +1423,88 @@ mzmls_plfq.mix(mzmls_plfq_picked)
   .multiMap{ it ->
       mzmls: it[1]
       ids: it[2]
+      stats: it
+      features: it
+      linking_ids: it[2]
   }
   .set{ch_plfq}
 
+// With --per_run_feature_detection, features are detected per run as soon as its IDs are final and
+// only alignment, linking, inference and quantification run on the whole study (instead of ProteomicsLFQ)
+quant_per_run = params.per_run_feature_detection
+if (quant_per_run && params.quantification_method != "feature_intensity") {
+  log.warn "--per_run_feature_detection is ignored with --quantification_method ${params.quantification_method}, ProteomicsLFQ is used."
+  quant_per_run = false
+}
+if (quant_per_run) {
+  [psm_pep_fdr_for_quant: null, protein_quant: 'unique_peptides', transfer_ids: 'false', mass_recalibration: 'false'].each{ name, default_value ->
+    if (params[name] != null && params[name].toString() != default_value) {
+      log.warn "--${name} is ignored with --per_run_feature_detection, it is only supported by ProteomicsLFQ."
+    }
+  }
+  // PTXQC and the QC metrics read the PSM section and columns of the mzTab of ProteomicsLFQ, the mzTab of
+  // ProteinQuantifier only holds the PSMs of the linked features
+  ['enable_qc', 'enable_qc_metrics'].findAll{ params[it] }.each{ name ->
+    log.warn "--${name} is skipped with --per_run_feature_detection, it needs the mzTab of ProteomicsLFQ."
+  }
+}
+
+// Records the size of the input data per run. Besides reporting, the totals are used to size the
+// quantification task (see conf/base.config) and can be used to re-fit the resource model.
+process run_statistics {
+
+    label 'process_very_low'
+    label 'process_single_thread'
+
+    input:
+     tuple mzml_id, file(mzml_file), file(id_file) from ch_plfq.stats
+
+    output:
+     file "${id_file.baseName}_stats.tsv" into ch_run_statistics
+
+    script:
+     // the MS2 spectra are only needed for the ID rate of the QC metrics
+     def count_ms2 = params.enable_qc_metrics ? '--count_ms2' : ''
+     """
+     run_statistics.py --name ${mzml_id} --mzml ${mzml_file} --ids ${id_file} ${count_ms2} > ${id_file.baseName}_stats.tsv
+     """
+}
+
+ch_run_statistics
+  .collectFile(name: 'run_statistics.tsv', keepHeader: true, skip: 1, storeDir: "${params.tracedir}")
+  .into{ ch_run_statistics_table; ch_run_statistics_qc }
+
+ch_run_statistics_table
+  .map{ stats ->
+        def runs = readRunStatistics(stats)
+        [ runs: runs.size(),
+          spectra: runs.sum{ it.spectra },
+          psms: runs.sum{ it.psms },
+          max_mzml_bytes: runs.collect{ it.mzml_bytes }.max() ] }
+  .set{ ch_plfq_run_statistics }
+
+ch_expdesign.into{ ch_expdesign_plfq; ch_expdesign_linking }
+
 process proteomicslfq {
 
     label 'process_high'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/proteomics_lfq", mode: 'copy'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/proteomics_lfq", mode: publishMode('proteomics_lfq')
 
     ///.toSortedList({ a, b -> b.baseName <=> a.baseName })
     input:
      file(mzmls) from ch_plfq.mzmls.collect()
      file(id_files) from ch_plfq.ids.collect()
-     file expdes from ch_expdesign
+     file expdes from ch_expdesign_plfq
      file fasta from plfq_in_db.mix(plfq_in_db_decoy)
+     // only used to estimate resources
+     val run_stats from ch_plfq_run_statistics
 
     output:
-     file "out.mzTab" into out_mztab_plfq, out_mztab_msstats
-     file "out.consensusXML" into out_consensusXML
-     file "out.csv" optional true into out_msstats
+     file "out.mzTab" into out_mztab_lfq
+     file "out.consensusXML" into out_consensusXML_lfq
+     file "out.csv" optional true into out_msstats_lfq
      file "debug_mergedIDs.idXML" optional true
      file "debug_mergedIDs_inference.idXML" optional true
      file "debug_mergedIDsGreedyResolved.idXML" optional true
@@ -1066,6 +1513,9 @@ process proteomicslfq {
      file "debug_mergedIDsFDRFilteredStrictlyUniqueResolved.idXML" optional true
      file "*.log"
 
+    when:
+     !quant_per_run
+
     script:
      def msstats_present = params.quantification_method == "feature_intensity" ? '-out_msstats out.csv' : ''
      """
@@ -1091,6 +1541,125 @@ process proteomicslfq {
 }
 
 
+process feature_detection {
+
+    label 'process_medium'
+    tag "${mzml_id}"
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+
+    input:
+     tuple mzml_id, file(mzml_file), file(id_file) from ch_plfq.features
+
+    output:
+     file "${mzml_file.baseName}.featureXML" into ch_features
+     file "*.log"
+
+    when:
+     quant_per_run
+
+    script:
+     """
+     FeatureFinderIdentification -in ${mzml_file} \\
+                                 -id ${id_file} \\
+                                 -out ${mzml_file.baseName}.featureXML \\
+                                 -threads ${task.cpus} \\
+                                 > ${mzml_file.baseName}_feature_detection.log
+     """
+}
+
+
+process feature_linking {
+
+    label 'process_high'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/proteomics_lfq", mode: publishMode('proteomics_lfq'), pattern: 'out.*'
+
+    input:
+     // sorted by name, so that the inputs and the results are the same for every order of completion
+     file(features) from ch_features.toSortedList({ a, b -> a.name <=> b.name })
+     file(id_files) from ch_plfq.linking_ids.toSortedList({ a, b -> a.name <=> b.name })
+     file expdes from ch_expdesign_linking
+
+    output:
+     file "out.mzTab" into out_mztab_linked
+     file "out.consensusXML" into out_consensusXML_linked
+     file "out.csv" into out_msstats_linked
+     file "*.log"
+
+    when:
+     quant_per_run
+
+    script:
+     def aligned = (features as List).collect{ "aligned/${it.name}" }.join(' ')
+     def inference = params.protein_inference == "bayesian" ? "Epifany" : "ProteinInference"
+     """
+     mkdir aligned
+     MapAlignerIdentification -in ${(features as List).join(' ')} \\
+                              -out ${aligned} \\
+                              -threads ${task.cpus} \\
+                              > feature_linking_alignment.log
+     FeatureLinkerUnlabeledKD -in ${aligned} \\
+                              -design ${expdes} \\
+                              -out linked.consensusXML \\
+                              -threads ${task.cpus} \\
+                              > feature_linking_linker.log
+     IDConflictResolver -in linked.consensusXML \\
+                        -out resolved.consensusXML \\
+                        -threads ${task.cpus} \\
+                        > feature_linking_conflict_resolution.log
+     IDMerger -in ${(id_files as List).join(' ')} \\
+              -annotate_file_origin \\
+              -merge_proteins_add_PSMs \\
+              -out merged.idXML \\
+              -threads ${task.cpus} \\
+              > feature_linking_merge_ids.log
+     ${inference} -in merged.idXML \\
+                  -out inference.idXML \\
+                  -threads ${task.cpus} \\
+                  > feature_linking_inference.log
+     FalseDiscoveryRate -in inference.idXML \\
+                        -out inference_fdr.idXML \\
+                        -protein true \\
+                        -PSM false \\
+                        -threads ${task.cpus} \\
+                        > feature_linking_protein_fdr.log
+     IDFilter -in inference_fdr.idXML \\
+              -out inference_filtered.idXML \\
+              -score:prot ${params.protein_level_fdr_cutoff} \\
+              -remove_decoys \\
+              -delete_unreferenced_peptide_hits \\
+              -threads ${task.cpus} \\
+              > feature_linking_protein_filter.log
+     # only the features with peptides of the proteins that pass the protein FDR are quantified and exported
+     mapfile -t accessions < <(sed -n 's/.*<ProteinHit [^>]*accession="\\([^"]*\\)".*/\\1/p' inference_filtered.idXML)
+     FileFilter -in resolved.consensusXML \\
+                -out out.consensusXML \\
+                -id:accessions_whitelist "\${accessions[@]}" \\
+                -id:remove_unassigned_ids \\
+                -id:remove_unannotated_features \\
+                > feature_linking_filter.log
+     ProteinQuantifier -in out.consensusXML \\
+                       -protein_groups inference_filtered.idXML \\
+                       -design ${expdes} \\
+                       -out out_proteins.tsv \\
+                       -mztab out.mzTab \\
+                       -threads ${task.cpus} \\
+                       > feature_linking_quantification.log
+     MSstatsConverter -in out.consensusXML \\
+                      -in_design ${expdes} \\
+                      -method LFQ \\
+                      -out out.csv \\
+                      > feature_linking_msstats_export.log
+     """
+}
+
+out_mztab_lfq.mix(out_mztab_linked).into{ out_mztab_plfq; out_mztab_msstats; out_mztab_parquet; out_mztab_qc }
+out_consensusXML_lfq.mix(out_consensusXML_linked).set{ out_consensusXML }
+out_msstats_lfq.mix(out_msstats_linked).into{ out_msstats; out_msstats_parquet }
+
+
 // TODO the script supports a control condition as third argument
 // TODO the second argument can be "pairwise" or TODO later a user defined contrast string
 
@@ -1098,8 +1667,8 @@ process msstats {
 
     label 'process_medium'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/msstats", mode: 'copy'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/msstats", mode: publishMode('msstats')
 
     when:
      !params.skip_post_msstats && params.quantification_method == "feature_intensity"
@@ -1118,7 +1687,37 @@ process msstats {
 
     script:
      """
-     msstats_plfq.R ${csv} ${mztab} > msstats.log || echo "Optional MSstats step failed. Please check logs and re-run or do a manual statistical analysis."
+     msstats_plfq.R ${csv} ${mztab} pairwise "" msstats ${task.cpus} > msstats.log || echo "Optional MSstats step failed. Please check logs and re-run or do a manual statistical analysis."
+     """
+}
+
+process parquet_export {
+
+    label 'process_low'
+    label 'process_single_thread'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/proteomics_lfq", mode: publishMode('proteomics_lfq'), pattern: 'parquet'
+
+    when:
+     params.export_parquet
+
+    input:
+     file mztab from out_mztab_parquet
+     // the MSstats table is only available for feature_intensity quantification
+     file csv from out_msstats_parquet.ifEmpty([])
+
+    output:
+     file "parquet"
+     file "*.log"
+
+    script:
+     def msstats_table = csv ? "--csv ${csv}" : ''
+     """
+     mztab_to_parquet.py parquet \\
+                         --mztab ${mztab} \\
+                         ${msstats_table} \\
+                         > parquet_export.log
      """
 }
 
@@ -1129,11 +1728,11 @@ process ptxqc {
     label 'process_low'
     label 'process_single_thread'
 
-    publishDir "${params.outdir}/logs", mode: 'copy', pattern: '*.log'
-    publishDir "${params.outdir}/ptxqc", mode: 'copy'
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/ptxqc", mode: publishMode('ptxqc')
 
     when:
-     params.enable_qc
+     params.enable_qc && !quant_per_run
 
     input:
      file mzTab from out_mztab_plfq
@@ -1151,12 +1750,46 @@ process ptxqc {
      """
 }
 
-if (!params.enable_qc)
+if (!params.enable_qc || quant_per_run)
 {
   ch_ptxqc_report = Channel.empty()
 }
 
 
+// Fast QC metrics computed while streaming the mzTab once (PTXQC stays available with --enable_qc)
+process qc_metrics {
+
+    label 'process_very_low'
+    label 'process_single_thread'
+
+    publishDir "${params.outdir}/logs", mode: publishMode('logs'), pattern: '*.log'
+    publishDir "${params.outdir}/qc_metrics", mode: publishMode('qc_metrics'), pattern: 'qc_metrics.*'
+
+    when:
+     params.enable_qc_metrics && !quant_per_run
+
+    input:
+     file mztab from out_mztab_qc
+     file run_stats from ch_run_statistics_qc
+
+    output:
+     file "qc_metrics.json"
+     file "qc_metrics.tsv"
+     file "qc_metrics.html"
+     file "*.log"
+
+    script:
+     """
+     mztab_qc.py --mztab ${mztab} \\
+                 --run_statistics ${run_stats} \\
+                 --enzyme "${params.enzyme}" \\
+                 --contaminant_regex "${params.contaminant_regex}" \\
+                 --out_prefix qc_metrics \\
+                 > qc_metrics.log
+     """
+}
+
+
 //--------------------------------------------------------------- //
 //---------------------- Nextflow specifics --------------------- //
 //--------------------------------------------------------------- //
@@ -1213,13 +1846,33 @@ Channel.from(summary.collect{ [it.key, it.value] })
 /*
  * Parse software version numbers
  */
+// The tool versions only depend on the software environment. They are resolved once per environment and kept
+// in the work directory, so that later executions do not have to start the tools again. The environment is
+// identified on the head node by the container (or pipeline version), the profile and the conda environment file.
+tool_environment_key = [tool_version_tag, workflow.profile, file("${baseDir}/environment.yml").text].join('_').md5()
+
+process get_tool_versions {
+    storeDir "${workflow.workDir}/.tool_versions/${tool_environment_key}"
+
+    output:
+    file "tool_versions.tsv" into ch_tool_versions
+
+    script:
+    """
+    scrape_software_versions.py probe tool_versions.tsv
+    """
+}
+
 process get_software_versions {
-    publishDir "${params.outdir}/pipeline_info", mode: params.publish_dir_mode,
+    publishDir "${params.outdir}/pipeline_info", mode: publishMode('pipeline_info'),
         saveAs: { filename ->
                       if (filename.indexOf(".csv") > 0) filename
                       else null
                 }
 
+    input:
+    file tool_versions from ch_tool_versions
+
     output:
     file 'software_versions_mqc.yaml' into ch_software_versions_yaml
     file "software_versions.csv"
@@ -1228,24 +1881,8 @@ process get_software_versions {
     """
     echo $workflow.manifest.version > v_pipeline.txt
     echo $workflow.nextflow.version > v_nextflow.txt
-    ThermoRawFileParser.sh --version &> v_thermorawfileparser.txt
-    echo \$(FileConverter 2>&1) > v_fileconverter.txt || true
-    echo \$(DecoyDatabase 2>&1) > v_decoydatabase.txt || true
-    echo \$(MSGFPlusAdapter 2>&1) > v_msgfplusadapter.txt || true
-    echo \$(msgf_plus 2>&1) > v_msgfplus.txt || true
-    echo \$(CometAdapter 2>&1) > v_cometadapter.txt || true
-    echo \$(comet 2>&1) > v_comet.txt || true
-    echo \$(PeptideIndexer 2>&1) > v_peptideindexer.txt || true
-    echo \$(PSMFeatureExtractor 2>&1) > v_psmfeatureextractor.txt || true
-    echo \$(PercolatorAdapter 2>&1) > v_percolatoradapter.txt || true
-    percolator -h &> v_percolator.txt
-    echo \$(IDFilter 2>&1) > v_idfilter.txt || true
-    echo \$(IDScoreSwitcher 2>&1) > v_idscoreswitcher.txt || true
-    echo \$(FalseDiscoveryRate 2>&1) > v_falsediscoveryrate.txt || true
-    echo \$(IDPosteriorErrorProbability 2>&1) > v_idposteriorerrorprobability.txt || true
-    echo \$(ProteomicsLFQ 2>&1) > v_proteomicslfq.txt || true
     echo $workflow.manifest.version &> v_msstats_plfq.txt
-    scrape_software_versions.py &> software_versions_mqc.yaml
+    scrape_software_versions.py report --tool_versions ${tool_versions} &> software_versions_mqc.yaml
     """
 }
 
@@ -1253,7 +1890,7 @@ process get_software_versions {
  * STEP 3 - Output Description HTML
  */
 process output_documentation {
-    publishDir "${params.outdir}/pipeline_info", mode: params.publish_dir_mode
+    publishDir "${params.outdir}/pipeline_info", mode: publishMode('pipeline_info')
 
     input:
     file output_docs from ch_output_docs
@@ -1448,3 +2085,341 @@ def hasExtension(it, extension) {
 boolean isCollectionOrArray(object) {
     [Collection, Object[]].any { it.isAssignableFrom(object.getClass()) }
 }
+
+// Mode for publishing into an output folder: --publish_dir_mode, unless overridden for the folder in
+// --publish_dir_mode_overrides (e.g. 'logs:copy,raw_ids:symlink')
+def publishMode(folder) {
+    return publish_dir_mode_overrides.get(folder, params.publish_dir_mode)
+}
+
+// The loosest cutting rules of an enzyme as used by MSGF
+def looseEnzyme(enzyme) {
+    def loose = ['Trypsin': 'Trypsin/P', 'Arg-C': 'Arg-C/P', 'Asp-N': 'Asp-N/B', 'Chymotrypsin': 'Chymotrypsin/P', 'Lys-C': 'Lys-C/P']
+    return loose.get(enzyme, enzyme)
+}
+
+// Enzyme name for Comet and PeptideIndexer. For consensusID the cutting rules need to be the same. So we adapt to
+// the loosest rules from MSGF if it is used. Alternative in PeptideIndexer is to let it auto-detect the enzyme by not specifying.
+// TODO find another solution. In ProteomicsLFQ we re-run PeptideIndexer (remove??) and if we
+// e.g. add XTandem, after running ConsensusID it will lose the auto-detection ability for the
+// XTandem specific rules.
+def searchEnzyme(enzyme) {
+    return params.search_engines.contains("msgf") ? looseEnzyme(enzyme) : enzyme
+}
+
+// MS-GF+ instrument type from the fragment mass tolerance, unless given explicitly
+def msgfInstrument(frag_tol, frag_tol_unit) {
+    if ((frag_tol.toDouble() < 50 && frag_tol_unit == "ppm") || (frag_tol.toDouble() < 0.1 && frag_tol_unit == "Da")) {
+        return params.instrument ?: "high_res"
+    }
+    return params.instrument ?: "low_res"
+}
+
+// Fragment bin tolerance, bin offset and instrument type for Comet from the fragment mass tolerance
+def cometFragmentSettings(frag_tol, frag_tol_unit) {
+    if (frag_tol_unit == "ppm") {
+        // Note: This uses an arbitrary rule to decide if it was hi-res or low-res
+        // and uses Comet's defaults for bin size (i.e. by passing 0.5*default to the Adapter), in case unsupported unit "ppm" was given.
+        def (bin_tol, bin_offset, inst) = frag_tol.toDouble() < 50 ?
+            [0.015, 0.0, params.instrument ?: "high_res"] :
+            [0.50025, 0.4, params.instrument ?: "low_res"]
+        log.warn "The chosen search engine Comet does not support ppm fragment tolerances. We guessed a " + inst +
+          " instrument and set the fragment_bin_tolerance to " + bin_tol
+        return [bin_tol, bin_offset, inst]
+    }
+    //TODO expose the fragment_bin_offset parameter of comet
+    def bin_tol = frag_tol.toDouble()
+    return [bin_tol, bin_tol <= 0.05 ? 0.0 : 0.4, params.instrument ?: (bin_tol <= 0.05 ? "high_res" : "low_res")]
+}
+
+// Commands of the search engines, shared by their single processes and search_engines_fused
+def msgfCommand(mzml_file, database, fixed, variable, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, enzyme, threads, java_memory) {
+    """
+    MSGFPlusAdapter -in ${mzml_file} \\
+                    -out ${mzml_file.baseName}_msgf.idXML \\
+                    -threads ${threads} \\
+                    -java_memory ${java_memory} \\
+                    -database "${database}" \\
+                    -instrument ${msgfInstrument(frag_tol, frag_tol_unit)} \\
+                    -protocol "${params.protocol}" \\
+                    -matches_per_spec ${params.num_hits} \\
+                    -min_precursor_charge ${params.min_precursor_charge} \\
+                    -max_precursor_charge ${params.max_precursor_charge} \\
+                    -min_peptide_length ${params.min_peptide_length} \\
+                    -max_peptide_length ${params.max_peptide_length} \\
+                    -enzyme "${looseEnzyme(enzyme)}" \\
+                    -tryptic ${params.num_enzyme_termini} \\
+                    -precursor_mass_tolerance ${prec_tol} \\
+                    -precursor_error_units ${prec_tol_unit} \\
+                    -fixed_modifications ${fixed.tokenize(',').collect { "'${it}'" }.join(" ") } \\
+                    -variable_modifications ${variable.tokenize(',').collect { "'${it}'" }.join(" ") } \\
+                    -max_mods ${params.max_mods} \\
+                    -debug ${params.db_debug} \\
+                    > ${mzml_file.baseName}_msgf.log
+    """.trim()
+}
+
+//TODO we currently ignore the activation_method param to leave the default "ALL" for max. compatibility
+//Note: OpenMS CometAdapter will double the number that is passed to fragment_mass_tolerance to "convert"
+// it to a fragment_bin_tolerance
+def cometCommand(mzml_file, database, fixed, variable, prec_tol, prec_tol_unit, frag_tol, frag_tol_unit, enzyme, threads) {
+    def (bin_tol, bin_offset, inst) = cometFragmentSettings(frag_tol, frag_tol_unit)
+    """
+    CometAdapter -in ${mzml_file} \\
+                 -out ${mzml_file.baseName}_comet.idXML \\
+                 -threads ${threads} \\
+                 -database "${database}" \\
+                 -instrument ${inst} \\
+                 -missed_cleavages ${params.allowed_missed_cleavages} \\
+                 -num_hits ${params.num_hits} \\
+                 -num_enzyme_termini ${params.num_enzyme_termini} \\
+                 -enzyme "${searchEnzyme(enzyme)}" \\
+                 -precursor_charge ${params.min_precursor_charge}:${params.max_precursor_charge} \\
+                 -fixed_modifications ${fixed.tokenize(',').collect { "'${it}'" }.join(" ") } \\
+                 -variable_modifications ${variable.tokenize(',').collect { "'${it}'" }.join(" ") } \\
+                 -max_variable_mods_in_peptide ${params.max_mods} \\
+                 -precursor_mass_tolerance ${prec_tol} \\
+                 -precursor_error_units ${prec_tol_unit} \\
+                 -fragment_mass_tolerance ${bin_tol} \\
+                 -fragment_bin_offset ${bin_offset} \\
+                 -debug ${params.db_debug} \\
+                 -force \\
+                 > ${mzml_file.baseName}_comet.log
+    """.trim()
+}
+
+// Commands of the steps after the search, shared by the per-run processes and post_search_batch. Every command
+// reads an idXML (file or name) and writes <basename>_<step>.idXML and a log named after the same basename.
+def idBaseName(id_file) {
+    def name = id_file instanceof java.nio.file.Path ? id_file.name : id_file.toString()
+    return name.take(name.lastIndexOf('.'))
+}
+
+def peptideIndexerCommand(id_file, database, enzyme, threads) {
+    def base = idBaseName(id_file)
+    """
+    PeptideIndexer -in ${id_file} \\
+                   -out ${base}_idx.idXML \\
+                   -threads ${threads} \\
+                   -fasta ${database} \\
+                   -enzyme:name "${searchEnzyme(enzyme)}" \\
+                   -enzyme:specificity ${pepidx_num_enzyme_termini} \\
+                   ${params.IL_equivalent ? '-IL_equivalent' : ''} \\
+                   ${params.allow_unmatched ? '-allow_unmatched' : ''} \\
+                   > ${base}_index_peptides.log
+    """
+}
+
+def psmFeatureExtractorCommand(id_file, threads) {
+    def base = idBaseName(id_file)
+    """
+    PSMFeatureExtractor -in ${id_file} \\
+                        -out ${base}_feat.idXML \\
+                        -threads ${threads} \\
+                        > ${base}_extract_percolator_features.log
+    """
+}
+
+// currently post-processing-tdc is always set since we do not support separate TD databases
+def percolatorCommand(id_file, threads) {
+    def base = idBaseName(id_file)
+    """
+    ## Percolator does not have a threads parameter. Set it via OpenMP env variable,
+    ## to honor threads on clusters
+    OMP_NUM_THREADS=${threads} PercolatorAdapter \\
+                        -in ${id_file} \\
+                        -out ${base}_perc.idXML \\
+                        -threads ${threads} \\
+                        -subset_max_train ${params.subset_max_train} \\
+                        -decoy_pattern ${params.decoy_affix} \\
+                        -post_processing_tdc \\
+                        -score_type pep \\
+                        > ${base}_percolator.log
+    """
+}
+
+def fdrCommand(id_file, threads) {
+    def base = idBaseName(id_file)
+    """
+    FalseDiscoveryRate -in ${id_file} \\
+                       -out ${base}_fdr.idXML \\
+                       -threads ${threads} \\
+                       -protein false \\
+                       -algorithm:add_decoy_peptides \\
+                       -algorithm:add_decoy_proteins \\
+                       > ${base}_fdr.log
+    """
+}
+
+def idpepCommand(id_file, threads) {
+    def base = idBaseName(id_file)
+    """
+    IDPosteriorErrorProbability -in ${id_file} \\
+                                -out ${base}_idpep.idXML \\
+                                -fit_algorithm:outlier_handling ${params.outlier_handling} \\
+                                -threads ${threads} \\
+                                > ${base}_idpep.log
+    """
+}
+
+def scoreSwitcherCommand(id_file, qval_score, threads) {
+    def base = idBaseName(id_file)
+    """
+    IDScoreSwitcher -in ${id_file} \\
+                    -out ${base}_switched.idXML \\
+                    -threads ${threads} \\
+                    -old_score "Posterior Error Probability" \\
+                    -new_score ${qval_score} \\
+                    -new_score_type q-value \\
+                    -new_score_orientation lower_better \\
+                    > ${base}_scoreswitcher_qval.log
+    """
+}
+
+// writes <mzml_id>_consensus.idXML
+def consensusIDCommand(id_files, mzml_id, threads) {
+    """
+    ConsensusID -in ${(id_files as List).join(' ')} \\
+                -out ${mzml_id}_consensus.idXML \\
+                -per_spectrum \\
+                -threads ${threads} \\
+                -algorithm ${params.consensusid_algorithm} \\
+                -filter:min_support ${params.min_consensus_support} \\
+                -filter:considered_hits ${params.consensusid_considered_top_hits} \\
+                > ${mzml_id}_consensusID.log
+    """
+}
+
+def idFilterCommand(id_file, threads) {
+    def base = idBaseName(id_file)
+    """
+    IDFilter -in ${id_file} \\
+             -out ${base}_filter.idXML \\
+             -threads ${threads} \\
+             -score:pep ${params.psm_pep_fdr_cutoff} \\
+             > ${base}_idfilter.log
+    """
+}
+
+// Read the rows of a run statistics table (see bin/run_statistics.py) into maps. Counts are converted to numbers.
+def readRunStatistics(stats_file) {
+    def lines = stats_file.readLines().findAll{ it }
+    def header = lines[0].split('\t')
+    return lines.drop(1).collect{ line ->
+        [header, line.split('\t')].transpose().collectEntries{ k, v -> [k, v.isLong() ? v as long : v] }
+    }
+}
+
+// Check if an mzML is indexed, i.e. wrapped in <indexedmzML> and the <indexListOffset> at the end of the file
+// points to the <indexList>. Only the head and the tail of the file are read. Truncated or otherwise broken
+// indexes count as not indexed, so that the file gets re-indexed.
+def isIndexedMzML(path) {
+    def size = path.size()
+    def channel
+    try {
+        channel = java.nio.file.Files.newByteChannel(path)
+    } catch (UnsupportedOperationException e) {
+        // no random access (e.g. some remote file systems): only look at the header
+        return path.withReader { reader -> (1..5).any { reader.readLine()?.contains("indexedmzML") } }
+    }
+    try {
+        if (!readFileRange(channel, 0, (int) Math.min(size, 4096)).contains("<indexedmzML")) return false
+        def tail = readFileRange(channel, Math.max(0, size - 4096), (int) Math.min(size, 4096))
+        def match = tail =~ /<indexListOffset>\s*(\d+)\s*<\/indexListOffset>/
+        if (!match.find()) return false
+        def offset = match.group(1) as long
+        // writers may let the offset point to the whitespace before the element
+        return offset < size && readFileRange(channel, offset, 256).replaceFirst(/^\s+/, '').startsWith("<indexList")
+    } finally {
+        channel.close()
+    }
+}
+
+// Read length bytes starting at position from a seekable channel
+def readFileRange(channel, long position, int length) {
+    def buffer = java.nio.ByteBuffer.allocate(length)
+    channel.position(position)
+    while (buffer.hasRemaining() && channel.read(buffer) > 0) {}
+    return new String(buffer.array(), 0, buffer.position(), "ISO-8859-1")
+}
+
+// Location of the spectra file of a row of the converted SDRF (openms.tsv): its URI or, with --root_folder,
+// the file name in that folder (with the extension replaced by --local_input_type)
+def sdrfSpectraPath(row) {
+    if (!params.root_folder) return row.URI
+    return params.root_folder + "/" + (params.local_input_type ?
+                                           row.Filename.take(row.Filename.lastIndexOf('.')) + '.' + params.local_input_type :
+                                           row.Filename)
+}
+
+// Returns the given files that do not exist. The checks run in parallel since every check of a remote
+// file (e.g. an FTP or HTTP URI) takes at least one round trip.
+def missingFiles(paths, threads = 16) {
+    def pool = java.util.concurrent.Executors.newFixedThreadPool(threads)
+    try {
+        def checks = paths.collect{ path -> pool.submit({ file(path).exists() ? null : path } as java.util.concurrent.Callable) }
+        return checks.collect{ it.get() }.findAll{ it }
+    } finally {
+        pool.shutdown()
+    }
+}
+
+// Keys of the conversion cache for raw files. A key is derived from the name, size and modification time of the file.
+// If a conversion is stored under it, the checksum of the raw file is compared with the one of the conversion, and a
+// different file is keyed by its checksum instead. The checksums of the hits are computed in parallel.
+def rawConversionKeys(raws, threads = 16) {
+    def pool = java.util.concurrent.Executors.newFixedThreadPool(threads)
+    try {
+        def keys = raws.collect{ raw -> pool.submit({
+            def key = [raw.name, raw.size(), raw.lastModified(), tool_version_tag].join('_').md5()
+            def stored = file("${params.conversion_cache}/raw_conversion/${key}/raw.md5")
+            if (!stored.exists()) return key
+            def checksum = cachedFileValue(raw_checksum_cache, raw_checksum_cache_file, raw){ fileChecksum(it) }
+            return stored.text.trim() == checksum ? key : [checksum, tool_version_tag].join('_').md5()
+        } as java.util.concurrent.Callable) }
+        return keys.collect{ it.get() }
+    } finally {
+        pool.shutdown()
+    }
+}
+
+// Read a cache of values of files (see cachedFileValue), keyed by path, size and modification time
+def readFileCache(cache_file) {
+    def cache = new java.util.concurrent.ConcurrentHashMap()
+    if (cache_file.exists()) {
+        cache_file.eachLine { line ->
+            def fields = line.split('\t')
+            if (fields.size() == 4) cache[fields[0..2].join('\t')] = fields[3]
+        }
+    }
+    return cache
+}
+
+// Value computed by compute(path), memoised by path, size and modification time of the file. New values are appended
+// to the cache file, unless it is not on the local file system (e.g. an object store that does not support appends).
+def cachedFileValue(cache, cache_file, path, Closure compute) {
+    def key = [path.toUriString(), path.size(), path.lastModified()].join('\t')
+    if (!cache.containsKey(key)) {
+        cache[key] = compute(path).toString()
+        if (cache_file.fileSystem == java.nio.file.FileSystems.default) {
+            synchronized (cache) {
+                cache_file.parent.mkdirs()
+                cache_file << "${key}\t${cache[key]}\n"
+            }
+        }
+    }
+    return cache[key]
+}
+
+// MD5 checksum of the content of a (potentially remote) file, read in chunks
+def fileChecksum(path) {
+    def digest = java.security.MessageDigest.getInstance("MD5")
+    path.withInputStream { stream ->
+        byte[] buffer = new byte[1 << 20]
+        int n
+        while ((n = stream.read(buffer)) > 0) {
+            digest.update(buffer, 0, n)
+        }
+    }
+    return digest.digest().encodeHex().toString()
+}
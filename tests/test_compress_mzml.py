@@ -0,0 +1,96 @@
+"""Round trip of bin/compress_mzml.py: the compressed mzML is valid, indexed and holds the same arrays."""
+
+import base64
+import os
+import struct
+import sys
+import xml.etree.ElementTree as ET
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "bin"))
+
+from compress_mzml import compress, read_offsets  # noqa: E402
+from index_mzml import index  # noqa: E402
+
+NS = {"mz": "http://psi.hupo.org/ms/mzml"}
+
+ARRAY = """          <binaryDataArray encodedLength="{length}">
+            <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>
+            <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+            <cvParam cvRef="MS" accession="{accession}" name="{name}" value=""/>
+            <binary>{data}</binary>
+          </binaryDataArray>
+"""
+
+SPECTRUM = """      <spectrum index="{index}" id="scan={scan}" defaultArrayLength="{n}">
+        <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{level}"/>
+        <binaryDataArrayList count="2">
+{arrays}        </binaryDataArrayList>
+      </spectrum>
+"""
+
+MZML = """<?xml version="1.0" encoding="utf-8"?>
+<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">
+  <run id="run">
+    <spectrumList count="{count}">
+{spectra}    </spectrumList>
+  </run>
+</mzML>
+"""
+
+
+def encode(values):
+    return base64.b64encode(struct.pack("<%dd" % len(values), *values)).decode()
+
+
+def decode(binary, compressed):
+    data = base64.b64decode(binary.text or "")
+    if compressed:
+        data = zlib.decompress(data)
+    return list(struct.unpack("<%dd" % (len(data) // 8), data))
+
+
+def write_mzml(path, spectra):
+    blocks = []
+    for i, (level, mz, intensity) in enumerate(spectra):
+        arrays = "".join(ARRAY.format(length=len(encode(values)), accession=accession, name=name, data=encode(values))
+                         for accession, name, values in [("MS:1000514", "m/z array", mz),
+                                                         ("MS:1000515", "intensity array", intensity)])
+        blocks.append(SPECTRUM.format(index=i, scan=i + 1, n=len(mz), level=level, arrays=arrays))
+    with open(path, "w") as f:
+        f.write(MZML.format(count=len(spectra), spectra="".join(blocks)))
+
+
+def arrays(path):
+    result = []
+    for spectrum in ET.parse(path).getroot().iterfind(".//mz:spectrum", NS):
+        for array in spectrum.iterfind(".//mz:binaryDataArray", NS):
+            accessions = [p.get("accession") for p in array.iterfind("mz:cvParam", NS)]
+            binary = array.find("mz:binary", NS)
+            assert int(array.get("encodedLength")) == len(binary.text or "")
+            # nothing of the original element may be left behind the replaced one
+            assert not (binary.tail or "").strip()
+            result.append((spectrum.get("id"), decode(binary, "MS:1000574" in accessions)))
+    return result
+
+
+def test_compress_round_trip(tmp_path):
+    spectra = [(1, [400.0 + i * 0.5 for i in range(50)], [float(i * i) for i in range(50)]),
+               (2, [100.25, 200.5, 300.75], [1.0, 2.0, 3.0]),
+               (2, [], [])]
+    write_mzml(str(tmp_path / "plain.mzML"), spectra)
+    index(str(tmp_path / "plain.mzML"), str(tmp_path / "in.mzML"))
+    compress(str(tmp_path / "in.mzML"), str(tmp_path / "out.mzML"), 6)
+
+    expected = [("scan=%d" % (i + 1), values) for i, (_, mz, intensity) in enumerate(spectra) for values in (mz, intensity)]
+    assert arrays(str(tmp_path / "in.mzML")) == expected
+    assert arrays(str(tmp_path / "out.mzML")) == expected
+
+    # every array is compressed and the rebuilt index points to the spectra
+    with open(str(tmp_path / "out.mzML"), "rb") as f:
+        content = f.read()
+        assert b"MS:1000576" not in content
+        offsets, _ = read_offsets(f)
+    assert [native_id for _, native_id, _ in offsets] == [b"scan=1", b"scan=2", b"scan=3"]
+    for _, native_id, offset in offsets:
+        assert content[offset:].startswith(b"<spectrum index=") and b"id=\"" + native_id + b"\"" in content[offset:offset + 100]
@@ -0,0 +1,40 @@
+"""tools/resources/fit_resources.py recovers the resource model from a trace and the recorded run statistics."""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "tools", "resources"))
+
+from fit_resources import collect, fit  # noqa: E402
+
+TRACE_HEADER = "task_id\thash\tnative_id\tname\tstatus\texit\tsubmit\tduration\trealtime\t%cpu\tpeak_rss\tpeak_vmem\trchar\twchar\n"
+STATISTICS_HEADER = "run\tspectra\tms2_spectra\tpsms\tmzml_bytes\tid_bytes\tmzml\n"
+
+
+def test_fit_percolator(tmp_path):
+    os.makedirs(str(tmp_path / "pipeline_info"))
+    psms = [100000, 200000, 400000, 800000]
+    with open(str(tmp_path / "pipeline_info" / "percolator_statistics.tsv"), "w") as f:
+        f.write(STATISTICS_HEADER)
+        for i, n in enumerate(psms):
+            f.write("run%d_comet_idx\tNA\tNA\t%d\tNA\t1000\tNA\n" % (i, n))
+    with open(str(tmp_path / "pipeline_info" / "execution_trace.txt"), "w") as f:
+        f.write(TRACE_HEADER)
+        for i, n in enumerate(psms):
+            # 2 GB + 20 KB per PSM (64 MB more for the first run), 36 ms CPU time per PSM on 8 CPUs
+            memory = 2 * 2**30 + 20 * 2**10 * n + (2**26 if i == 0 else 0)
+            f.write("%d\th%d\t-\tpercolator (run%d_comet_idx)\tCOMPLETED\t0\t-\t-\t%dms\t800.0%%\t%.1f MB\t-\t-\t-\n" % (
+                i, i, i, 36 * n / 8, memory / 2**20))
+        f.write("9\th9\t-\tpercolator (run9_comet_idx)\tFAILED\t137\t-\t-\t1s\t100.0%\t1 GB\t-\t-\t-\n")
+
+    result = fit(collect([str(tmp_path)]), 1.0)["percolator"]
+    assert result["tasks"] == len(psms)
+    assert result["memory_slopes"][0] == pytest.approx(20 * 2**10, rel=0.05)
+    # every observed task fits into the estimate
+    assert all(result["memory_intercept"] + result["memory_slopes"][0] * n >= 2 * 2**30 + 20 * 2**10 * n for n in psms)
+    assert result["memory_intercept"] + result["memory_slopes"][0] * psms[0] >= 2 * 2**30 + 2**26 + 20 * 2**10 * psms[0] - 2**20
+    assert result["psms_per_cpu"] == pytest.approx(100000, rel=0.01)
@@ -0,0 +1,35 @@
+"""The MSstats table of bin/mztab_to_parquet.py keeps its column types over all blocks of the csv."""
+
+import os
+import sys
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+ds = pytest.importorskip("pyarrow.dataset")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "bin"))
+
+from mztab_to_parquet import convert_msstats  # noqa: E402
+
+HEADER = "ProteinName,PeptideSequence,PrecursorCharge,FragmentIon,ProductCharge,IsotopeLabelType," \
+         "Condition,BioReplicate,Run,Fraction,Intensity,Reference\n"
+
+
+def test_msstats_column_empty_in_first_block(tmp_path):
+    rows = 100000
+    with open(str(tmp_path / "msstats.csv"), "w") as f:
+        f.write(HEADER)
+        for i in range(rows):
+            # no intensity in the first (default 1 MB) block of the reader
+            intensity = "NA" if i < rows // 2 else "%d.5" % i
+            f.write("P%d,PEPTIDE%dK,2,NA,NA,L,%d,%d,%d,1,%s,\"run%d.mzML\"\n" % (
+                i % 100, i, i % 2 + 1, i % 4 + 1, i % 3 + 1, intensity, i % 3 + 1))
+    convert_msstats(str(tmp_path / "msstats.csv"), str(tmp_path))
+
+    table = ds.dataset(str(tmp_path / "msstats"), partitioning="hive").to_table()
+    assert table.num_rows == rows
+    assert table.schema.field("Intensity").type == pa.float64()
+    assert table.schema.field("PrecursorCharge").type == pa.int32()
+    assert table.column("Intensity").null_count == rows // 2
+    assert sorted(os.listdir(str(tmp_path / "msstats"))) == ["Run=1", "Run=2", "Run=3"]
@@ -0,0 +1,59 @@
+"""The study-level Percolator of main.nf pools the runs with IDMerger and splits them with IDRipper by file origin.
+
+Both need OpenMS (2.6, as in the container and the conda environment) on the PATH.
+"""
+
+import os
+import shutil
+import subprocess
+import xml.etree.ElementTree as ET
+
+import pytest
+
+if not (shutil.which("IDMerger") and shutil.which("IDRipper")):
+    pytest.skip("OpenMS (IDMerger, IDRipper) is not available", allow_module_level=True)
+
+IDXML = """<?xml version="1.0" encoding="UTF-8"?>
+<IdXML version="1.5" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <SearchParameters id="SP_0" db="database.fasta" db_version="" taxonomy="" mass_type="monoisotopic" charges="+2, +3" enzyme="trypsin" missed_cleavages="2" precursor_peak_tolerance="10" precursor_peak_tolerance_ppm="true" peak_mass_tolerance="0.02" peak_mass_tolerance_ppm="false">
+  </SearchParameters>
+  <IdentificationRun date="2020-01-0{day}T00:00:00" search_engine="Comet" search_engine_version="2019.01" search_parameters_ref="SP_0">
+    <ProteinIdentification score_type="" higher_score_better="true" significance_threshold="0">
+      <ProteinHit id="PH_0" accession="P{day}" score="0" sequence="">
+      </ProteinHit>
+      <UserParam type="stringList" name="spectra_data" value="[{run}.mzML]"/>
+    </ProteinIdentification>
+{peptides}  </IdentificationRun>
+</IdXML>
+"""
+
+PEPTIDE = """    <PeptideIdentification score_type="expect" higher_score_better="false" significance_threshold="0" MZ="{mz}" RT="{rt}" spectrum_reference="controllerType=0 controllerNumber=1 scan={scan}">
+      <PeptideHit score="0.01" sequence="PEPTIDE{scan}K" charge="2" aa_before="K" aa_after="A" protein_refs="PH_0">
+        <UserParam type="string" name="target_decoy" value="target"/>
+      </PeptideHit>
+    </PeptideIdentification>
+"""
+
+
+def spectrum_references(path):
+    return sorted(p.get("spectrum_reference") for p in ET.parse(path).getroot().iter("PeptideIdentification"))
+
+
+def test_merge_and_rip_keep_runs(tmp_path):
+    runs = {"run_a_comet_idx_feat": range(1, 4), "run_b_comet_idx_feat": range(1, 6)}
+    for day, (run, scans) in enumerate(sorted(runs.items()), 1):
+        peptides = "".join(PEPTIDE.format(mz=400 + scan, rt=10 * scan, scan=scan) for scan in scans)
+        with open(str(tmp_path / (run + ".idXML")), "w") as f:
+            f.write(IDXML.format(day=day, run=run, peptides=peptides))
+
+    subprocess.run(["IDMerger", "-in"] + [run + ".idXML" for run in sorted(runs)] +
+                   ["-out", "merged.idXML", "-annotate_file_origin", "-merge_proteins_add_PSMs"],
+                   cwd=str(tmp_path), check=True)
+    os.makedirs(str(tmp_path / "ripped"))
+    subprocess.run(["IDRipper", "-in", "merged.idXML", "-out_path", "ripped"], cwd=str(tmp_path), check=True)
+
+    # one file per run, named as the run, with the PSMs of that run
+    assert sorted(os.listdir(str(tmp_path / "ripped"))) == sorted(run + ".idXML" for run in runs)
+    for run in runs:
+        assert spectrum_references(str(tmp_path / "ripped" / (run + ".idXML"))) == \
+            spectrum_references(str(tmp_path / (run + ".idXML")))
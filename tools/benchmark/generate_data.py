@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic protein database and synthetic indexed mzMLs for benchmarking.
+
+Random proteins are written to <out>/database.fasta, the experimental design (one sample per
+mzML) to <out>/experimental_design.tsv. Every mzML contains MS1 scans with the
+isotope patterns of tryptic peptides of these proteins eluting over time and one MS2 scan
+(b/y ions plus noise) per peptide at its elution apex, so that all steps of the pipeline
+(search, rescoring, feature detection and quantification) have something to work on.
+Results only depend on the seed and the size parameters.
+"""
+
+import argparse
+import base64
+import os
+import random
+import sys
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "bin"))
+from index_mzml import HashingWriter, write_index  # noqa: E402
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+RESIDUE_MASS = {
+    "G": 57.02146, "A": 71.03711, "S": 87.03203, "P": 97.05276, "V": 99.06841,
+    "T": 101.04768, "C": 160.03065,  # carbamidomethylated
+    "L": 113.08406, "I": 113.08406, "N": 114.04293, "D": 115.02694, "Q": 128.05858,
+    "K": 128.09496, "E": 129.04259, "M": 131.04049, "H": 137.05891, "F": 147.06841,
+    "R": 156.10111, "Y": 163.06333, "W": 186.07931,
+}
+WATER = 18.01056
+PROTON = 1.00728
+ISOTOPE_SPACING = 1.00336
+
+MS1_INTERVAL = 1.0  # seconds between MS1 scans
+ELUTION_WIDTH = 5.0  # standard deviation of the elution profile in seconds
+
+
+def write_fasta(path, n_proteins, rng):
+    proteins = []
+    with open(path, "w") as f:
+        for i in range(n_proteins):
+            sequence = "M" + "".join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(150, 600)))
+            proteins.append(sequence)
+            f.write(">sp|SYN{0:05d}|SYN{0:05d}_SYNTH Synthetic protein {0}\n".format(i))
+            for start in range(0, len(sequence), 60):
+                f.write(sequence[start:start + 60] + "\n")
+    return proteins
+
+
+def tryptic_peptides(proteins, min_length=7, max_length=30):
+    peptides = set()
+    for protein in proteins:
+        start = 0
+        for i, aa in enumerate(protein):
+            if aa in "KR" and (i + 1 == len(protein) or protein[i + 1] != "P"):
+                if min_length <= i + 1 - start <= max_length:
+                    peptides.add(protein[start:i + 1])
+                start = i + 1
+    return sorted(peptides)
+
+
+def fragment_mzs(peptide):
+    masses = np.cumsum([RESIDUE_MASS[aa] for aa in peptide])
+    b_ions = masses[:-1] + PROTON
+    y_ions = masses[-1] - masses[:-1] + WATER + PROTON
+    return np.concatenate([b_ions, y_ions])
+
+
+def encode(values):
+    return base64.b64encode(zlib.compress(np.asarray(values, dtype="<f8").tobytes())).decode()
+
+
+def binary_arrays(mzs, intensities):
+    arrays = []
+    for values, accession, name in [(mzs, "MS:1000514", "m/z array"), (intensities, "MS:1000515", "intensity array")]:
+        data = encode(values)
+        arrays.append(
+            "          <binaryDataArray encodedLength=\"{length}\">\n"
+            "            <cvParam cvRef=\"MS\" accession=\"MS:1000523\" name=\"64-bit float\"/>\n"
+            "            <cvParam cvRef=\"MS\" accession=\"MS:1000574\" name=\"zlib compression\"/>\n"
+            "            <cvParam cvRef=\"MS\" accession=\"{accession}\" name=\"{name}\"/>\n"
+            "            <binary>{data}</binary>\n"
+            "          </binaryDataArray>\n".format(length=len(data), accession=accession, name=name, data=data))
+    return "        <binaryDataArrayList count=\"2\">\n" + "".join(arrays) + "        </binaryDataArrayList>\n"
+
+
+def spectrum_xml(index, native_id, rt, ms_level, mzs, intensities, precursor=None):
+    order = np.argsort(mzs)
+    mzs, intensities = np.asarray(mzs)[order], np.asarray(intensities)[order]
+    xml = ("<spectrum index=\"{index}\" id=\"{native_id}\" defaultArrayLength=\"{n}\">\n"
+           "        <cvParam cvRef=\"MS\" accession=\"MS:1000511\" name=\"ms level\" value=\"{ms_level}\"/>\n"
+           "        <cvParam cvRef=\"MS\" accession=\"{spectrum_type}\" name=\"{spectrum_type_name}\"/>\n"
+           "        <cvParam cvRef=\"MS\" accession=\"MS:1000127\" name=\"centroid spectrum\"/>\n"
+           "        <scanList count=\"1\">\n"
+           "          <scan>\n"
+           "            <cvParam cvRef=\"MS\" accession=\"MS:1000016\" name=\"scan start time\" value=\"{rt:.3f}\" "
+           "unitCvRef=\"UO\" unitAccession=\"UO:0000010\" unitName=\"second\"/>\n"
+           "          </scan>\n"
+           "        </scanList>\n").format(
+        index=index, native_id=native_id, n=len(mzs), ms_level=ms_level, rt=rt,
+        spectrum_type="MS:1000579" if ms_level == 1 else "MS:1000580",
+        spectrum_type_name="MS1 spectrum" if ms_level == 1 else "MSn spectrum")
+    if precursor is not None:
+        precursor_mz, charge, ms1_id = precursor
+        xml += ("        <precursorList count=\"1\">\n"
+                "          <precursor spectrumRef=\"{ms1_id}\">\n"
+                "            <isolationWindow>\n"
+                "              <cvParam cvRef=\"MS\" accession=\"MS:1000827\" name=\"isolation window target m/z\" value=\"{mz:.5f}\"/>\n"
+                "            </isolationWindow>\n"
+                "            <selectedIonList count=\"1\">\n"
+                "              <selectedIon>\n"
+                "                <cvParam cvRef=\"MS\" accession=\"MS:1000744\" name=\"selected ion m/z\" value=\"{mz:.5f}\"/>\n"
+                "                <cvParam cvRef=\"MS\" accession=\"MS:1000041\" name=\"charge state\" value=\"{charge}\"/>\n"
+                "              </selectedIon>\n"
+                "            </selectedIonList>\n"
+                "            <activation>\n"
+                "              <cvParam cvRef=\"MS\" accession=\"MS:1000422\" name=\"beam-type collision-induced dissociation\"/>\n"
+                "            </activation>\n"
+                "          </precursor>\n"
+                "        </precursorList>\n").format(ms1_id=ms1_id, mz=precursor_mz, charge=charge)
+    return xml + binary_arrays(mzs, intensities) + "      </spectrum>\n"
+
+
+def write_mzml(path, peptides, n_spectra, rng):
+    """Write an indexed mzML with about n_spectra spectra (one MS1 scan per ten MS2 scans)."""
+    n_ms2 = max(1, n_spectra * 10 // 11)
+    gradient = n_ms2 / 10 * MS1_INTERVAL
+    sample = [peptides[i] for i in rng.sample(range(len(peptides)), min(n_ms2, len(peptides)))]
+    precursors = []
+    for peptide in sample:
+        charge = rng.choice([2, 2, 3])
+        mass = sum(RESIDUE_MASS[aa] for aa in peptide) + WATER
+        precursors.append({"peptide": peptide, "charge": charge, "mz": mass / charge + PROTON,
+                           "rt": rng.uniform(0, gradient), "abundance": 10 ** rng.uniform(5, 8)})
+    precursors.sort(key=lambda p: p["rt"])
+
+    run_id = os.path.splitext(os.path.basename(path))[0]
+    out = HashingWriter(path)
+    out.write(("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
+               "<indexedmzML xmlns=\"http://psi.hupo.org/ms/mzml\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\" "
+               "xsi:schemaLocation=\"http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.2_idx.xsd\">\n"
+               "  <mzML xmlns=\"http://psi.hupo.org/ms/mzml\" version=\"1.1.0\">\n"
+               "    <cvList count=\"2\">\n"
+               "      <cv id=\"MS\" fullName=\"Proteomics Standards Initiative Mass Spectrometry Ontology\" URI=\"https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo\"/>\n"
+               "      <cv id=\"UO\" fullName=\"Unit Ontology\" URI=\"https://raw.githubusercontent.com/bio-ontology-research-group/unit-ontology/master/unit.obo\"/>\n"
+               "    </cvList>\n"
+               "    <fileDescription>\n"
+               "      <fileContent>\n"
+               "        <cvParam cvRef=\"MS\" accession=\"MS:1000579\" name=\"MS1 spectrum\"/>\n"
+               "        <cvParam cvRef=\"MS\" accession=\"MS:1000580\" name=\"MSn spectrum\"/>\n"
+               "      </fileContent>\n"
+               "    </fileDescription>\n"
+               "    <softwareList count=\"1\">\n"
+               "      <software id=\"generate_data\" version=\"1.0\">\n"
+               "        <cvParam cvRef=\"MS\" accession=\"MS:1000799\" name=\"custom unreleased software tool\" value=\"generate_data.py\"/>\n"
+               "      </software>\n"
+               "    </softwareList>\n"
+               "    <instrumentConfigurationList count=\"1\">\n"
+               "      <instrumentConfiguration id=\"IC\">\n"
+               "        <cvParam cvRef=\"MS\" accession=\"MS:1000031\" name=\"instrument model\"/>\n"
+               "      </instrumentConfiguration>\n"
+               "    </instrumentConfigurationList>\n"
+               "    <dataProcessingList count=\"1\">\n"
+               "      <dataProcessing id=\"dp\">\n"
+               "        <processingMethod order=\"0\" softwareRef=\"generate_data\">\n"
+               "          <cvParam cvRef=\"MS\" accession=\"MS:1000035\" name=\"peak picking\"/>\n"
+               "        </processingMethod>\n"
+               "      </dataProcessing>\n"
+               "    </dataProcessingList>\n"
+               "    <run id=\"{run_id}\" defaultInstrumentConfigurationRef=\"IC\">\n"
+               "      <spectrumList count=\"{count}\" defaultDataProcessingRef=\"dp\">\n").format(
+        run_id=run_id, count=len(precursors) + int(gradient / MS1_INTERVAL) + 1).encode())
+
+    offsets = []
+    index = 0
+    next_ms2 = 0
+    for scan in range(int(gradient / MS1_INTERVAL) + 1):
+        rt = scan * MS1_INTERVAL
+        ms1_id = "scan={}".format(index + 1)
+        # isotope patterns of all peptides eluting at this time
+        mzs, intensities = [rng.uniform(350, 1500) for _ in range(50)], [rng.uniform(1e3, 1e4) for _ in range(50)]
+        for p in precursors:
+            if abs(p["rt"] - rt) < 3 * ELUTION_WIDTH:
+                height = p["abundance"] * np.exp(-0.5 * ((rt - p["rt"]) / ELUTION_WIDTH) ** 2)
+                for isotope, ratio in enumerate([1.0, 0.6, 0.25, 0.08]):
+                    mzs.append(p["mz"] + isotope * ISOTOPE_SPACING / p["charge"])
+                    intensities.append(height * ratio)
+        out.write(b"      ")
+        offsets.append((ms1_id.encode(), out.pos))
+        out.write(spectrum_xml(index, ms1_id, rt, 1, mzs, intensities).encode())
+        index += 1
+
+        # fragment the peptides at their apex
+        while next_ms2 < len(precursors) and precursors[next_ms2]["rt"] < rt + MS1_INTERVAL:
+            p = precursors[next_ms2]
+            fragments = list(fragment_mzs(p["peptide"]))
+            mzs = fragments + [rng.uniform(100, 2000) for _ in range(len(fragments))]
+            intensities = [rng.uniform(1e4, 1e5) for _ in fragments] + [rng.uniform(1e2, 2e4) for _ in fragments]
+            native_id = "scan={}".format(index + 1)
+            out.write(b"      ")
+            offsets.append((native_id.encode(), out.pos))
+            out.write(spectrum_xml(index, native_id, p["rt"], 2, mzs, intensities, (p["mz"], p["charge"], ms1_id)).encode())
+            index += 1
+            next_ms2 += 1
+
+    out.write(b"      </spectrumList>\n    </run>\n  </mzML>\n")
+    write_index(out, offsets)
+
+
+def write_design(path, mzmls):
+    """One unfractionated sample per mzML, alternately assigned to two conditions."""
+    with open(path, "w") as f:
+        f.write("Fraction_Group\tFraction\tSpectra_Filepath\tLabel\tSample\n")
+        for i, mzml in enumerate(mzmls, start=1):
+            f.write("{0}\t1\t{1}\t1\t{0}\n".format(i, mzml))
+        f.write("\nSample\tMSstats_Condition\tMSstats_BioReplicate\n")
+        for i in range(1, len(mzmls) + 1):
+            f.write("{0}\t{1}\t{0}\n".format(i, (i - 1) % 2 + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out", help="Output folder")
+    parser.add_argument("--files", type=int, default=1, help="Number of mzML files")
+    parser.add_argument("--spectra", type=int, default=5000, help="Number of spectra per mzML")
+    parser.add_argument("--proteins", type=int, default=500, help="Number of proteins in the database")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    rng = random.Random(args.seed)
+    proteins = write_fasta(os.path.join(args.out, "database.fasta"), args.proteins, rng)
+    peptides = tryptic_peptides(proteins)
+    mzmls = ["run{:03d}.mzML".format(i + 1) for i in range(args.files)]
+    for i, mzml in enumerate(mzmls):
+        write_mzml(os.path.join(args.out, mzml), peptides, args.spectra, random.Random(args.seed + i + 1))
+    write_design(os.path.join(args.out, "experimental_design.tsv"), mzmls)
+    print("Wrote {} proteins ({} tryptic peptides) and {} mzMLs with {} spectra each to {}".format(
+        len(proteins), len(peptides), args.files, args.spectra, args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Benchmark the pipeline on synthetic data at several scales and record a baseline.
+
+For every scale point (number of mzML files), synthetic data is generated with
+generate_data.py (once, reused afterwards) and the pipeline is run from scratch with the
+`benchmark` profile. Wall time, CPU time and peak memory per process are taken from the
+Nextflow trace and written to a JSON file. If a previous baseline is given, the results are
+compared against it and the script fails if a process got slower or needs more memory than
+the tolerance allows.
+
+Usage:
+  run_benchmark.py WORK_DIR [--scales 1,10,100] [--profile docker] [--baseline OLD.json] [--out NEW.json]
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import generate_data
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+# processes whose performance is compared against the baseline
+BENCHMARKED_PROCESSES = [
+    "generate_decoy_database",
+    "msgf_index",
+    "search_engine_comet",
+    "search_engine_msgf",
+    "extract_percolator_features",
+    "percolator",
+    "proteomicslfq",
+]
+METRICS = ["realtime_s", "max_realtime_s", "peak_rss_mb"]
+
+
+def generate(data_dir, files, spectra, proteins, seed):
+    if os.path.exists(os.path.join(data_dir, "experimental_design.tsv")):
+        return
+    tmp_dir = data_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    subprocess.run([sys.executable, generate_data.__file__, tmp_dir, "--files", str(files),
+                    "--spectra", str(spectra), "--proteins", str(proteins), "--seed", str(seed)], check=True)
+    os.rename(tmp_dir, data_dir)
+
+
+def summarize_trace(trace):
+    """Sum up the (raw) trace per process."""
+    processes = {}
+    with open(trace) as f:
+        for task in csv.DictReader(f, delimiter="\t"):
+            if task["status"] not in ("COMPLETED", "CACHED"):
+                continue
+            p = processes.setdefault(task["process"], {"tasks": 0, "realtime_s": 0.0, "max_realtime_s": 0.0, "cpu_s": 0.0, "peak_rss_mb": 0.0})
+            realtime = float(task["realtime"]) / 1000 if task["realtime"] != "-" else 0.0
+            cpu = float(task["%cpu"]) / 100 if task["%cpu"] != "-" else 0.0
+            peak_rss = float(task["peak_rss"]) / 2**20 if task["peak_rss"] != "-" else 0.0
+            p["tasks"] += 1
+            p["realtime_s"] += realtime
+            p["max_realtime_s"] = max(p["max_realtime_s"], realtime)
+            p["cpu_s"] += cpu * realtime
+            p["peak_rss_mb"] = max(p["peak_rss_mb"], peak_rss)
+    return {name: {k: round(v, 1) for k, v in p.items()} for name, p in sorted(processes.items())}
+
+
+def run_scale(args, scale):
+    data_dir = os.path.join(args.work_dir, "data", "files_{}".format(scale))
+    generate(data_dir, scale, args.spectra, args.proteins, args.seed)
+
+    run_dir = os.path.join(args.work_dir, "runs", "files_{}".format(scale))
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    trace = os.path.join(run_dir, "execution_trace.txt")
+    cmd = [args.nextflow, "run", os.path.join(REPO, "main.nf"),
+           "-profile", "benchmark," + args.profile,
+           "-work-dir", os.path.join(run_dir, "work"),
+           "-with-trace", trace,
+           "--input", os.path.join(data_dir, "*.mzML"),
+           "--database", os.path.join(data_dir, "database.fasta"),
+           "--expdesign", os.path.join(data_dir, "experimental_design.tsv"),
+           "--outdir", os.path.join(run_dir, "results")] + args.nextflow_args
+    print("Running scale point with {} files: {}".format(scale, " ".join(cmd)), flush=True)
+    start = time.time()
+    subprocess.run(cmd, cwd=run_dir, check=True)
+    return {"files": scale, "spectra_per_file": args.spectra, "proteins": args.proteins,
+            "wall_s": round(time.time() - start, 1), "processes": summarize_trace(trace)}
+
+
+def compare(baseline, results, tolerance):
+    """Return the regressions of the benchmarked processes compared to the baseline."""
+    regressions = []
+    for scale, result in results["scales"].items():
+        old_scale = baseline["scales"].get(scale)
+        if old_scale is None:
+            continue
+        for process in BENCHMARKED_PROCESSES:
+            old, new = old_scale["processes"].get(process), result["processes"].get(process)
+            if old is None or new is None:
+                continue
+            for metric in METRICS:
+                # ignore noise in very short or small measurements
+                if old[metric] >= 1 and new[metric] > old[metric] * (1 + tolerance):
+                    regressions.append("{} files, {}: {} {} -> {} (+{:.0%})".format(
+                        scale, process, metric, old[metric], new[metric], new[metric] / old[metric] - 1))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("work_dir", help="Folder for the synthetic data and the pipeline runs")
+    parser.add_argument("--scales", default="1,10,100", help="Comma-separated numbers of mzML files to benchmark")
+    parser.add_argument("--spectra", type=int, default=5000, help="Number of spectra per mzML")
+    parser.add_argument("--proteins", type=int, default=2000, help="Number of proteins in the database")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the synthetic data")
+    parser.add_argument("--profile", default="docker", help="Additional Nextflow profile(s), e.g. the container engine")
+    parser.add_argument("--nextflow", default="nextflow", help="Nextflow executable")
+    parser.add_argument("--out", default="benchmark.json", help="Output JSON with the results")
+    parser.add_argument("--baseline", help="Previous results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative increase of time and memory")
+    parser.add_argument("nextflow_args", nargs=argparse.REMAINDER, help="Additional arguments for the pipeline (after --)")
+    args = parser.parse_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+    args.nextflow_args = [a for a in args.nextflow_args if a != "--"]
+
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip(),
+        "nextflow_args": args.nextflow_args,
+        "scales": {},
+    }
+    for scale in [int(s) for s in args.scales.split(",")]:
+        results["scales"][str(scale)] = run_scale(args, scale)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            sys.exit("Performance regressions compared to {}:\n  {}".format(args.baseline, "\n  ".join(regressions)))
+        print("No regressions compared to " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
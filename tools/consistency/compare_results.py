@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Check that two runs of the pipeline on the same data agree within a tolerance, e.g. after
+switching a performance option that should not change the results.
+
+quant: Compare the quantification (proteomics_lfq/out.csv and out.mzTab) of two results
+  folders, e.g. ProteomicsLFQ against --per_run_feature_detection. Peptide intensities are
+  matched on protein, sequence, charge and file, protein abundances on the accession and
+  study variable. For both, the overlap (shared / all keys) and the Pearson correlation of
+  the log2 values of the shared keys must reach the given minimum.
+
+search: Compare the search results (raw_ids/*_perc.idXML or *_idpep.idXML) of two results
+  folders, e.g. with and without --search_chunking. The search engine scores (E-values) of a
+  spectrum do not depend on the other spectra, so the best hit of every spectrum must be the
+  same and its scores equal within a relative tolerance.
+
+Usage:
+  compare_results.py quant RESULTS_A RESULTS_B [--min_overlap 0.8] [--min_correlation 0.9]
+  compare_results.py search RESULTS_A RESULTS_B [--score_tolerance 1e-6]
+"""
+
+import argparse
+import math
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+MSSTATS_KEY = ["ProteinName", "PeptideSequence", "PrecursorCharge", "Reference"]
+ID_FILE_REGEX = re.compile(r"_(perc|idpep)\.idXML$")
+# scores of the search engines that are kept as UserParams of the PeptideHits
+ENGINE_SCORES = ["COMET:xcorr", "COMET:lnExpect", "MS:1002252", "MS:1002049", "MS:1002052", "MS:1002053"]
+
+
+def read_msstats(results):
+    table = pd.read_csv(os.path.join(results, "proteomics_lfq", "out.csv"))
+    if "Reference" not in table.columns:
+        table["Reference"] = table["Run"]
+    table["Reference"] = table["Reference"].map(os.path.basename)
+    return table.groupby(MSSTATS_KEY)["Intensity"].sum()
+
+
+def read_protein_abundances(results):
+    with open(os.path.join(results, "proteomics_lfq", "out.mzTab")) as f:
+        rows = [line.rstrip("\n").split("\t") for line in f if line.startswith(("PRH", "PRT"))]
+    if not rows:
+        return pd.Series(dtype=float)
+    table = pd.DataFrame(rows[1:], columns=rows[0])
+    columns = [c for c in table.columns if c.startswith("protein_abundance_study_variable[")]
+    table = table.melt(id_vars=["accession"], value_vars=columns, var_name="study_variable", value_name="abundance")
+    table["abundance"] = pd.to_numeric(table["abundance"], errors="coerce")
+    return table.dropna().groupby(["accession", "study_variable"])["abundance"].sum()
+
+
+def agreement(name, a, b, min_overlap, min_correlation):
+    """Print overlap and log2 correlation of two value series, returns whether both reach the minimum."""
+    a = a[a > 0]
+    b = b[b > 0]
+    shared = a.index.intersection(b.index)
+    overlap = len(shared) / max(1, len(a.index.union(b.index)))
+    correlation = np.corrcoef(np.log2(a[shared]), np.log2(b[shared]))[0, 1] if len(shared) > 1 else float("nan")
+    ok = overlap >= min_overlap and correlation >= min_correlation
+    print("{}: {} / {} values, {} shared (overlap {:.3f}), log2 correlation {:.3f} -> {}".format(
+        name, len(a), len(b), len(shared), overlap, correlation, "OK" if ok else "FAILED"))
+    return ok
+
+
+def read_best_hits(path):
+    """Spectrum reference -> (sequence, charge, engine scores) of the best hit of every spectrum of an idXML."""
+    hits = {}
+    for _, element in ET.iterparse(path):
+        if element.tag.endswith("PeptideIdentification"):
+            best = next((c for c in element if c.tag.endswith("PeptideHit")), None)
+            if best is not None:
+                scores = {p.get("name"): float(p.get("value")) for p in best
+                          if p.tag.endswith("UserParam") and p.get("name") in ENGINE_SCORES}
+                hits[element.get("spectrum_reference")] = (best.get("sequence"), best.get("charge"), scores)
+            element.clear()
+    return hits
+
+
+def same_hit(a, b, score_tolerance):
+    if a is None or b is None or a[:2] != b[:2]:
+        return False
+    return all(math.isclose(v, b[2].get(k, float("nan")), rel_tol=score_tolerance) for k, v in a[2].items())
+
+
+def compare_search(args):
+    folder_a = os.path.join(args.results_a, "raw_ids")
+    folder_b = os.path.join(args.results_b, "raw_ids")
+    names = sorted(n for n in os.listdir(folder_a) if ID_FILE_REGEX.search(n))
+    ok = bool(names)
+    for name in names:
+        if not os.path.exists(os.path.join(folder_b, name)):
+            print("{}: missing in {}".format(name, folder_b))
+            ok = False
+            continue
+        a = read_best_hits(os.path.join(folder_a, name))
+        b = read_best_hits(os.path.join(folder_b, name))
+        different = [spectrum for spectrum in set(a) | set(b)
+                     if not same_hit(a.get(spectrum), b.get(spectrum), args.score_tolerance)]
+        print("{}: {} / {} spectra, {} different best hits -> {}".format(
+            name, len(a), len(b), len(different), "FAILED" if different else "OK"))
+        for spectrum in sorted(different)[:5]:
+            print("  {}: {} / {}".format(spectrum, a.get(spectrum), b.get(spectrum)))
+        ok &= not different
+    return ok
+
+
+def compare_quant(args):
+    ok = agreement("peptide intensities", read_msstats(args.results_a), read_msstats(args.results_b),
+                   args.min_overlap, args.min_correlation)
+    ok &= agreement("protein abundances", read_protein_abundances(args.results_a),
+                    read_protein_abundances(args.results_b), args.min_overlap, args.min_correlation)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    quant_parser = subparsers.add_parser("quant", help="Compare the quantification of two results folders")
+    quant_parser.add_argument("results_a", help="Results folder (--outdir) of the reference run")
+    quant_parser.add_argument("results_b", help="Results folder (--outdir) to compare")
+    quant_parser.add_argument("--min_overlap", type=float, default=0.8, help="Minimum fraction of shared values")
+    quant_parser.add_argument("--min_correlation", type=float, default=0.9,
+                              help="Minimum Pearson correlation of the log2 values")
+    search_parser = subparsers.add_parser("search", help="Compare the search results of two results folders")
+    search_parser.add_argument("results_a", help="Results folder (--outdir) of the reference run")
+    search_parser.add_argument("results_b", help="Results folder (--outdir) to compare")
+    search_parser.add_argument("--score_tolerance", type=float, default=1e-6,
+                               help="Maximum relative difference of the search engine scores")
+    args = parser.parse_args()
+
+    if args.command == "quant":
+        ok = compare_quant(args)
+    elif args.command == "search":
+        ok = compare_search(args)
+    else:
+        parser.error("Please specify a command (quant or search)")
+    if not ok:
+        sys.exit("Error: the results differ by more than the tolerance")
+
+
+if __name__ == "__main__":
+    main()
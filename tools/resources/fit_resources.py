@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Fit the coefficients of the resource model in conf/base.config on finished runs of the pipeline.
+
+The peak memory and CPU time of the tasks are taken from the execution trace of every results
+folder (`pipeline_info/execution_trace.txt`, with the default or the raw fields of conf/trace.config)
+and joined with the size of their inputs: the spectra, PSMs and mzML sizes per run of
+`pipeline_info/run_statistics.tsv`, the PSMs per search engine result before Percolator of
+`pipeline_info/percolator_statistics.tsv` and the size of the MSstats input `proteomics_lfq/out.csv`.
+
+Memory is modelled as intercept + slopes * inputs. The coefficients are fitted by least squares over
+all tasks of a process, then the intercept is raised until every observed task fits (upper envelope),
+since a task that gets too little memory fails. The CPUs of Percolator are sized such that the fitted
+CPU time per PSM is done within --target_time hours, i.e. one CPU per "PSMs per CPU".
+
+Usage:
+  fit_resources.py RESULTS [RESULTS ...] [--target_time 1]
+"""
+
+import argparse
+import csv
+import os
+import re
+
+import numpy as np
+
+TRACE_NAME_REGEX = re.compile(r"^(\S+)(?: \((.*)\))?$")
+MEMORY_UNITS = {"B": 1, "KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40}
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+# the engine of a search engine result, e.g. BSA1_F1_comet_idx
+ENGINE_REGEX = re.compile(r"_([^_]+)_idx$")
+
+
+def parse_memory(value):
+    """Bytes of a raw or human readable (e.g. 1.5 GB) memory value of the trace."""
+    if value in ("-", ""):
+        return None
+    parts = value.split()
+    return float(parts[0]) * (MEMORY_UNITS[parts[1]] if len(parts) > 1 else 1)
+
+
+def parse_duration(value):
+    """Seconds of a raw (milliseconds) or human readable (e.g. 1h 2m 3s) duration of the trace."""
+    if value in ("-", ""):
+        return None
+    if re.match(r"^[\d.]+$", value):
+        return float(value) / 1000
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in re.findall(r"([\d.]+)(ms|s|m|h|d)", value))
+
+
+def read_trace(trace):
+    """Completed tasks of the trace with their process, tag, peak memory (bytes) and CPU time (seconds)."""
+    tasks = {}
+    with open(trace) as f:
+        for task in csv.DictReader(f, delimiter="\t"):
+            if task["status"] not in ("COMPLETED", "CACHED"):
+                continue
+            process, tag = TRACE_NAME_REGEX.match(task["name"]).groups()
+            process = task.get("process") or process.split(":")[-1]
+            tag = task.get("tag") if task.get("tag") not in (None, "-") else tag
+            realtime = parse_duration(task["realtime"])
+            cpu = float(task["%cpu"].rstrip("%")) / 100 if task["%cpu"] not in ("-", "") else None
+            tasks[task["hash"]] = {"process": process, "tag": tag, "peak_rss": parse_memory(task["peak_rss"]),
+                                   "cpu_s": realtime * cpu if realtime is not None and cpu is not None else None}
+    return list(tasks.values())
+
+
+def read_statistics(path):
+    """Rows of a run statistics table (see bin/run_statistics.py) by run, counts as numbers."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {row["run"]: {k: float(v) if re.match(r"^\d+$", v) else v for k, v in row.items()}
+                for row in csv.DictReader(f, delimiter="\t")}
+
+
+def model_inputs(results):
+    """Functions from the tag of a task to the inputs of the resource model of its process."""
+    runs = read_statistics(os.path.join(results, "pipeline_info", "run_statistics.tsv"))
+    percolator = read_statistics(os.path.join(results, "pipeline_info", "percolator_statistics.tsv"))
+    msstats_csv = os.path.join(results, "proteomics_lfq", "out.csv")
+
+    def engine_psms(engine):
+        return sum(row["psms"] for run, row in percolator.items() if ENGINE_REGEX.search(run).group(1) == engine)
+
+    return {
+        "percolator": (["psms"], lambda tag: [percolator[tag]["psms"]]),
+        "percolator_study": (["psms"], lambda tag: [engine_psms(tag)]),
+        "proteomicslfq": (["max_mzml_bytes", "psms"], lambda tag: [max(r["mzml_bytes"] for r in runs.values()),
+                                                                  sum(r["psms"] for r in runs.values())]),
+        "feature_detection": (["mzml_bytes"], lambda tag: [runs[tag]["mzml_bytes"]]),
+        "search_engines_fused": (["mzml_bytes"], lambda tag: [runs[tag]["mzml_bytes"]]),
+        "msstats": (["csv_bytes"], lambda tag: [os.path.getsize(msstats_csv)]),
+    }
+
+
+def collect(results_folders):
+    """Observations (inputs, peak memory, CPU time) per process over all results folders."""
+    observations = {}
+    for results in results_folders:
+        models = model_inputs(results)
+        for task in read_trace(os.path.join(results, "pipeline_info", "execution_trace.txt")):
+            if task["process"] not in models or task["peak_rss"] is None:
+                continue
+            names, inputs = models[task["process"]]
+            try:
+                x = inputs(task["tag"])
+            except (KeyError, OSError, ValueError, TypeError, AttributeError):
+                print("Skipping {} ({}): its inputs are not recorded in {}".format(task["process"], task["tag"], results))
+                continue
+            observations.setdefault(task["process"], (names, []))[1].append((x, task["peak_rss"], task["cpu_s"]))
+    return observations
+
+
+def fit_upper_envelope(x, y):
+    """Least squares fit of y = intercept + x * slopes, with the intercept raised until it covers all observations."""
+    design = np.column_stack([np.ones(len(x)), x])
+    coefficients = np.linalg.lstsq(design, y, rcond=None)[0]
+    # a negative slope means that the input does not explain the requirements
+    coefficients[1:] = np.maximum(coefficients[1:], 0)
+    coefficients[0] = max(0.0, np.max(y - design[:, 1:] @ coefficients[1:]))
+    return coefficients
+
+
+def fit(observations, target_time):
+    """Model coefficients per process, None if there are fewer tasks than coefficients."""
+    fits = {}
+    for process, (names, rows) in sorted(observations.items()):
+        x = np.array([r[0] for r in rows], dtype=float)
+        if len(rows) <= len(names):
+            fits[process] = None
+            continue
+        memory = fit_upper_envelope(x, np.array([r[1] for r in rows]))
+        result = {"tasks": len(rows), "inputs": names, "memory_intercept": memory[0], "memory_slopes": list(memory[1:])}
+        cpu_rows = [r for r in rows if r[2] is not None]
+        if process.startswith("percolator") and len(cpu_rows) > 1:
+            design = np.column_stack([np.ones(len(cpu_rows)), [r[0][0] for r in cpu_rows]])
+            cpu_per_psm = np.linalg.lstsq(design, np.array([r[2] for r in cpu_rows]), rcond=None)[0][1]
+            result["psms_per_cpu"] = target_time * 3600 / cpu_per_psm if cpu_per_psm > 0 else None
+        fits[process] = result
+    return fits
+
+
+def format_slope(name, slope):
+    # slopes on sizes in bytes are factors, the ones on counts are bytes per count
+    if name.endswith("bytes"):
+        return "{:.2f} * {}".format(slope, name)
+    return "{:.1f}.KB * {}".format(slope / 2**10, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("results", nargs="+", help="Results folders (--outdir) of finished runs of the pipeline")
+    parser.add_argument("--target_time", type=float, default=1.0,
+                        help="Wall time in hours that the Percolator CPUs are sized for")
+    args = parser.parse_args()
+
+    for process, result in fit(collect(args.results), args.target_time).items():
+        if result is None:
+            print("{}: not enough tasks to fit".format(process))
+            continue
+        print("{} ({} tasks): memory = {:.1f}.GB + {}".format(
+            process, result["tasks"], result["memory_intercept"] / 2**30,
+            " + ".join(format_slope(n, s) for n, s in zip(result["inputs"], result["memory_slopes"]))))
+        if result.get("psms_per_cpu"):
+            print("{} ({} tasks): one CPU per {:.0f} PSMs".format(process, result["tasks"], result["psms_per_cpu"]))
+
+
+if __name__ == "__main__":
+    main()
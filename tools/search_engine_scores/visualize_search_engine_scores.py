@@ -1,97 +1,155 @@
-from pyopenms import *
-from typing import List
+#!/usr/bin/env python3
+"""
+Compare Comet and MSGF+ best hits per spectrum for every run of a study.
+
+Every pair of `<run>_comet*_perc.idXML` / `<run>_msgf*_perc.idXML` files found in
+the given results folder (e.g. the `raw_ids` output folder of the pipeline) is
+streamed by its own worker process, joined on `spectrum_reference` and appended
+as one row group to a single Parquet table. Only one run per worker is held in
+memory at any time.
+
+Usage:
+  visualize_search_engine_scores.py RESULTS_FOLDER OUT_PARQUET [--threads N] [--plot HTML_PREFIX]
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+
+import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly
-
-prots = []  # type: List[ProteinIdentification]
-peps = []  # type: List[PeptideIdentification]
-IdXMLFile().load("/Users/pfeuffer/Downloads/debugPLFQ/BSAConsensus/consensus_eval/UPS1_50000amol_R1_comet_idx_feat_perc.xml", prots, peps)
-
-cols = ["comet", "comet_xcorr", "comet_pep", "msgf", "msgf_raw", "msgf_pep", "comet_seq", "msgf_seq", 'target_decoy_comet', 'target_decoy_msgf']
-
-d = {}
-for pep in peps:
-    best_hit = pep.getHits()[0]  # type: PeptideHit
-    d[pep.getMetaValue("spectrum_reference")] = {
-        'comet': best_hit.getMetaValue("COMET:lnExpect"),
-        'comet_xcorr': best_hit.getMetaValue("MS:1002252"),
-        'comet_pep': best_hit.getScore(),
-        'msgf': None,
-        'msgf_raw': None,
-        'msgf_pep': None,
-        'comet_seq':  best_hit.getSequence().toString(),
-        'msgf_seq': None,
-        'target_decoy_comet': best_hit.getMetaValue("target_decoy"),
-        'target_decoy_msgf': None,
-    }
-
-
-prots = []  # type: List[ProteinIdentification]
-peps = []  # type: List[PeptideIdentification]
-IdXMLFile().load("/Users/pfeuffer/Downloads/debugPLFQ/BSAConsensus/consensus_eval/UPS1_50000amol_R1_msgf_idx_feat_perc.xml", prots, peps)
-
-for pep in peps:
-    best_hit = pep.getHits()[0]  # type: PeptideHit
-    spec_ref = pep.getMetaValue("spectrum_reference")
-    if spec_ref in d:
-        mydict = d[spec_ref]
-        mydict["msgf"] = np.log10(best_hit.getMetaValue("MS:1002052"))
-        mydict["msgf_seq"] = best_hit.getSequence().toString()
-        mydict["msgf_raw"] = best_hit.getMetaValue("MS:1002049")
-        mydict["msgf_pep"] = best_hit.getScore()
-        mydict["target_decoy_msgf"] = best_hit.getMetaValue("target_decoy")
-
-    else:
-        d[spec_ref] = {
-            'comet': None,
-            'comet_pep': None,
-            'msgf': best_hit.getMetaValue("MS:1002052"),  # MSGF SpecEval
-            'msgf_raw': best_hit.getMetaValue("MS:1002049"),
-            'msgf_pep': best_hit.getScore(),
-            'comet_seq':  None,
-            'msgf_seq': best_hit.getSequence().toString(),
-            'target_decoy_comet': None,
-            'target_decoy_msgf': best_hit.getMetaValue("target_decoy")
-        }
-
-
-df = pd.DataFrame.from_dict(d, orient="index", columns=cols)
-df['same_seq'] = df.apply(lambda x: x['comet_seq'] == x['msgf_seq'], axis=1)
-
-
-def getTDstatus(x):
-    if x['same_seq']:
-        return x['target_decoy_comet']
-    else:
-        if x['target_decoy_comet'] is not None and x['target_decoy_msgf'] is not None:
-            if x['target_decoy_comet'] == x['target_decoy_msgf']:
-                return x['target_decoy_comet']
-            else:
-                return 'mixed'
-        elif x['target_decoy_comet'] is not None:
-            return x['target_decoy_comet']
-        else:
-            return x['target_decoy_msgf']
-
-
-df['target_decoy'] = df.apply(getTDstatus, axis=1)
-df['pep_max'] = df.apply(lambda x: max(x["comet_pep"],x["msgf_pep"]), axis=1)
-
-print(df['comet_seq'].head(10))
-print(df['msgf_seq'].head(10))
-
-df.to_csv("/Users/pfeuffer/Downloads/debugPLFQ/BSAConsensus/consensus_eval/pandas.csv")
-#tidy_df = df.melt(id_vars=[])
-#print(tidy_df.head())
-fig = px.scatter(df, x='comet_xcorr', y='msgf_raw', color='same_seq', symbol='target_decoy',
-                 hover_data=["target_decoy_comet", "comet_seq", "msgf_seq"],
-                 marginal_x="violin",
-                 marginal_y="violin", )
-fig.show()
-plotly.offline.plot(fig, "/Users/pfeuffer/Downloads/debugPLFQ/BSAConsensus/consensus_eval/plotly.html")
-
-fig = px.violin(df, x='target_decoy', y='pep_max', color='target_decoy')
-fig.show()
-
-
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ID_FILE_REGEX = re.compile(r"^(?P<run>.+)_(?P<engine>comet|msgf)(?P<suffix>.*)_perc\.idXML$")
+
+# UserParams to extract from the best PeptideHit, per engine
+ENGINE_META = {
+    'comet': {'comet': 'COMET:lnExpect', 'comet_xcorr': 'MS:1002252'},
+    'msgf': {'msgf': 'MS:1002052', 'msgf_raw': 'MS:1002049'},
+}
+
+SCHEMA = pa.schema([
+    ('run', pa.dictionary(pa.int32(), pa.string())),
+    ('spectrum_reference', pa.string()),
+    ('comet', pa.float64()),
+    ('comet_xcorr', pa.float64()),
+    ('comet_pep', pa.float64()),
+    ('msgf', pa.float64()),
+    ('msgf_raw', pa.float64()),
+    ('msgf_pep', pa.float64()),
+    ('comet_seq', pa.string()),
+    ('msgf_seq', pa.string()),
+    ('target_decoy_comet', pa.string()),
+    ('target_decoy_msgf', pa.string()),
+    ('same_seq', pa.bool_()),
+    ('target_decoy', pa.string()),
+    ('pep_max', pa.float64()),
+])
+
+
+def find_run_pairs(folder):
+    """Group the Percolator idXMLs in folder by run into (run, comet_file, msgf_file)."""
+    runs = {}
+    for f in sorted(glob.glob(os.path.join(folder, "*_perc.idXML"))):
+        match = ID_FILE_REGEX.match(os.path.basename(f))
+        if match:
+            runs.setdefault(match.group('run'), {})[match.group('engine')] = f
+    return [(run, files.get('comet'), files.get('msgf')) for run, files in sorted(runs.items())]
+
+
+def read_best_hits(idxml, engine):
+    """Stream an idXML and return the best hit per spectrum as a DataFrame."""
+    meta = ENGINE_META[engine]
+    cols = {k: [] for k in ['spectrum_reference', engine + '_pep', engine + '_seq', 'target_decoy_' + engine] + list(meta)}
+    if idxml is None:
+        return pd.DataFrame(cols)
+
+    id_run = None
+    for event, elem in ET.iterparse(idxml, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "IdentificationRun":
+                id_run = elem
+            continue
+        if elem.tag != "PeptideIdentification":
+            continue
+        best_hit = elem.find("PeptideHit")
+        if best_hit is not None:
+            params = {p.get("name"): p.get("value") for p in best_hit.iter("UserParam")}
+            cols['spectrum_reference'].append(elem.get("spectrum_reference"))
+            cols[engine + '_pep'].append(best_hit.get("score"))
+            cols[engine + '_seq'].append(best_hit.get("sequence"))
+            cols['target_decoy_' + engine].append(params.get("target_decoy"))
+            for col, name in meta.items():
+                cols[col].append(params.get(name))
+        # drop everything parsed so far in this run to keep memory bounded
+        id_run.clear()
+
+    df = pd.DataFrame(cols)
+    for col in [engine + '_pep'] + list(meta):
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+def compare_run(run_files):
+    """Join the Comet and MSGF+ best hits of one run and derive the comparison columns."""
+    run, comet_file, msgf_file = run_files
+    df = read_best_hits(comet_file, 'comet').merge(
+        read_best_hits(msgf_file, 'msgf'), on='spectrum_reference', how='outer')
+
+    df['msgf'] = np.log10(df['msgf'])
+    df['same_seq'] = (df['comet_seq'] == df['msgf_seq']).to_numpy()
+
+    td_comet = df['target_decoy_comet']
+    td_msgf = df['target_decoy_msgf']
+    mixed = td_comet.notna() & td_msgf.notna() & (td_comet != td_msgf) & ~df['same_seq']
+    df['target_decoy'] = td_comet.where(td_comet.notna(), td_msgf).mask(mixed, 'mixed')
+    df['pep_max'] = np.fmax(df['comet_pep'].to_numpy(), df['msgf_pep'].to_numpy())
+
+    table = pa.Table.from_pandas(df[SCHEMA.names[1:]], schema=pa.schema(list(SCHEMA)[1:]), preserve_index=False)
+    runs = pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(df), dtype=np.int32)), pa.array([run]))
+    return table.add_column(0, SCHEMA.field('run'), runs)
+
+
+def plot(parquet, html_prefix):
+    import plotly
+    import plotly.express as px
+
+    df = pq.read_table(parquet, columns=['comet_xcorr', 'msgf_raw', 'same_seq', 'target_decoy',
+                                         'target_decoy_comet', 'comet_seq', 'msgf_seq', 'pep_max']).to_pandas()
+    fig = px.scatter(df, x='comet_xcorr', y='msgf_raw', color='same_seq', symbol='target_decoy',
+                     hover_data=["target_decoy_comet", "comet_seq", "msgf_seq"],
+                     marginal_x="violin",
+                     marginal_y="violin", )
+    plotly.offline.plot(fig, filename=html_prefix + "_scatter.html", auto_open=False)
+
+    fig = px.violin(df, x='target_decoy', y='pep_max', color='target_decoy')
+    plotly.offline.plot(fig, filename=html_prefix + "_pep_max.html", auto_open=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", help="Folder with the *_comet*_perc.idXML and *_msgf*_perc.idXML files")
+    parser.add_argument("out", help="Output Parquet file")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--plot", metavar="HTML_PREFIX", help="Also write plotly HTML plots with this prefix")
+    args = parser.parse_args()
+
+    pairs = find_run_pairs(args.folder)
+    if not pairs:
+        sys.exit("No *_perc.idXML files found in " + args.folder)
+
+    with pq.ParquetWriter(args.out, SCHEMA) as writer, Pool(args.threads, maxtasksperchild=1) as pool:
+        for table in pool.imap_unordered(compare_run, pairs):
+            writer.write_table(table)
+
+    if args.plot:
+        plot(args.out, args.plot)
+
+
+if __name__ == "__main__":
+    main()
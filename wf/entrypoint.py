@@ -1,7 +1,15 @@
 from dataclasses import dataclass
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import fnmatch
+import glob
+import hashlib
+import json
+import math
 import os
 import subprocess
+import threading
 import requests
 import shutil
 from pathlib import Path
@@ -25,58 +33,325 @@ meta = Path("latch_metadata") / "__init__.py"
 import_module_by_path(meta)
 import latch_metadata
 
+# can be pointed to a local stand-in of the dispatcher for testing
+dispatcher_url = os.environ.get("LATCH_NF_DISPATCHER_URL", "http://nf-dispatcher-service.flyte.svc.cluster.local")
+
+default_storage_gib = 100
+min_storage_gib = 20
+max_storage_gib = 8192
+# fixed headroom for the pipeline code, containers, databases and search indexes
+base_storage_gib = 10
+
+
+def file_size(path: str) -> typing.Optional[int]:
+    try:
+        if path.startswith("latch://"):
+            return LPath(path).size()
+        if path.startswith("http://") or path.startswith("https://"):
+            resp = requests.head(path, allow_redirects=True)
+            resp.raise_for_status()
+            return int(resp.headers["Content-Length"])
+        if "://" not in path:
+            return os.path.getsize(path)
+    except Exception as e:
+        print(f"Failed to get the size of {path}: {e}")
+    return None
+
+
+def expand_glob(pattern: str) -> typing.List[str]:
+    if not glob.has_magic(pattern):
+        return [pattern]
+    if pattern.startswith("latch://"):
+        folder, name = pattern.rsplit("/", 1)
+        return [f"{folder}/{child.name()}" for child in LPath(folder).iterdir() if fnmatch.fnmatch(child.name(), name)]
+    if "://" not in pattern:
+        return glob.glob(pattern)
+    print(f"Cannot list {pattern}")
+    return []
+
+
+def read_text(path: str) -> str:
+    if path.startswith("latch://"):
+        return Path(LPath(path).download()).read_text()
+    if path.startswith("http://") or path.startswith("https://"):
+        resp = requests.get(path)
+        resp.raise_for_status()
+        return resp.text
+    return Path(path).read_text()
+
+
+def spectra_files(input: str, root_folder: typing.Optional[str], local_input_type: typing.Optional[str]) -> typing.List[str]:
+    # same resolution of the spectra files as in main.nf
+    if not input.lower().endswith(("sdrf", "tsv")):
+        return expand_glob(input)
+
+    files = []
+    for row in csv.DictReader(read_text(input).splitlines(), delimiter="\t"):
+        row = {k.lower(): v for k, v in row.items()}
+        if root_folder is None:
+            files.append(row["comment[file uri]"])
+            continue
+        name = row["comment[data file]"]
+        if local_input_type is not None:
+            name = name[:name.rfind(".")] + "." + local_input_type
+        files.append(root_folder.rstrip("/") + "/" + name)
+    return files
+
+
+def estimate_storage(input: str, root_folder: typing.Optional[str], local_input_type: typing.Optional[str], database: str, expansion_factor: float) -> typing.Tuple[int, int]:
+    """Estimate the size of the shared volume from the size of the inputs.
+
+    The spectra files are expanded by the given factor to account for RAW to mzML conversion
+    and intermediate results. Returns the size of the inputs in bytes and of the volume in GiB.
+    """
+    try:
+        files = spectra_files(input, root_folder, local_input_type)
+    except Exception as e:
+        # e.g. an unreadable SDRF or one without the expected columns, the pipeline reports the details itself
+        print(f"WARNING: Failed to read the spectra files from {input} ({type(e).__name__}: {e}), "
+              f"falling back to the default storage size of {default_storage_gib} GiB")
+        return 0, default_storage_gib
+    sizes = [file_size(f) for f in files]
+    unknown = sum(size is None for size in sizes)
+    input_bytes = sum(size for size in sizes if size is not None)
+    print(f"Found {len(files)} spectra files with a total size of {input_bytes / 2**30:.1f} GiB ({unknown} of unknown size)")
+
+    if not files or unknown == len(files):
+        print(f"Falling back to the default storage size of {default_storage_gib} GiB")
+        return input_bytes, default_storage_gib
+
+    # files of unknown size are assumed to be of average size
+    input_bytes = input_bytes * len(files) / (len(files) - unknown)
+    storage_gib = base_storage_gib + math.ceil((input_bytes * expansion_factor + (file_size(database) or 0)) / 2**30)
+    return int(input_bytes), min(max_storage_gib, max(min_storage_gib, storage_gib))
+
+
 @custom_task(cpu=0.25, memory=0.5, storage_gib=1)
-def initialize() -> str:
+def initialize(input: str, root_folder: typing.Optional[str], local_input_type: typing.Optional[str], database: str, storage_expansion_factor: typing.Optional[float]) -> typing.NamedTuple("InitializeOutput", pvc_name=str, input_bytes=int, storage_gib=int):
     token = os.environ.get("FLYTE_INTERNAL_EXECUTION_ID")
     if token is None:
         raise RuntimeError("failed to get execution token")
 
     headers = {"Authorization": f"Latch-Execution-Token {token}"}
 
-    print("Provisioning shared storage volume... ", end="")
+    if storage_expansion_factor is None:
+        storage_expansion_factor = 4.0
+    input_bytes, storage_gib = estimate_storage(input, root_folder, local_input_type, database, storage_expansion_factor)
+
+    print(f"Provisioning shared storage volume of {storage_gib} GiB... ", end="")
     resp = requests.post(
-        "http://nf-dispatcher-service.flyte.svc.cluster.local/provision-storage",
+        f"{dispatcher_url}/provision-storage",
         headers=headers,
         json={
-            "storage_gib": 100,
+            "storage_gib": storage_gib,
         }
     )
     resp.raise_for_status()
     print("Done.")
 
-    return resp.json()["name"]
+    return resp.json()["name"], input_bytes, storage_gib
 
 
+# files and folders of the pipeline needed to run it from the shared volume
+pipeline_files = [
+    "main.nf",
+    "nextflow.config",
+    "nextflow_schema.json",
+    "latch.config",
+    "environment.yml",
+    "conf",
+    "bin",
+    "assets",
+    "docs",
+]
 
 
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
 
-@nextflow_runtime_task(cpu=4, memory=8, storage_gib=100)
-def nextflow_runtime(pvc_name: str, input: str, outdir: typing.Optional[typing_extensions.Annotated[LatchDir, FlyteAnnotation({'output': True})]], email: typing.Optional[str], root_folder: typing.Optional[str], local_input_type: typing.Optional[str], expdesign: typing.Optional[str], database: str, add_decoys: typing.Optional[bool], openms_peakpicking: typing.Optional[bool], peakpicking_inmemory: typing.Optional[bool], peakpicking_ms_levels: typing.Optional[str], db_debug: typing.Optional[int], enable_mod_localization: typing.Optional[bool], pp_debug: typing.Optional[int], description_correct_features: typing.Optional[int], consensusid_considered_top_hits: typing.Optional[int], min_consensus_support: typing.Optional[int], mass_recalibration: typing.Optional[bool], inf_quant_debug: typing.Optional[int], skip_post_msstats: typing.Optional[bool], ref_condition: typing.Optional[str], contrasts: typing.Optional[str], enable_qc: typing.Optional[bool], ptxqc_report_layout: typing.Optional[str], decoy_affix: typing.Optional[str], affix_type: typing.Optional[str], search_engines: typing.Optional[str], enzyme: typing.Optional[str], num_enzyme_termini: typing.Optional[str], allowed_missed_cleavages: typing.Optional[int], precursor_mass_tolerance: typing.Optional[int], precursor_mass_tolerance_unit: typing.Optional[str], fragment_mass_tolerance: typing.Optional[float], fragment_mass_tolerance_unit: typing.Optional[str], fixed_mods: typing.Optional[str], variable_mods: typing.Optional[str], isotope_error_range: typing.Optional[str], instrument: typing.Optional[str], protocol: typing.Optional[str], min_precursor_charge: typing.Optional[int], max_precursor_charge: typing.Optional[int], min_peptide_length: typing.Optional[int], max_peptide_length: typing.Optional[int], num_hits: typing.Optional[int], max_mods: typing.Optional[int], mod_localization: typing.Optional[str], allow_unmatched: typing.Optional[str], IL_equivalent: typing.Optional[str], posterior_probabilities: typing.Optional[str], psm_pep_fdr_cutoff: typing.Optional[float], FDR_level: typing.Optional[str], train_FDR: typing.Optional[float], test_FDR: typing.Optional[float], subset_max_train: typing.Optional[int], outlier_handling: typing.Optional[str], consensusid_algorithm: typing.Optional[str], protein_inference: typing.Optional[str], protein_level_fdr_cutoff: typing.Optional[float], protein_quant: typing.Optional[str], quantification_method: typing.Optional[str], transfer_ids: typing.Optional[str], targeted_only: typing.Optional[bool]) -> None:
+def sync_file(src: Path, dst: Path) -> bool:
+    """Copy src to dst unless dst is unchanged (same size and modification time or content)."""
+    if dst.exists():
+        src_stat = src.stat()
+        dst_stat = dst.stat()
+        if src_stat.st_size == dst_stat.st_size:
+            if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                return False
+            if file_digest(src) == file_digest(dst):
+                shutil.copystat(src, dst)
+                return False
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(src, dst)
+    return True
+
+
+def stage_pipeline(src: Path, dst: Path, threads: int = 16):
+    """Copy the pipeline files to dst in parallel, skipping files that are already up to date."""
+    files = []
+    for name in pipeline_files:
+        path = src / name
+        if path.is_dir():
+            files.extend(p for p in path.rglob("*") if p.is_file() and "__pycache__" not in p.parts)
+        elif path.is_file():
+            files.append(path)
+
+    with ThreadPoolExecutor(threads) as pool:
+        copied = sum(pool.map(lambda f: sync_file(f, dst / f.relative_to(src)), files))
+    print(f"Staged pipeline files: {copied} copied, {len(files) - copied} unchanged")
+
+
+class StorageMonitor(threading.Thread):
+    """Samples the used space of the shared volume to record the peak usage."""
+
+    def __init__(self, path: Path, interval: float = 30):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak_bytes = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        self.peak_bytes = max(self.peak_bytes, shutil.disk_usage(self.path).used)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.sample()
+
+
+log_dir = "latch:///your_log_dir/nf_nf_core_proteomicslfq"
+
+
+def upload_logs(name: typing.Optional[str], files: typing.List[Path]):
+    if name is None:
+        print("Skipping logs upload, failed to get execution name")
+        return
+    for local in files:
+        if local.exists():
+            remote = LPath(urljoins(log_dir, name, local.name.lstrip(".")))
+            print(f"Uploading {local.name} to {remote.path}")
+            remote.upload_from(local)
+
+
+def trace_number(value: str) -> float:
+    # missing values are reported as "-"
     try:
-        shared_dir = Path("/nf-workdir")
+        return float(value.rstrip("%"))
+    except ValueError:
+        return 0
 
 
+summary_columns = ["process", "tasks", "failed", "retries", "realtime_h", "max_realtime_h", "cpu_efficiency", "max_peak_rss_gib", "max_memory_gib"]
 
-        ignore_list = [
-            "latch",
-            ".latch",
-            "nextflow",
-            ".nextflow",
-            "work",
-            "results",
-            "miniconda",
-            "anaconda3",
-            "mambaforge",
-        ]
 
-        shutil.copytree(
-            Path("/root"),
-            shared_dir,
-            ignore=lambda src, names: ignore_list,
-            ignore_dangling_symlinks=True,
-            dirs_exist_ok=True,
-        )
+def summarize_trace(tasks: typing.Iterable[typing.Dict[str, str]]) -> typing.List[typing.List]:
+    """Per-process wall time, CPU efficiency, peak RSS and retries of the tasks of a (raw) Nextflow trace."""
+    processes = {}
+    for task in tasks:
+        p = processes.setdefault(task["process"], {"tasks": 0, "failed": 0, "retries": 0, "realtime": 0, "max_realtime": 0, "cpu_time": 0, "reserved_cpu_time": 0, "peak_rss": 0, "memory": 0})
+        realtime = trace_number(task["realtime"]) / 1000
+        p["tasks"] += 1
+        p["failed"] += task["status"] == "FAILED"
+        p["retries"] += int(trace_number(task["attempt"]) > 1)
+        p["realtime"] += realtime
+        p["max_realtime"] = max(p["max_realtime"], realtime)
+        p["cpu_time"] += trace_number(task["%cpu"]) / 100 * realtime
+        p["reserved_cpu_time"] += max(1, trace_number(task["cpus"])) * realtime
+        p["peak_rss"] = max(p["peak_rss"], trace_number(task["peak_rss"]))
+        p["memory"] = max(p["memory"], trace_number(task["memory"]))
+
+    # the processes with the most wall time first
+    return [
+        [name, p["tasks"], p["failed"], p["retries"],
+         round(p["realtime"] / 3600, 2), round(p["max_realtime"] / 3600, 2),
+         round(p["cpu_time"] / p["reserved_cpu_time"], 2) if p["reserved_cpu_time"] else "NA",
+         round(p["peak_rss"] / 2**30, 2), round(p["memory"] / 2**30, 2)]
+        for name, p in sorted(processes.items(), key=lambda item: -item[1]["realtime"])
+    ]
+
+
+class TraceMonitor(threading.Thread):
+    """Tails the Nextflow trace file, prints finished tasks and periodically uploads a per-process summary."""
+
+    def __init__(self, trace: Path, summary: Path, execution_name: typing.Optional[str], interval: float = 300):
+        super().__init__(daemon=True)
+        self.trace = trace
+        self.summary = summary
+        self.execution_name = execution_name
+        self.interval = interval
+        self.header = None
+        self.position = 0
+        self.tasks = {}
+        self.stopped = threading.Event()
+
+    def read(self):
+        if not self.trace.exists():
+            return
+        with self.trace.open() as f:
+            f.seek(self.position)
+            while True:
+                line = f.readline()
+                # only complete lines, the rest is read once it is written
+                if not line.endswith("\n"):
+                    break
+                self.position = f.tell()
+                fields = line.rstrip("\n").split("\t")
+                if self.header is None:
+                    self.header = fields
+                    continue
+                task = dict(zip(self.header, fields))
+                self.tasks[task["task_id"]] = task
+                print(f"[trace] {task['status']:<9} {task['name']} ({trace_number(task['realtime']) / 1000:.0f} s, {trace_number(task['%cpu']):.0f}% CPU, peak RSS {trace_number(task['peak_rss']) / 2**30:.1f} GiB)", flush=True)
+
+    def write_summary(self):
+        with self.summary.open("w") as f:
+            f.write("\t".join(summary_columns) + "\n")
+            for row in summarize_trace(self.tasks.values()):
+                f.write("\t".join(str(v) for v in row) + "\n")
+
+    def update(self):
+        self.read()
+        self.write_summary()
+        upload_logs(self.execution_name, [self.trace, self.summary])
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.update()
+            except Exception as e:
+                print(f"Failed to update the trace summary: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            self.update()
+        except Exception as e:
+            print(f"Failed to update the trace summary: {e}")
+
+
+
+
+
+
+@nextflow_runtime_task(cpu=4, memory=8, storage_gib=100)
+def nextflow_runtime(pvc_name: str, input_bytes: int, storage_gib: int, storage_expansion_factor: typing.Optional[float], input: str, outdir: typing.Optional[typing_extensions.Annotated[LatchDir, FlyteAnnotation({'output': True})]], email: typing.Optional[str], root_folder: typing.Optional[str], local_input_type: typing.Optional[str], sdrf_cache: typing.Optional[str], expdesign: typing.Optional[str], database: str, add_decoys: typing.Optional[bool], database_cache: typing.Optional[str], openms_peakpicking: typing.Optional[bool], peakpicking_inmemory: typing.Optional[bool], peakpicking_ms_levels: typing.Optional[str], db_debug: typing.Optional[int], enable_mod_localization: typing.Optional[bool], pp_debug: typing.Optional[int], description_correct_features: typing.Optional[int], consensusid_considered_top_hits: typing.Optional[int], min_consensus_support: typing.Optional[int], mass_recalibration: typing.Optional[bool], inf_quant_debug: typing.Optional[int], skip_post_msstats: typing.Optional[bool], ref_condition: typing.Optional[str], contrasts: typing.Optional[str], enable_qc: typing.Optional[bool], ptxqc_report_layout: typing.Optional[str], publish_dir_mode_overrides: typing.Optional[str], conversion_cache: typing.Optional[str], raw_conversion_batch_size: typing.Optional[int], peakpicking_adaptive: typing.Optional[bool], peakpicking_compression: typing.Optional[bool], search_chunking: typing.Optional[bool], search_chunk_size: typing.Optional[int], search_max_chunks: typing.Optional[int], fused_search: typing.Optional[bool], luciphor_shard_size: typing.Optional[int], post_search_batch_size: typing.Optional[int], percolator_study_level: typing.Optional[bool], per_run_feature_detection: typing.Optional[bool], export_parquet: typing.Optional[bool], enable_qc_metrics: typing.Optional[bool], contaminant_regex: typing.Optional[str], decoy_affix: typing.Optional[str], affix_type: typing.Optional[str], search_engines: typing.Optional[str], enzyme: typing.Optional[str], num_enzyme_termini: typing.Optional[str], allowed_missed_cleavages: typing.Optional[int], precursor_mass_tolerance: typing.Optional[int], precursor_mass_tolerance_unit: typing.Optional[str], fragment_mass_tolerance: typing.Optional[float], fragment_mass_tolerance_unit: typing.Optional[str], fixed_mods: typing.Optional[str], variable_mods: typing.Optional[str], isotope_error_range: typing.Optional[str], instrument: typing.Optional[str], protocol: typing.Optional[str], min_precursor_charge: typing.Optional[int], max_precursor_charge: typing.Optional[int], min_peptide_length: typing.Optional[int], max_peptide_length: typing.Optional[int], num_hits: typing.Optional[int], max_mods: typing.Optional[int], mod_localization: typing.Optional[str], allow_unmatched: typing.Optional[str], IL_equivalent: typing.Optional[str], posterior_probabilities: typing.Optional[str], psm_pep_fdr_cutoff: typing.Optional[float], FDR_level: typing.Optional[str], train_FDR: typing.Optional[float], test_FDR: typing.Optional[float], subset_max_train: typing.Optional[int], outlier_handling: typing.Optional[str], consensusid_algorithm: typing.Optional[str], protein_inference: typing.Optional[str], protein_level_fdr_cutoff: typing.Optional[float], protein_quant: typing.Optional[str], quantification_method: typing.Optional[str], transfer_ids: typing.Optional[str], targeted_only: typing.Optional[bool]) -> None:
+    shared_dir = Path("/nf-workdir")
+    storage_monitor = StorageMonitor(shared_dir)
+    storage_monitor.start()
+    # written to the shared volume (instead of the outdir) to be able to follow it during the run
+    execution_name = _get_execution_name()
+    pipeline_info = shared_dir / "pipeline_info"
+    trace_monitor = TraceMonitor(pipeline_info / "execution_trace.txt", pipeline_info / "process_summary.tsv", execution_name)
+    try:
+        stage_pipeline(Path("/root"), shared_dir)
 
         cmd = [
             "/root/nextflow",
@@ -88,18 +363,29 @@ def nextflow_runtime(pvc_name: str, input: str, outdir: typing.Optional[typing_e
             "docker",
             "-c",
             "latch.config",
+            "-with-trace",
+            str(trace_monitor.trace),
+            "-with-timeline",
+            str(pipeline_info / "execution_timeline.html"),
                 *get_flag('input', input),
                 *get_flag('outdir', outdir),
                 *get_flag('email', email),
+                *get_flag('publish_dir_mode_overrides', publish_dir_mode_overrides),
                 *get_flag('root_folder', root_folder),
                 *get_flag('local_input_type', local_input_type),
+                *get_flag('sdrf_cache', sdrf_cache),
                 *get_flag('expdesign', expdesign),
                 *get_flag('database', database),
                 *get_flag('add_decoys', add_decoys),
                 *get_flag('decoy_affix', decoy_affix),
                 *get_flag('affix_type', affix_type),
+                *get_flag('database_cache', database_cache),
+                *get_flag('conversion_cache', conversion_cache),
+                *get_flag('raw_conversion_batch_size', raw_conversion_batch_size),
                 *get_flag('openms_peakpicking', openms_peakpicking),
                 *get_flag('peakpicking_inmemory', peakpicking_inmemory),
+                *get_flag('peakpicking_adaptive', peakpicking_adaptive),
+                *get_flag('peakpicking_compression', peakpicking_compression),
                 *get_flag('peakpicking_ms_levels', peakpicking_ms_levels),
                 *get_flag('search_engines', search_engines),
                 *get_flag('enzyme', enzyme),
@@ -121,17 +407,24 @@ def nextflow_runtime(pvc_name: str, input: str, outdir: typing.Optional[typing_e
                 *get_flag('num_hits', num_hits),
                 *get_flag('max_mods', max_mods),
                 *get_flag('db_debug', db_debug),
+                *get_flag('search_chunking', search_chunking),
+                *get_flag('search_chunk_size', search_chunk_size),
+                *get_flag('search_max_chunks', search_max_chunks),
+                *get_flag('fused_search', fused_search),
                 *get_flag('enable_mod_localization', enable_mod_localization),
                 *get_flag('mod_localization', mod_localization),
+                *get_flag('luciphor_shard_size', luciphor_shard_size),
                 *get_flag('allow_unmatched', allow_unmatched),
                 *get_flag('IL_equivalent', IL_equivalent),
                 *get_flag('posterior_probabilities', posterior_probabilities),
                 *get_flag('psm_pep_fdr_cutoff', psm_pep_fdr_cutoff),
+                *get_flag('post_search_batch_size', post_search_batch_size),
                 *get_flag('pp_debug', pp_debug),
                 *get_flag('FDR_level', FDR_level),
                 *get_flag('train_FDR', train_FDR),
                 *get_flag('test_FDR', test_FDR),
                 *get_flag('subset_max_train', subset_max_train),
+                *get_flag('percolator_study_level', percolator_study_level),
                 *get_flag('description_correct_features', description_correct_features),
                 *get_flag('outlier_handling', outlier_handling),
                 *get_flag('consensusid_algorithm', consensusid_algorithm),
@@ -144,11 +437,15 @@ def nextflow_runtime(pvc_name: str, input: str, outdir: typing.Optional[typing_e
                 *get_flag('mass_recalibration', mass_recalibration),
                 *get_flag('transfer_ids', transfer_ids),
                 *get_flag('targeted_only', targeted_only),
+                *get_flag('per_run_feature_detection', per_run_feature_detection),
                 *get_flag('inf_quant_debug', inf_quant_debug),
                 *get_flag('skip_post_msstats', skip_post_msstats),
                 *get_flag('ref_condition', ref_condition),
                 *get_flag('contrasts', contrasts),
+                *get_flag('export_parquet', export_parquet),
                 *get_flag('enable_qc', enable_qc),
+                *get_flag('enable_qc_metrics', enable_qc_metrics),
+                *get_flag('contaminant_regex', contaminant_regex),
                 *get_flag('ptxqc_report_layout', ptxqc_report_layout)
         ]
 
@@ -156,6 +453,10 @@ def nextflow_runtime(pvc_name: str, input: str, outdir: typing.Optional[typing_e
         print(' '.join(cmd))
         print(flush=True)
 
+        pipeline_info.mkdir(parents=True, exist_ok=True)
+        trace_monitor.trace.unlink(missing_ok=True)
+        trace_monitor.start()
+
         env = {
             **os.environ,
             "NXF_HOME": "/root/.nextflow",
@@ -172,26 +473,31 @@ def nextflow_runtime(pvc_name: str, input: str, outdir: typing.Optional[typing_e
     finally:
         print()
 
-        nextflow_log = shared_dir / ".nextflow.log"
-        if nextflow_log.exists():
-            name = _get_execution_name()
-            if name is None:
-                print("Skipping logs upload, failed to get execution name")
-            else:
-                remote = LPath(urljoins("latch:///your_log_dir/nf_nf_core_proteomicslfq", name, "nextflow.log"))
-                print(f"Uploading .nextflow.log to {remote.path}")
-                remote.upload_from(nextflow_log)
+        # record the estimate together with the actual usage to tune the expansion factor
+        storage_monitor.stop()
+        storage_usage = shared_dir / "storage_usage.json"
+        storage_usage.write_text(json.dumps({
+            "input_bytes": input_bytes,
+            "storage_expansion_factor": storage_expansion_factor,
+            "storage_gib": storage_gib,
+            "peak_used_gib": round(storage_monitor.peak_bytes / 2**30, 2),
+        }, indent=2))
+        print(f"Peak usage of the shared storage volume: {storage_monitor.peak_bytes / 2**30:.1f} of {storage_gib} GiB")
+
+        if trace_monitor.is_alive():
+            trace_monitor.stop()
+        upload_logs(execution_name, [shared_dir / ".nextflow.log", storage_usage, pipeline_info / "execution_timeline.html"])
 
 
 
 @workflow(metadata._nextflow_metadata)
-def nf_nf_core_proteomicslfq(input: str, outdir: typing.Optional[typing_extensions.Annotated[LatchDir, FlyteAnnotation({'output': True})]], email: typing.Optional[str], root_folder: typing.Optional[str], local_input_type: typing.Optional[str], expdesign: typing.Optional[str], database: str, add_decoys: typing.Optional[bool], openms_peakpicking: typing.Optional[bool], peakpicking_inmemory: typing.Optional[bool], peakpicking_ms_levels: typing.Optional[str], db_debug: typing.Optional[int], enable_mod_localization: typing.Optional[bool], pp_debug: typing.Optional[int], description_correct_features: typing.Optional[int], consensusid_considered_top_hits: typing.Optional[int], min_consensus_support: typing.Optional[int], mass_recalibration: typing.Optional[bool], inf_quant_debug: typing.Optional[int], skip_post_msstats: typing.Optional[bool], ref_condition: typing.Optional[str], contrasts: typing.Optional[str], enable_qc: typing.Optional[bool], ptxqc_report_layout: typing.Optional[str], decoy_affix: typing.Optional[str] = 'DECOY_', affix_type: typing.Optional[str] = 'prefix', search_engines: typing.Optional[str] = 'comet', enzyme: typing.Optional[str] = 'Trypsin', num_enzyme_termini: typing.Optional[str] = 'fully', allowed_missed_cleavages: typing.Optional[int] = 2, precursor_mass_tolerance: typing.Optional[int] = 5, precursor_mass_tolerance_unit: typing.Optional[str] = 'ppm', fragment_mass_tolerance: typing.Optional[float] = 0.03, fragment_mass_tolerance_unit: typing.Optional[str] = 'Da', fixed_mods: typing.Optional[str] = 'Carbamidomethyl (C)', variable_mods: typing.Optional[str] = 'Oxidation (M)', isotope_error_range: typing.Optional[str] = '0,1', instrument: typing.Optional[str] = 'high_res', protocol: typing.Optional[str] = 'automatic', min_precursor_charge: typing.Optional[int] = 2, max_precursor_charge: typing.Optional[int] = 4, min_peptide_length: typing.Optional[int] = 6, max_peptide_length: typing.Optional[int] = 40, num_hits: typing.Optional[int] = 1, max_mods: typing.Optional[int] = 3, mod_localization: typing.Optional[str] = 'Phospho (S),Phospho (T),Phospho (Y)', allow_unmatched: typing.Optional[str] = 'false', IL_equivalent: typing.Optional[str] = 'true', posterior_probabilities: typing.Optional[str] = 'percolator', psm_pep_fdr_cutoff: typing.Optional[float] = 0.1, FDR_level: typing.Optional[str] = 'peptide-level-fdrs', train_FDR: typing.Optional[float] = 0.05, test_FDR: typing.Optional[float] = 0.05, subset_max_train: typing.Optional[int] = 300000, outlier_handling: typing.Optional[str] = 'none', consensusid_algorithm: typing.Optional[str] = 'best', protein_inference: typing.Optional[str] = 'aggregation', protein_level_fdr_cutoff: typing.Optional[float] = 0.05, protein_quant: typing.Optional[str] = 'unique_peptides', quantification_method: typing.Optional[str] = 'feature_intensity', transfer_ids: typing.Optional[str] = 'false', targeted_only: typing.Optional[bool] = True) -> None:
+def nf_nf_core_proteomicslfq(input: str, outdir: typing.Optional[typing_extensions.Annotated[LatchDir, FlyteAnnotation({'output': True})]], email: typing.Optional[str], root_folder: typing.Optional[str], local_input_type: typing.Optional[str], sdrf_cache: typing.Optional[str], expdesign: typing.Optional[str], database: str, storage_expansion_factor: typing.Optional[float], add_decoys: typing.Optional[bool], database_cache: typing.Optional[str], openms_peakpicking: typing.Optional[bool], peakpicking_inmemory: typing.Optional[bool], peakpicking_ms_levels: typing.Optional[str], db_debug: typing.Optional[int], enable_mod_localization: typing.Optional[bool], pp_debug: typing.Optional[int], description_correct_features: typing.Optional[int], consensusid_considered_top_hits: typing.Optional[int], min_consensus_support: typing.Optional[int], mass_recalibration: typing.Optional[bool], inf_quant_debug: typing.Optional[int], skip_post_msstats: typing.Optional[bool], ref_condition: typing.Optional[str], contrasts: typing.Optional[str], enable_qc: typing.Optional[bool], ptxqc_report_layout: typing.Optional[str], publish_dir_mode_overrides: typing.Optional[str], conversion_cache: typing.Optional[str], raw_conversion_batch_size: typing.Optional[int], peakpicking_adaptive: typing.Optional[bool], peakpicking_compression: typing.Optional[bool], search_chunking: typing.Optional[bool], search_chunk_size: typing.Optional[int], search_max_chunks: typing.Optional[int], fused_search: typing.Optional[bool], luciphor_shard_size: typing.Optional[int], post_search_batch_size: typing.Optional[int], percolator_study_level: typing.Optional[bool], per_run_feature_detection: typing.Optional[bool], export_parquet: typing.Optional[bool], enable_qc_metrics: typing.Optional[bool], contaminant_regex: typing.Optional[str], decoy_affix: typing.Optional[str] = 'DECOY_', affix_type: typing.Optional[str] = 'prefix', search_engines: typing.Optional[str] = 'comet', enzyme: typing.Optional[str] = 'Trypsin', num_enzyme_termini: typing.Optional[str] = 'fully', allowed_missed_cleavages: typing.Optional[int] = 2, precursor_mass_tolerance: typing.Optional[int] = 5, precursor_mass_tolerance_unit: typing.Optional[str] = 'ppm', fragment_mass_tolerance: typing.Optional[float] = 0.03, fragment_mass_tolerance_unit: typing.Optional[str] = 'Da', fixed_mods: typing.Optional[str] = 'Carbamidomethyl (C)', variable_mods: typing.Optional[str] = 'Oxidation (M)', isotope_error_range: typing.Optional[str] = '0,1', instrument: typing.Optional[str] = 'high_res', protocol: typing.Optional[str] = 'automatic', min_precursor_charge: typing.Optional[int] = 2, max_precursor_charge: typing.Optional[int] = 4, min_peptide_length: typing.Optional[int] = 6, max_peptide_length: typing.Optional[int] = 40, num_hits: typing.Optional[int] = 1, max_mods: typing.Optional[int] = 3, mod_localization: typing.Optional[str] = 'Phospho (S),Phospho (T),Phospho (Y)', allow_unmatched: typing.Optional[str] = 'false', IL_equivalent: typing.Optional[str] = 'true', posterior_probabilities: typing.Optional[str] = 'percolator', psm_pep_fdr_cutoff: typing.Optional[float] = 0.1, FDR_level: typing.Optional[str] = 'peptide-level-fdrs', train_FDR: typing.Optional[float] = 0.05, test_FDR: typing.Optional[float] = 0.05, subset_max_train: typing.Optional[int] = 300000, outlier_handling: typing.Optional[str] = 'none', consensusid_algorithm: typing.Optional[str] = 'best', protein_inference: typing.Optional[str] = 'aggregation', protein_level_fdr_cutoff: typing.Optional[float] = 0.05, protein_quant: typing.Optional[str] = 'unique_peptides', quantification_method: typing.Optional[str] = 'feature_intensity', transfer_ids: typing.Optional[str] = 'false', targeted_only: typing.Optional[bool] = True) -> None:
     """
     nf-core/proteomicslfq
 
     Sample Description
     """
 
-    pvc_name: str = initialize()
-    nextflow_runtime(pvc_name=pvc_name, input=input, outdir=outdir, email=email, root_folder=root_folder, local_input_type=local_input_type, expdesign=expdesign, database=database, add_decoys=add_decoys, decoy_affix=decoy_affix, affix_type=affix_type, openms_peakpicking=openms_peakpicking, peakpicking_inmemory=peakpicking_inmemory, peakpicking_ms_levels=peakpicking_ms_levels, search_engines=search_engines, enzyme=enzyme, num_enzyme_termini=num_enzyme_termini, allowed_missed_cleavages=allowed_missed_cleavages, precursor_mass_tolerance=precursor_mass_tolerance, precursor_mass_tolerance_unit=precursor_mass_tolerance_unit, fragment_mass_tolerance=fragment_mass_tolerance, fragment_mass_tolerance_unit=fragment_mass_tolerance_unit, fixed_mods=fixed_mods, variable_mods=variable_mods, isotope_error_range=isotope_error_range, instrument=instrument, protocol=protocol, min_precursor_charge=min_precursor_charge, max_precursor_charge=max_precursor_charge, min_peptide_length=min_peptide_length, max_peptide_length=max_peptide_length, num_hits=num_hits, max_mods=max_mods, db_debug=db_debug, enable_mod_localization=enable_mod_localization, mod_localization=mod_localization, allow_unmatched=allow_unmatched, IL_equivalent=IL_equivalent, posterior_probabilities=posterior_probabilities, psm_pep_fdr_cutoff=psm_pep_fdr_cutoff, pp_debug=pp_debug, FDR_level=FDR_level, train_FDR=train_FDR, test_FDR=test_FDR, subset_max_train=subset_max_train, description_correct_features=description_correct_features, outlier_handling=outlier_handling, consensusid_algorithm=consensusid_algorithm, consensusid_considered_top_hits=consensusid_considered_top_hits, min_consensus_support=min_consensus_support, protein_inference=protein_inference, protein_level_fdr_cutoff=protein_level_fdr_cutoff, protein_quant=protein_quant, quantification_method=quantification_method, mass_recalibration=mass_recalibration, transfer_ids=transfer_ids, targeted_only=targeted_only, inf_quant_debug=inf_quant_debug, skip_post_msstats=skip_post_msstats, ref_condition=ref_condition, contrasts=contrasts, enable_qc=enable_qc, ptxqc_report_layout=ptxqc_report_layout)
+    pvc_name, input_bytes, storage_gib = initialize(input=input, root_folder=root_folder, local_input_type=local_input_type, database=database, storage_expansion_factor=storage_expansion_factor)
+    nextflow_runtime(pvc_name=pvc_name, input_bytes=input_bytes, storage_gib=storage_gib, storage_expansion_factor=storage_expansion_factor, input=input, outdir=outdir, email=email, publish_dir_mode_overrides=publish_dir_mode_overrides, root_folder=root_folder, local_input_type=local_input_type, sdrf_cache=sdrf_cache, expdesign=expdesign, database=database, add_decoys=add_decoys, decoy_affix=decoy_affix, affix_type=affix_type, database_cache=database_cache, conversion_cache=conversion_cache, raw_conversion_batch_size=raw_conversion_batch_size, openms_peakpicking=openms_peakpicking, peakpicking_inmemory=peakpicking_inmemory, peakpicking_adaptive=peakpicking_adaptive, peakpicking_compression=peakpicking_compression, peakpicking_ms_levels=peakpicking_ms_levels, search_engines=search_engines, enzyme=enzyme, num_enzyme_termini=num_enzyme_termini, allowed_missed_cleavages=allowed_missed_cleavages, precursor_mass_tolerance=precursor_mass_tolerance, precursor_mass_tolerance_unit=precursor_mass_tolerance_unit, fragment_mass_tolerance=fragment_mass_tolerance, fragment_mass_tolerance_unit=fragment_mass_tolerance_unit, fixed_mods=fixed_mods, variable_mods=variable_mods, isotope_error_range=isotope_error_range, instrument=instrument, protocol=protocol, min_precursor_charge=min_precursor_charge, max_precursor_charge=max_precursor_charge, min_peptide_length=min_peptide_length, max_peptide_length=max_peptide_length, num_hits=num_hits, max_mods=max_mods, db_debug=db_debug, search_chunking=search_chunking, search_chunk_size=search_chunk_size, search_max_chunks=search_max_chunks, fused_search=fused_search, enable_mod_localization=enable_mod_localization, mod_localization=mod_localization, luciphor_shard_size=luciphor_shard_size, allow_unmatched=allow_unmatched, IL_equivalent=IL_equivalent, posterior_probabilities=posterior_probabilities, psm_pep_fdr_cutoff=psm_pep_fdr_cutoff, post_search_batch_size=post_search_batch_size, pp_debug=pp_debug, FDR_level=FDR_level, train_FDR=train_FDR, test_FDR=test_FDR, subset_max_train=subset_max_train, percolator_study_level=percolator_study_level, description_correct_features=description_correct_features, outlier_handling=outlier_handling, consensusid_algorithm=consensusid_algorithm, consensusid_considered_top_hits=consensusid_considered_top_hits, min_consensus_support=min_consensus_support, protein_inference=protein_inference, protein_level_fdr_cutoff=protein_level_fdr_cutoff, protein_quant=protein_quant, quantification_method=quantification_method, mass_recalibration=mass_recalibration, transfer_ids=transfer_ids, targeted_only=targeted_only, per_run_feature_detection=per_run_feature_detection, inf_quant_debug=inf_quant_debug, skip_post_msstats=skip_post_msstats, ref_condition=ref_condition, contrasts=contrasts, export_parquet=export_parquet, enable_qc=enable_qc, enable_qc_metrics=enable_qc_metrics, contaminant_regex=contaminant_regex, ptxqc_report_layout=ptxqc_report_layout)
 